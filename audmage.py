@@ -22,8 +22,61 @@
 
 # Command inputs: 
 #   1-  <path to data> : required, audioDir or imgDir (if sorting images)
-#   2+- options{audio, spect, audmage, create, dataset, copy, test}
+#   2+- options{audio, spect, audmage, create, dataset, copy, test, npy}
 #              (takes 0 or more options)
+#   --render=<mpl|lut> : spectrogram renderer, lut skips matplotlib figures
+#   --size=<W>x<H>     : size of lut spectrograms (default 503x376)
+#   --png-level=<0-9>  : PNG compression level of lut spectrograms
+#   npy                : save lut spectrograms as raw uint8 .npy files
+#   features           : save the log-mel matrices (float16 .npy, dB)
+#                        instead of spectrogram images, for dlag-p.py
+#   --batch=<N>        : compute spectrograms with the float32 FFT
+#                        (batchLogMel, about 1.5x librosa's), N tracks
+#                        per task. The gain is the FFT, not N: any N
+#                        from 2 up is about as fast (bench.py batch)
+#   --chunksize=<N>    : tasks handed to a worker at a time (default 1)
+#   --max-tasks=<N>    : replace each worker after N tasks (memory growth)
+#   --order=<size|list> : hand out the biggest files first (default)
+#                        or keep the TRACKLIST order
+#   report             : print per-worker busy time after each stage
+#   --shard-index=<I> --shard-count=<N> : only create shard I of N
+#                        (split by hashed track id), one per node,
+#                        writes manifests/shard-<I>-of-<N>.csv
+#   merge              : merge the shard manifests (with --shard-count)
+#                        and report missing or failed tracks
+#   --queue=<file.db>  : SQLite work queue, with create the workers
+#                        lease tracks from it (any number of hosts)
+#   publish/queueinfo  : add the matched tracks to the queue, or show it
+#   --lease=<seconds>  : lease timeout (default 600), then retried
+#   --tries=<N>        : times a track is tried before failing (default 3)
+#   --journal=<file.db> : job journal (default journal.db, 'none' is off)
+#                        reruns skip the images it has as done
+#   --retry-failed     : only make the tracks the journal has failed
+#                        images of (failed images are retried anyway,
+#                        this skips the rest), not with --queue
+#   nostream           : search and match every file before creating
+#                        (default is to start creating while searching)
+#   --link=<hard|sym|reflink> : link files into the dataset (and when
+#                        sorting) instead of copying (--link is hard),
+#                        copies when it can't link (across devices)
+#   dryrun             : print the sorting/dataset file operations
+#                        (moves, copies, removes, new dirs), do nothing
+#   --file-threads=<N> : threads moving/copying files (default 8)
+#   manifest           : with dataset, only write the split to
+#                        dataset/<spect|audmage>.csv, no copies
+#   --seed=<N>         : seed of the dataset split (another split)
+#   --cache=<dir>      : cache decoded audio here, reruns skip decoding
+#   --cache-size=<20G> : size cap of the audio cache (LRU pruned)
+#   cacheinfo/cacheprune : show the audio cache, or prune it to --cache-size
+#   --mel=<n_fft>:<hop>:<n_mels> : also create this spectrogram version
+#                        (more than once for more versions), each
+#                        track is decoded only once for all images
+#   --stft-block=<seconds> : decode and compute spectrograms in blocks
+#                        of this many seconds, memory doesn't grow
+#                        with the track (fma_full, hours long tracks)
+#                        audmages still load whole tracks
+#   --max-frames=<N>   : with --stft-block, average the spectrogram
+#                        down to at most N frames (time) as it goes
 #
 # [Usage Examples]
 # ex: ~$ python audmage.py fma_small audio
@@ -43,6 +96,39 @@
 # ex4: ~$ python audmage.py fma_small
 # default, no options does all options!
 #
+#
+# ex5: ~$ python audmage.py fma_small create spect --render=lut --png-level=1
+# creates spectrograms without matplotlib figures, fast PNG compression
+#
+#
+# ex6: ~$ python audmage.py audiocache cacheprune --cache-size=20G
+# prunes the decoded audio cache down to 20GB
+#
+#
+# ex7: ~$ python audmage.py fma_full create spect --shard-index=3 --shard-count=16
+# creates the spectrograms of shard 3 (of 16), run one shard per node
+# then: ~$ python audmage.py fma_full merge --shard-count=16
+#
+#
+# ex8: ~$ python audmage.py fma_full publish --queue=jobs.db
+# adds every track to the work queue, then on each host (same dir):
+#      ~$ python audmage.py fma_full create spect --queue=jobs.db
+#
+#
+# ex9: ~$ python audmage.py sorted dataset spect manifest --seed=7
+# writes the split to dataset/spect.csv, then train from it:
+#      ~$ python dlag-p.py dataset/spect.csv
+#
+#
+# ex10: ~$ python audmage.py fma_small create spect features dataset manifest
+# saves each track's log-mel as sorted/spect/<genre>/<track>.npy (float16)
+# and its split to dataset/spect.csv, dlag-p.py trains on 1 channel inputs
+#
+#
+# ex11: ~$ python audmage.py fma_full create spect features --stft-block=30 --max-frames=4096
+# streams full length tracks 30 seconds at a time, each worker's memory stays
+# the same however long the track, spectrograms at most 4096 frames wide
+#
 #############################################################
 
 #Import required libs
@@ -50,17 +136,39 @@ import matplotlib
 matplotlib.use('Agg')
 import os    #for file system tools
 import sys   #to read command-line arguments
-from multiprocessing import Pool
+from multiprocessing import Pool, Value
+from multiprocessing.pool import ThreadPool #file operation threads
 import numpy as np #matrices and tools
 import librosa #spectrogram/audio tools
 from librosa import display #Must import seperately
+import audioread #block by block decoding (streamed spectrograms)
+import resampy   #librosa.load's resampler
+from fractions import gcd
+from numpy.lib.stride_tricks import as_strided
+from scipy import fftpack #single precision FFTs
 
 import matplotlib.pyplot as plt #for access to the pyplot module
                                 #underlying librosa
 from shutil import move #move(src, dst)
 from shutil import copyfile #copyfile(src, dst)
-from random import shuffle #randomize the dataset selections
 import csv
+import json
+import zlib   #PNG compression
+import struct #PNG chunk headers
+import hashlib #audio cache keys
+import time
+import threading #file threads, journal lock, lease renewal
+import sqlite3 #work queue
+try:
+  from os import scandir #python 3.5+
+except ImportError:
+  try:
+    from scandir import scandir #python 2: pip install scandir
+  except ImportError:
+    scandir = None #walkFiles falls back to os.listdir
+import socket  #work queue lease owners
+import errno
+import fcntl   #reflinks (FICLONE)
 
 ###########
 # GLOBALS #
@@ -72,21 +180,147 @@ GDATA = False   #If True, we are going to generate a dataset.
 CREATE = False  #If True, we are going to create images.
 VERBOSE = False #If True, we will print out commentary.
 COPY = False    #If True, files are copied when sorting.
+LINKMODE = None #'hard', 'sym' or 'reflink', files are linked instead of
+                #copied (datasets and sorting), no extra disk space.
+                #Where that's not possible (across devices) they are
+                #copied. None = copy.
 TEST = False    #If True, stop creating images after just 5.
+SPLITMANIFEST = False #If True, generateSet only writes the split as
+                #dataset/<item>.csv (no dataset dirs, nothing copied),
+                #dlag-p.py trains straight from it (see dlagdata.py)
+SPLITSEED = None #Seed of the dataset split, tracks are split by
+                #their hashed id, another seed gives another split
+
+RENDER = 'mpl'  #Spectrogram renderer, 'mpl' uses librosa's specshow
+                #and a matplotlib figure, 'lut' maps the log-mel values
+                #through a colormap lookup table (no figure, much faster).
+IMGSIZE = (503, 376) #(width, height) of 'lut' spectrograms
+PNGLEVEL = 6    #PNG compression level (0-9) of 'lut' spectrograms
+RAWNPY = False  #If True, 'lut' spectrograms are saved as uint8 .npy
+FEATURES = False #If True, spectrograms are saved as their log-mel
+                 #matrix, float16 (n_mels, frames) .npy, no image
+BATCHSIZE = 1   #Tracks per batch when computing spectrograms,
+                #above 1 batchLogMel's float32 FFT is used (that's
+                #the speedup, not the stacking of equal length clips,
+                #bigger batches are no faster, see bench.py batch).
+CACHEDIR = None #If set, decoded audio is cached in this dir as
+                #float32 .npy files, so reruns skip decoding.
+CACHESIZE = 0   #Max size of the audio cache in bytes (0 = no limit)
+                #least recently used tracks are removed first.
+CACHECMD = None #'info' or 'prune', inspect or prune the audio cache
+STFTBLOCK = 0   #If above 0, spectrograms are streamed: the audio is
+                #decoded and its STFT computed this many seconds at
+                #a time (see streamLogMels), 0 loads whole tracks
+MAXFRAMES = 0   #If above 0 (and STFTBLOCK), streamed spectrograms
+                #are averaged down to at most this many frames
+MELCONFIGS = [] #Extra spectrogram versions to create, list of
+                #[n_fft, hop_length, n_mels], each one is saved
+                #in sorted/spect-<n_fft>-<hop_length>-<n_mels>
+
+STREAM = True   #If True, tracks are matched and handed to the
+                #workers while the search is still going
+                #(see streamTracks), 'nostream' searches first.
+STREAMWINDOW = 64 #Streamed tasks are handed out biggest first
+                #within windows of this many tasks.
+
+FILETHREADS = 8 #Threads moving/copying files when sorting and
+                #generating datasets (see runPlan)
+DRYRUN = False  #If True, sorting and datasets only print the plan
+                #of file operations, nothing is moved or copied
+DIRSMADE = set() #Genres whose dirs doDirs() has made
+FILELOCK = threading.Lock() #Guards LINKCOPIES/NOLINKS (file threads)
+LINKCOPIES = 0  #Files copied because they couldn't be linked
+NOLINKS = set() #(src device, dst device) pairs that can't be linked
+FICLONE = 0x40049409 #Linux ioctl that reflinks a whole file
 
 PATHLIST = []   #List of file paths(audio/image)
 TRACKLIST = []  #List of tuples (filePath, genre)
-META = []       #List of meta data (from csv file)
-META_T= {}       #Dictionary of track names and matching genres
-                #Indexed by track name.
+GINDEX = None   #Genre index [trackIds, genreCodes, genreNames]
+                #sorted int32 ids and matching uint8 genre codes
+                #(memory-mapped), see loadGenreIndex()
+GINDEX_DIR = 'genreindex' #Where the genre index files are kept.
                     
 NUMNODES = 1    #Number of CPU nodes you will be using(non-zero).
 NUMCORES = 4   #Number of CPU cores per node you will be using(non-zero).
                 #Number of workers(sub-processes) = NUMNODES * NUMCORES
                 #(16 cores on the GPUs)
 
-S = 0           #Number of completed images(per given instance)
-                #ie: 5*32Workers = 160 images done. (test)
+CHUNKSIZE = 1   #Tasks handed to a worker at a time
+MAXTASKS = None #Tasks a worker does before it is replaced by a
+                #fresh one (None = never), keeps librosa/matplotlib
+                #memory growth from building up.
+POOL = None     #The worker pool, made once for all creation stages
+ORDER = 'size'  #Task order, 'size' hands out the biggest (slowest)
+                #files first so no long track is left for the end,
+                #'list' keeps the TRACKLIST order.
+REPORT = False  #If True, print a scheduling report after each stage
+
+SHARDINDEX = 0  #This node's shard (0 to SHARDCOUNT-1)
+SHARDCOUNT = 1  #Number of shards (nodes) the tracks are split into,
+                #above 1 each node only creates the tracks whose
+                #hashed id falls in its shard (see trackShard).
+MANIFEST_DIR = 'manifests' #Where the shard manifests are written
+MERGE = False   #If True, merge the shard manifests and report
+
+QUEUEFILE = None #If set, tracks are leased from this SQLite work
+                 #queue (see publishTracks) instead of TRACKLIST
+QUEUECMD = None  #'publish' or 'info', fill or inspect the work queue
+JOURNALFILE = 'journal.db' #SQLite record of every image made (or failed)
+                 #and the settings used, reruns skip the done images
+                 #from it (None = check each file with os.path.exists)
+RETRYFAILED = False #If True, only the tracks with failed images are
+                    #made (failed images are retried either way)
+JOURNAL = {}     #savePath -> [status, params] loaded by loadJournal()
+JOURNALOUT = []  #Image results of this worker not yet in the journal
+JOURNALLOCK = threading.Lock() #Guards JOURNALOUT (a thread may add
+                 #to it while another takes it)
+FAILEDTRACKS = set() #Tracks with failed images (for RETRYFAILED)
+
+LEASETIME = 600  #Seconds a lease lasts unless renewed (every third of
+                 #it while the worker is alive), after that the track
+                 #is handed out again (crashed worker)
+MAXTRIES = 3     #Times a track is handed out before it is 'failed'
+
+DONE = None     #Number of completed images (shared by all workers)
+TESTED = None   #Number of images started in test mode (shared)
+                #Both are multiprocessing Values, see startPool()
+
+#####################
+# PROGRESS COUNTERS #
+#####################
+#Adds one to the shared count of completed images
+#and returns the new count (across all workers).
+def countDone():
+  global DONE
+  if DONE == None:
+    DONE = Value('i', 0) #Not started by startPool()
+  with DONE.get_lock():
+    DONE.value += 1
+    return DONE.value
+#END countDone Function
+
+
+#In test mode, claims one of the 5 test images. Returns False
+#once all 5 have been claimed (by any worker).
+def claimTest():
+  global TESTED
+  if not TEST:
+    return True
+  if TESTED == None:
+    TESTED = Value('i', 0) #Not started by startPool()
+  with TESTED.get_lock():
+    if TESTED.value >= 5:
+      return False
+    TESTED.value += 1
+    return True
+#END claimTest Function
+
+
+#True if in test mode and all 5 test images are claimed
+def testDone():
+  return TEST and TESTED != None and TESTED.value >= 5
+#END testDone Function
+
 
 ####################
 # SEARCH FOR FILES #
@@ -95,40 +329,72 @@ S = 0           #Number of completed images(per given instance)
 #If AUDIO flag set, only finds .mp3 files
 #If no AUDIO flag set, only finds .png files
 def doSearch(dirPath):
-  #Is dirPath a directory or file?
-  if os.path.isdir(dirPath):
-    #Try to read dirPath
-    try:
-      itemList = os.listdir(dirPath)
-    except IOError:
-      print 'Failed to open: '+ dirPath
-      return False
-    #pass each item back into this function
-    #and add its results to this one
-    for item in itemList:
-      doSearch(dirPath +'/'+ item)
-  else:
+  for fpath in searchFiles(dirPath):
+    PATHLIST.append(fpath)
+  return True
+#END doSearch Function
+
+
+#Yields the files doSearch wants as they are found
+def searchFiles(dirPath):
+  for fpath in walkFiles(dirPath):
     if VERBOSE:
-      print 'Found audio file: '+ dirPath
-    #dirPath is a file, if looking for audio
+      print 'Found file: '+ fpath
     #find only audio, else find only images
     #this avoids picking up files we don't want
     #(what if image file in audio dir?.. we make sure)
-
-    if (AUDIO or CREATE) and dirPath[-4:] == '.mp3':
+    if (AUDIO or CREATE) and fpath[-4:] == '.mp3':
       #Only grab .mp3 files and only if working with audio
-      PATHLIST.append(dirPath)
-    elif (SPECT or AUDMAGE) and dirPath[-4:] == '.png':
+      yield fpath
+    elif (SPECT or AUDMAGE) and fpath[-4:] == '.png':
       #Only grab .png files since we are not working with audio
-      PATHLIST.append(dirPath)
-  return True
-#END doSearch Function
+      yield fpath
+#END searchFiles Function
+
+
+#Yields the path of every file under dirPath, one directory
+#listing at a time (a stack, no recursion). With scandir the
+#entry types come with the listing, no isdir() call per entry.
+def walkFiles(dirPath):
+  if not os.path.isdir(dirPath):
+    yield dirPath #a file
+    return
+  dirs = [dirPath]
+  while dirs:
+    current = dirs.pop()
+    try:
+      if scandir != None:
+        entries = [(entry.path, entry.is_dir()) for entry in scandir(current)]
+      else:
+        entries = [(current +'/'+ name, os.path.isdir(current +'/'+ name)) for name in os.listdir(current)]
+    except OSError:
+      print 'Failed to open: '+ current
+      continue
+    subDirs = []
+    for path, isDir in entries:
+      if isDir:
+        subDirs.append(path)
+      else:
+        yield path
+    dirs.extend(reversed(subDirs)) #first sub-directory on top
+#END walkFiles Function
 
 
 #####################################
 # Creating the Directory Structures #
 #####################################
+#Name of the sorted dir for a spectrogram version
+#ex: [2048, 512, 128] -> 'spect-2048-512-128'
+def melDirName(config):
+  return 'spect-'+ '-'.join(str(v) for v in config)
+#END melDirName Function
+
+
+#Makes the sorted (and dataset) dirs of a genre, once per
+#genre and run (DIRSMADE), not per track.
 def doDirs(genre):
+  if genre in DIRSMADE or DRYRUN:
+    return True
   
   #Sorted version
   # 'sorted/audio/<genre>/<image>'
@@ -183,6 +449,14 @@ def doDirs(genre):
       if not os.path.isdir("dataset/spect/validate/"+ genre):
         os.mkdir("dataset/spect/validate/"+ genre)
 
+  #Create extra spectrogram version dirs (sorted ver)
+  for config in MELCONFIGS:
+    item = melDirName(config)
+    if not os.path.isdir("sorted/"+ item):
+      os.mkdir("sorted/"+ item)
+    if not os.path.isdir("sorted/"+ item +"/"+ genre):
+      os.mkdir("sorted/"+ item +"/"+ genre)
+
   if AUDMAGE:
     #Create audmage dir (sorted ver)
     if not os.path.isdir("sorted/audmage"):
@@ -212,6 +486,7 @@ def doDirs(genre):
       if not os.path.isdir("dataset/audmage/validate/"+ genre):
         os.mkdir("dataset/audmage/validate/"+ genre)
 
+  DIRSMADE.add(genre)
   return True
 #End doDirs function
 
@@ -219,157 +494,1105 @@ def doDirs(genre):
 ################
 # MATCH TRACKS #
 ################
+#Returns the track name (number minus leading zeros)
+#of an audio/image file path. ex: 'fma/000/000002.mp3' -> '2'
+def getTrackName(fpath):
+  tmp = fpath.split('/')[-1] # filename.mp3
+  return str(int(tmp.split('.')[0]))
+#END getTrackName Function
+
+
+#Reads the csv rows (tracks.csv) once and returns a dictionary
+#of track names and genres. Only the track id (col 0),
+#subset (col 32) and genre (col 40) columns are looked at.
+def buildGenreIndex(meta):
+  genreIndex = {}
+  for row in meta:
+    if len(row) < 41:
+      continue #header or broken row
+    if row[32] == 'small' or row[32] == 'medium':
+      #ensure proper formatting for dirName for the genre
+      genreIndex[row[0]] = str(row[40]).replace(' ', '').replace('/', '-').replace(',', '-')
+  return genreIndex
+#END buildGenreIndex Function
+
+
+#Returns the path to tracks.csv or None if it can't be found
+def findTracksCsv():
+  for csvPath in ['fma_metadata/tracks.csv', 'tracks.csv']:
+    if os.path.isfile(csvPath):
+      return csvPath
+  return None
+#END findTracksCsv Function
+
+
+#Size and modified time of a file, used to tell
+#if the genre index is older than its source.
+def sourceStamp(srcPath):
+  info = os.stat(srcPath)
+  return [srcPath, info.st_size, info.st_mtime]
+#END sourceStamp Function
+
+
+#Writes the genre index files from a dictionary of track
+#names and genres (see buildGenreIndex).
+#  genreindex/ids.npy    - sorted int32 track ids
+#  genreindex/genres.npy - uint8 genre code of each id
+#  genreindex/meta.json  - genre names + source size/mtime
+#meta.json is written last, so a half written index
+#is seen as missing and gets rebuilt.
+def saveGenreIndex(genreIndex, stamp):
+  if not os.path.isdir(GINDEX_DIR):
+    os.mkdir(GINDEX_DIR)
+  metaPath = GINDEX_DIR +'/meta.json'
+  if os.path.exists(metaPath):
+    os.remove(metaPath)
+
+  names = sorted(set(genreIndex.values()))
+  if len(names) > 255:
+    print 'Too many genres for the genre index: '+ str(len(names))
+    return False
+  codeOf = dict((name, code) for code, name in enumerate(names))
+
+  trackIds = np.array(sorted(int(t) for t in genreIndex), dtype=np.int32)
+  codes = np.array([codeOf[genreIndex[str(t)]] for t in trackIds], dtype=np.uint8)
+  np.save(GINDEX_DIR +'/ids.npy', trackIds)
+  np.save(GINDEX_DIR +'/genres.npy', codes)
+
+  with open(metaPath +'.tmp', 'w') as f:
+    json.dump({'source': stamp, 'genres': names, 'count': len(trackIds)}, f)
+  os.rename(metaPath +'.tmp', metaPath)
+  return True
+#END saveGenreIndex Function
+
+
+#Loads the genre index into the GINDEX global.
+#The arrays are memory-mapped, so this is quick even for the
+#full FMA catalog. If a part of the index is missing, or
+#tracks.csv has changed since it was built, the whole index is
+#rebuilt from tracks.csv (or an old tracks.txt if there's no
+#csv). That's on purpose: no part can be remade from the others
+#(the codes index the genre names in meta.json, ids and codes go
+#row by row), and a changed source changes all three. It's one
+#pass over the csv, under a second for 100k rows (bench.py match).
+def loadGenreIndex():
+  global GINDEX
+  GINDEX = None
+
+  #Where would the genre data come from?
+  srcPath = findTracksCsv()
+  if srcPath == None and os.path.isfile('tracks.txt'):
+    srcPath = 'tracks.txt'
+
+  #Try the index we already have
+  meta = None
+  try:
+    with open(GINDEX_DIR +'/meta.json', 'r') as f:
+      meta = json.load(f)
+    trackIds = np.load(GINDEX_DIR +'/ids.npy', mmap_mode='r')
+    codes = np.load(GINDEX_DIR +'/genres.npy', mmap_mode='r')
+    if not len(trackIds) == len(codes) == meta['count']:
+      meta = None #Broken index
+  except (IOError, ValueError, KeyError):
+    meta = None #Missing or broken index
+
+  if meta != None:
+    #Still up to date with its source?
+    if srcPath == None or sourceStamp(srcPath) == meta['source']:
+      GINDEX = [trackIds, codes, [str(g) for g in meta['genres']]]
+      return True
+    print 'Genre index is out of date with '+ srcPath +', rebuilding it...'
+  elif srcPath == None:
+    print 'Could not find tracks.csv (fma_metadata/tracks.csv)'
+    return False
+  else:
+    print 'Building genre index from '+ srcPath +', please wait...'
+
+  #(Re)build the index from its source
+  stamp = sourceStamp(srcPath)
+  if srcPath == 'tracks.txt':
+    genreIndex = {}
+    with open(srcPath, 'r') as f:
+      for row in f.read().splitlines():
+        tmp2 = row.split(' ')
+        genreIndex[tmp2[0]] = tmp2[1]
+  else:
+    with open(srcPath, 'rb') as iFile:
+      genreIndex = buildGenreIndex(csv.reader(iFile))
+  if not saveGenreIndex(genreIndex, stamp):
+    return False
+  print 'Indexed '+ str(len(genreIndex)) +' tracks.'
+  return loadGenreIndex()
+#END loadGenreIndex Function
+
+
+#Looks up the genres of a list of track names using
+#a binary search of the genre index.
+#Returns a list of genres, None where not found.
+def lookupGenres(names):
+  trackIds, codes, genres = GINDEX
+  wanted = np.array([int(n) for n in names], dtype=np.int64)
+  if len(trackIds) == 0:
+    return [None] * len(wanted)
+  pos = np.searchsorted(trackIds, wanted)
+  pos = np.minimum(pos, len(trackIds) - 1) #past the end can't match
+  found = trackIds[pos] == wanted
+  return [genres[c] if f else None for c, f in zip(codes[pos], found)]
+#END lookupGenres Function
+
+
 #Matches names of files in the PATHLIST global
-#with genres read from the tracks.txt, tracks.csv
-#or from the audio file itself(if audio files)
+#with genres from the genre index (built from tracks.csv)
 #Adds matches as tuple pair to TRACKLIST global
 def matchTracks():
   
   #Check for pathList
   if not PATHLIST:
     print 'pathList is empty, no tracks to match. You must first do a search.'
+  elif GINDEX == None:
+    #Skip or read from .mp3 file..
+    print 'No genre data, skipping...'
   else:
-  
-    #Before we start any loops.. where are we finding the genre data?
-    #Is tracks.txt available????
-    if META_T:
-      if VERBOSE:
-        print 'Using tracks.txt for genre matching. (You wanna go fast!)'
-      #Loop each path in pathList
-      for fpath in PATHLIST:
-        #Split up the path string and get 
-        #the file name and extension
-        tmp = fpath.split('/') #Split path into list seperating by '/' 
-        tmp2 = str(tmp[-1]).split('.') #last element is filename+ext
-        fullFileName = tmp[-1]       # filename.mp3
-        fileName = str(int(tmp2[0]))  # filename
-        fileExt = tmp2[1]             # .mp3/.png
+    if VERBOSE:
+      print 'Using the genre index for genre matching. (You wanna go fast!)'
+
+    missing = matchPaths(PATHLIST)[1]
+    if missing:
+      print 'Unable to find a genre for '+ str(len(missing)) +' files:'
+      print missing
         
-        #Get the genre that matches this filename
-        try:
-          tgenre = META_T[fileName]
-        except KeyError:
-          print 'Missing tracks.txt entry for: '+ str(fileName)
-          print 'Please remove tracks.txt so it can be regenerated for this set.'
-          print '(Requires tracks.csv)'
-          sys.exit()
+  return True
+#END matchTracks Function
 
-        print 'File: '+ fullFileName +', Genre: '+ tgenre
-        #Create genre directories (and or dataset dirs)
-        #If they don't already exist
-        doDirs(tgenre)
 
-        #add trackPath and genre as tuple to TRACKLIST
-        TRACKLIST.append([fpath, tgenre])
+#Matches paths with their genres and adds them to TRACKLIST.
+#Returns [the new TRACKLIST items, paths with no genre].
+def matchPaths(paths):
+  #Get the genre for every path in one go
+  genres = lookupGenres([getTrackName(fpath) for fpath in paths])
 
-    elif META:
-      #using tracks.csv (Modified from Joseph Kotva's Code)
-      print 'Using tracks.csv for genre matching. Warning: Slower than using tracks.txt'
-      print 'Please wait.. Searching csv is slow....'
-      if VERBOSE:
-        print 'I\'ll make you a tracks.txt file after we search the csv file this one time.'
-        print 'That way we can use it when making the images.'
-      #Loop META data
-      p = 0
-      f = len(PATHLIST)
-      #We will iterate csv data only one time.
-      for row in META:
-        #Loop PATHLIST
-        for fpath in PATHLIST:
-          #Split up the path string and get 
-          #the file name and extension
-          tmp = fpath.split('/')
-          tmp2 = str(tmp[-1]).split('.')
-          fullFileName = tmp[-1] # filename.mp3
-          fileName = str(int(tmp2[0]))# filename
-          fileExt = tmp2[1] # .mp3/.png
-          #Does this track name match the current csv row?
-          if fileName == row[0]:
-            if row[32] == 'small' or row[32] == 'medium':
-              #ensure proper formatting for dirName for the genre
-              genre = str(row[40]).replace(' ', '').replace('/', '-').replace(',', '-')
-              if VERBOSE:
-                print 'Match Found['+ genre +']: '+ fpath
-
-              doDirs(genre) #Create genre directories
-              #add trackPath and genre as tuple to TRACKLIST
-              TRACKLIST.append([fpath, genre])
-              PATHLIST.remove(fpath) #more Speed SCOTTY!!
-              break #cur meta row matched move on, more Speed SCOTTY!!
-        #END PATHLIST Loop
-
-        #Keep our user company while they wait...lol
-        if not VERBOSE:
-          if p == int(.99*f):
-            print 'Looks..like..we-made-it!!!!!..!!!!...: 99%'
-            print 'Still trying to find:'
-            print PATHLIST
-          elif p == int(.98*f):
-            print 'And..............: 98%'
-          elif p == int(.94*f):
-            print 'Hey! Don\'t touch that... focus man!!: 94%'
-          elif p == int(.86*f):
-            print '\nStop it!\n'
-          elif p == int(.83*f):
-            print 'No no no, I said... ^, so forget it right now. 83%'
-          elif p == int(.75*f):
-            print 'I change my mind, let\'s not imagine it. 75%'
-          elif p == int(.70*f):
-            print 'Imagine how long creating images would take if you'
-            print 'had to loop the csv file for every image...: 70%'
-          elif p == int(f/2):
-            print 'Keep calm, it\'s almost over now!'
-            print 'The speed will be much faster after this. 50%'
-          elif p == int(.25*f):
-            print 'We have to do this to get accurate genre matches for our files...sorry: 25%.'
-        p += 1
-        
-        #Did we find them all?  
-        if len(PATHLIST) == 0:
-          break #I've given her all she's got captain!!
-      #End META Loop
-      if VERBOSE:
-        print '\npheww(cough)!'
-        print 'Glad we won\'t have to do that again...'
-        print 'Wait, you are not planning on using more data than this are you?'
-        print 'Sigh... moving on..\n'
+  matched = []
+  missing = [] #paths with no genre in tracks.csv
+  for fpath, genre in zip(paths, genres):
+    if genre == None:
+      missing.append(fpath)
+      continue
+    if VERBOSE:
+      print 'File: '+ fpath.split('/')[-1] +', Genre: '+ genre
+
+    #Create genre directories (and or dataset dirs)
+    #If they don't already exist
+    doDirs(genre)
+
+    #add trackPath and genre as tuple to TRACKLIST
+    matched.append([fpath, genre])
+  #END paths Loop
+  TRACKLIST.extend(matched)
+  return [matched, missing]
+#END matchPaths Function
+
+
+#Searches dirPath and yields [trackPath, genre] for each track
+#to create while the search is still going, so the workers start
+#on the first tracks right away. Files are matched a few at a
+#time, tracks of other shards (or, with RETRYFAILED, without
+#failed images) are left out. PATHLIST and TRACKLIST are filled
+#as it goes.
+def streamTracks(dirPath, chunk=64):
+  missing = []
+  paths = []
+  for fpath in searchFiles(dirPath):
+    PATHLIST.append(fpath)
+    paths.append(fpath)
+    if len(paths) < chunk:
+      continue
+    for trackL in streamChunk(paths, missing):
+      yield trackL
+    paths = []
+  for trackL in streamChunk(paths, missing):
+    yield trackL
+
+  print 'Found '+ str(len(PATHLIST)) +' Files, '+ str(len(TRACKLIST)) +' tracks to create'
+  if missing:
+    print 'Unable to find a genre for '+ str(len(missing)) +' files:'
+    print missing
+#END streamTracks Function
+
+
+#Matches a chunk of streamed paths, returns the tracks wanted
+def streamChunk(paths, missing):
+  if GINDEX == None or not paths:
+    return []
+  matched, noGenre = matchPaths(paths)
+  missing.extend(noGenre)
+  wanted = [trackL for trackL in matched if wantTrack(trackL)]
+  if len(wanted) < len(matched):
+    del TRACKLIST[len(TRACKLIST) - len(matched):]
+    TRACKLIST.extend(wanted)
+  return wanted
+#END streamChunk Function
+
+
+#True if this run should create the track: it's in this node's
+#shard and (with RETRYFAILED) it has failed images
+def wantTrack(trackL):
+  trackName = getTrackName(trackL[0])
+  if SHARDCOUNT > 1 and trackShard(trackName, SHARDCOUNT) != SHARDINDEX:
+    return False
+  return not RETRYFAILED or trackName in FAILEDTRACKS
+#END wantTrack Function
+
+
+############
+# SHARDING #
+############
+#Returns the shard (0 to count-1) a track belongs to. The track
+#id is hashed (md5, not python's hash()) so every node agrees on
+#the split no matter the file order or python version.
+def trackShard(trackName, count):
+  return int(hashlib.md5(trackName).hexdigest()[:8], 16) % count
+#END trackShard Function
+
+
+#Keeps only the tracks of this node's shard in TRACKLIST
+def shardTracks():
+  global TRACKLIST
+  total = len(TRACKLIST)
+  TRACKLIST = [trackL for trackL in TRACKLIST
+               if trackShard(getTrackName(trackL[0]), SHARDCOUNT) == SHARDINDEX]
+  print 'Shard '+ str(SHARDINDEX) +' of '+ str(SHARDCOUNT) +': '+ str(len(TRACKLIST)) +' of '+ str(total) +' tracks'
+  return True
+#END shardTracks Function
+
+
+#Path of a shard's manifest
+def manifestPath(index, count):
+  return os.path.join(MANIFEST_DIR, 'shard-%03d-of-%03d.csv' % (index, count))
+#END manifestPath Function
+
+
+#Writes this shard's manifest, one row per track in TRACKLIST
+#[track, path, genre, status], status is 'done' or 'failed' from
+#status (trackPath -> True/False) or 'pending' if not in it yet.
+def writeManifest(status):
+  if not os.path.isdir(MANIFEST_DIR):
+    os.mkdir(MANIFEST_DIR)
+  savePath = manifestPath(SHARDINDEX, SHARDCOUNT)
+  tmpPath = savePath +'.tmp'
+  with open(tmpPath, 'wb') as mfile:
+    writer = csv.writer(mfile)
+    writer.writerow(['track', 'path', 'genre', 'status'])
+    for fpath, genre in TRACKLIST:
+      if fpath not in status:
+        state = 'pending'
+      else:
+        state = 'done' if status[fpath] else 'failed'
+      writer.writerow([getTrackName(fpath), fpath, genre, state])
+  os.rename(tmpPath, savePath) #never leave a half written manifest
+  return savePath
+#END writeManifest Function
+
+
+#Combines the shard manifests into MANIFEST_DIR/merged.csv and
+#reports missing shards, tracks no shard finished (missing or
+#still pending) and failed tracks. TRACKLIST must hold every
+#matched track (the whole collection, not one shard).
+def mergeManifests():
+  rows = {}  #track -> [track, path, genre, status]
+  missingShards = []
+  for index in range(SHARDCOUNT):
+    mpath = manifestPath(index, SHARDCOUNT)
+    if not os.path.isfile(mpath):
+      missingShards.append(index)
+      continue
+    with open(mpath, 'rb') as mfile:
+      reader = csv.reader(mfile)
+      next(reader) #header
+      for row in reader:
+        rows[row[0]] = row
+
+  merged = []
+  missing = []
+  failed = []
+  for fpath, genre in TRACKLIST:
+    trackName = getTrackName(fpath)
+    row = rows.get(trackName, [trackName, fpath, genre, 'missing'])
+    if row[3] == 'failed':
+      failed.append(row)
+    elif row[3] != 'done':
+      missing.append(row)
+    merged.append(row)
+
+  if not os.path.isdir(MANIFEST_DIR):
+    os.mkdir(MANIFEST_DIR)
+  with open(os.path.join(MANIFEST_DIR, 'merged.csv'), 'wb') as mfile:
+    writer = csv.writer(mfile)
+    writer.writerow(['track', 'path', 'genre', 'status'])
+    writer.writerows(merged)
+
+  print 'Merged '+ str(SHARDCOUNT - len(missingShards)) +' of '+ str(SHARDCOUNT) +' shard manifests, '+ str(len(merged)) +' tracks'
+  print '  done: '+ str(len(merged) - len(missing) - len(failed))
+  if missingShards:
+    print '  missing shards: '+ ', '.join(map(str, missingShards))
+  print '  missing: '+ str(len(missing))
+  for row in missing:
+    print '    '+ row[0] +' (shard '+ str(trackShard(row[0], SHARDCOUNT)) +', '+ row[3] +'): '+ row[1]
+  print '  failed: '+ str(len(failed))
+  for row in failed:
+    print '    '+ row[0] +' (shard '+ str(trackShard(row[0], SHARDCOUNT)) +'): '+ row[1]
+  return not (missing or failed)
+#END mergeManifests Function
 
-      #Next time we'll be ready fer em!!
-      if VERBOSE:
-        print 'Creating tracks.txt file to speed up future runs with this set.'
-      #Create new tracks list (tracks.txt)
-      tracksFile = open('tracks.txt', 'a')
-      for fpath, genre in TRACKLIST:
-        #Split up the path string and get 
-        #the file name and extension
-        tmp = fpath.split('/')
-        tmp2 = str(tmp[-1]).split('.')
-        fullFileName = tmp[-1] # filename.mp3
-        fileName = str(int(tmp2[0])) # filename
-        fileExt = tmp2[1]       # .mp3/.png
-        print >> tracksFile, fileName, genre
-      #End loop
-      tracksFile.close()
+
+#######################
+# RENDER SPECTROGRAMS #
+#######################
+COLORLUTS = {}  #Colormap lookup tables (256x3 uint8) by name
+
+#Returns the 256 entry RGB lookup table of a matplotlib colormap
+#(built once per process, then reused for every image)
+def getColorLUT(name):
+  if not name in COLORLUTS:
+    cmap = plt.get_cmap(name)
+    COLORLUTS[name] = cmap(np.arange(cmap.N), bytes=True)[:, :3]
+  return COLORLUTS[name]
+#END getColorLUT Function
+
+
+#Turns a log-mel matrix into a (height, width, 3) uint8 image
+#the same way specshow would draw it: magma colormap if the data
+#is one sign, coolwarm if not, scaled from its min to its max,
+#low frequencies at the bottom.
+def specToPixels(logMel, width, height):
+  #Pick the colormap like librosa.display.cmap (robust=True)
+  finite = logMel[np.isfinite(logMel)]
+  if np.percentile(finite, 2) >= 0 or np.percentile(finite, 98) <= 0:
+    lut = getColorLUT('magma')
+  else:
+    lut = getColorLUT('coolwarm')
+
+  #Scale into colormap indices (matches matplotlib's Normalize)
+  low, high = finite.min(), finite.max()
+  scale = len(lut) / float(high - low) if high > low else 0.0
+  codes = (logMel - low) * scale
+  codes = np.clip(codes, 0, len(lut) - 1, out=codes).astype(np.uint8)
+
+  #Resize by picking the nearest source cell for each pixel
+  rows = ((np.arange(height) + 0.5) * codes.shape[0] / height).astype(np.intp)
+  cols = ((np.arange(width) + 0.5) * codes.shape[1] / width).astype(np.intp)
+  codes = codes[rows[::-1]][:, cols] #flip so row 0 is the top
+  return lut[codes]
+#END specToPixels Function
+
+
+#Writes a uint8 (height, width, 3) RGB, (height, width, 4) RGBA
+#or (height, width) gray pixel array as a PNG file.
+def writePNG(savePath, pixels, level=6):
+  height, width = pixels.shape[:2]
+  colorType = 0 if pixels.ndim == 2 else {3: 2, 4: 6}[pixels.shape[2]] #gray, RGB, RGBA
+
+  #Each row starts with its filter type (0 = none)
+  raw = np.zeros((height, 1 + pixels[0].size), dtype=np.uint8)
+  raw[:, 1:] = pixels.reshape(height, -1)
+
+  def chunk(tag, data):
+    return (struct.pack('>I', len(data)) + tag + data +
+            struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+  with open(savePath, 'wb') as f:
+    f.write('\x89PNG\r\n\x1a\n')
+    f.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, colorType, 0, 0, 0)))
+    f.write(chunk('IDAT', zlib.compress(raw.tostring(), level)))
+    f.write(chunk('IEND', ''))
+  return True
+#END writePNG Function
+
+
+#Saves a log-mel matrix as a spectrogram image
+#using the renderer chosen by RENDER.
+def saveSpect(log_mel, sr, savePath):
+  if FEATURES:
+    #The dB values themselves, float16 is ~0.03 dB at -60 dB
+    features = log_mel.astype(np.float16)
+    with open(tempPath(savePath), 'wb') as f:
+      np.save(f, features)
+    os.rename(tempPath(savePath), savePath)
+    return True
+
+  if RENDER == 'lut' or RAWNPY:
+    pixels = specToPixels(log_mel, IMGSIZE[0], IMGSIZE[1])
+    if RAWNPY:
+      with open(tempPath(savePath), 'wb') as f:
+        np.save(f, pixels)
     else:
-      #Skip or read from .mp3 file..
-      print 'No genre data, skipping...'
-        
+      writePNG(tempPath(savePath), pixels, PNGLEVEL)
+    os.rename(tempPath(savePath), savePath)
+    return True
+
+  #Create the spectrogram image
+  librosa.display.specshow(log_mel, sr=sr, hop_length=512)
+  plt.axis("normal") #axis limits auto scaled to make image sit well in plot box.
+  plt.margins(0,0) #remove margins
+  plt.gca().xaxis.set_major_locator(plt.NullLocator()) #remove x axis locator
+  plt.gca().yaxis.set_major_locator(plt.NullLocator()) #remove y axis locator
+
+  #Save the plotted figure (image) using "SortedVersion" dir structure
+  #the image can/will be copied later into a "DataVersion" dir set.
+  plt.savefig(tempPath(savePath), format='png', dpi=100, frameon='false', bbox_inches="tight", pad_inches=0.0)
+  plt.clf()#Clear the current figure (possibly helps with speed)
+  os.rename(tempPath(savePath), savePath)
   return True
-#END matchTracks Function
+#END saveSpect Function
+
+
+###############
+# AUDIO CACHE #
+###############
+#Decoded audio is kept as one float32 .npy file per track
+#(and mono/stereo, sample rate) in CACHEDIR/<xx>/<key>.npy
+#The key includes the file's size and modified time, so
+#changed audio files are decoded again. A file's modified
+#time is bumped each time it's used (for LRU pruning).
+CACHESAVES = 0 #Saves since the cache was last pruned (per process)
+
+#Returns the cache file path for an audio file
+def cachePath(fpath, sr, mono):
+  info = os.stat(fpath)
+  key = '|'.join([os.path.abspath(fpath), str(info.st_size), repr(info.st_mtime), str(sr), str(mono)])
+  key = hashlib.sha1(key).hexdigest()
+  return CACHEDIR +'/'+ key[:2] +'/'+ key +'.npy'
+#END cachePath Function
+
+
+#Returns the cached [data, sr] (memory-mapped) or None
+def cacheLoad(fpath, sr, mono):
+  try:
+    savePath = cachePath(fpath, sr, mono)
+    data = np.load(savePath, mmap_mode='r')
+    os.utime(savePath, None) #recently used
+  except (IOError, OSError, ValueError):
+    return None #Not cached (or broken)
+  return [data, sr]
+#END cacheLoad Function
+
+
+#Saves decoded audio to the cache
+def cacheSave(fpath, sr, mono, data):
+  global CACHESAVES
+  savePath = cachePath(fpath, sr, mono)
+  try:
+    if not os.path.isdir(os.path.dirname(savePath)):
+      os.makedirs(os.path.dirname(savePath))
+  except OSError:
+    pass #Another worker made it
+  #Write then rename, so a half written file is never used
+  tmpPath = savePath +'.'+ str(os.getpid()) +'.tmp'
+  try:
+    with open(tmpPath, 'wb') as f:
+      np.save(f, np.asarray(data, dtype=np.float32))
+    os.rename(tmpPath, savePath)
+  except (IOError, OSError):
+    print 'Unable to cache audio for: '+ fpath
+    if os.path.exists(tmpPath):
+      os.remove(tmpPath)
+    return False
+
+  #Keep the cache under its size cap now and then
+  CACHESAVES += 1
+  if CACHESIZE and CACHESAVES >= 100:
+    CACHESAVES = 0
+    pruneCache(CACHESIZE)
+  return True
+#END cacheSave Function
+
+
+#Lists the cache files as [lastUsed, size, path], oldest first
+def cacheFiles():
+  files = []
+  for root, dirs, names in os.walk(CACHEDIR):
+    for name in names:
+      if name.endswith('.npy') or name.endswith('.tmp'):
+        try:
+          info = os.stat(root +'/'+ name)
+        except OSError:
+          continue #Removed by another worker
+        files.append([info.st_mtime, info.st_size, root +'/'+ name])
+  files.sort()
+  return files
+#END cacheFiles Function
+
+
+#Removes least recently used cache files until the
+#cache is no bigger than maxBytes. Returns bytes freed.
+def pruneCache(maxBytes):
+  files = cacheFiles()
+  total = sum(f[1] for f in files)
+  freed = 0
+  for lastUsed, size, filePath in files:
+    if total - freed <= maxBytes:
+      break
+    if filePath.endswith('.tmp') and time.time() - lastUsed < 3600:
+      continue #Still being written
+    try:
+      os.remove(filePath)
+      freed += size
+    except OSError:
+      pass #Already gone
+  return freed
+#END pruneCache Function
+
+
+#Prints what's in the audio cache ('info') or
+#prunes it to CACHESIZE ('prune')
+def cacheCommand(command):
+  if not os.path.isdir(CACHEDIR):
+    print 'No audio cache at: '+ CACHEDIR
+    return False
+  if command == 'prune':
+    if not CACHESIZE:
+      print 'Give the size to prune the cache to, ex: --cache-size=20G'
+      return False
+    freed = pruneCache(CACHESIZE)
+    print 'Removed %.1f MB from the audio cache.' % (freed / 1e6)
+
+  files = cacheFiles()
+  total = sum(f[1] for f in files)
+  print 'Audio cache: '+ CACHEDIR
+  print '  Tracks: '+ str(len([f for f in files if f[2].endswith('.npy')]))
+  print '  Size:   %.1f MB' % (total / 1e6)
+  if CACHESIZE:
+    print '  Cap:    %.1f MB' % (CACHESIZE / 1e6)
+  if files:
+    print '  Least recently used:  '+ time.ctime(files[0][0])
+    print '  Most recently used:   '+ time.ctime(files[-1][0])
+  return True
+#END cacheCommand Function
+
+
+#Reads a size like 500M or 20G as bytes
+def parseSize(text):
+  units = {'k': 1e3, 'm': 1e6, 'g': 1e9, 't': 1e12}
+  text = text.strip().lower().rstrip('b')
+  if text and text[-1] in units:
+    return int(float(text[:-1]) * units[text[-1]])
+  return int(text)
+#END parseSize Function
+
+
+###############
+# JOB JOURNAL #
+###############
+#A SQLite table with a row per image: its track, status ('done' or
+#'failed'), a hash of the settings it was made with and the error.
+#The main process reads it once (loadJournal) before the workers
+#start, then images are skipped without touching the file system.
+#Workers collect their results in JOURNALOUT, the main process
+#writes them (one writer, see runStage). Images are saved to a
+#temp file and renamed, so a killed run never leaves a half
+#written image behind.
+
+#Opens the journal (made if new)
+def openJournal():
+  db = sqlite3.connect(JOURNALFILE, timeout=60)
+  db.execute('''CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY, track TEXT, status TEXT,
+    params TEXT, error TEXT, time REAL)''')
+  return db
+#END openJournal Function
+
+
+#Reads the whole journal into JOURNAL (one query).
+#With RETRYFAILED, TRACKLIST is cut down to the tracks
+#that have failed images.
+def loadJournal():
+  global JOURNAL, TRACKLIST, FAILEDTRACKS
+  if JOURNALFILE == None:
+    return False
+  db = openJournal()
+  JOURNAL = {}
+  failedTracks = FAILEDTRACKS = set()
+  for path, track, status, params in db.execute('SELECT path, track, status, params FROM images'):
+    JOURNAL[str(path)] = [str(status), str(params)]
+    if status == 'failed':
+      failedTracks.add(str(track))
+  db.close()
+
+  done = sum(1 for entry in JOURNAL.values() if entry[0] == 'done')
+  print 'Journal '+ JOURNALFILE +': '+ str(done) +' images done, '+ str(len(failedTracks)) +' tracks failed'
+  if RETRYFAILED:
+    TRACKLIST = [trackL for trackL in TRACKLIST if getTrackName(trackL[0]) in failedTracks]
+    print 'Retrying the failed tracks only'
+  elif failedTracks:
+    print '(failed images are made again, --retry-failed makes only those)'
+  return True
+#END loadJournal Function
+
+
+#Returns a short hash of the settings an image is made with,
+#kind is 'spect' (config [n_fft, hop_length, n_mels]) or 'audmage'
+def imageParams(kind, config=None):
+  params = [kind, config]
+  if kind == 'spect':
+    params += [RENDER, RAWNPY]
+    if FEATURES:
+      params.append('features')
+    elif RENDER == 'lut' or RAWNPY:
+      params.append(IMGSIZE)
+    if STFTBLOCK and MAXFRAMES:
+      params.append(['frames', MAXFRAMES])
+  elif kind == 'audmage':
+    params.append('exact') #L x W without the old + 2 padding
+  return hashlib.md5(repr(params)).hexdigest()[:12]
+#END imageParams Function
+
+
+#True if an image can be skipped: it's in the journal as done
+#with the same settings. Failed images are made again.
+#Images the journal doesn't have are skipped if the file exists
+#(made before there was a journal), and recorded as done.
+def skipImage(savePath, params):
+  if JOURNALFILE == None:
+    return os.path.exists(savePath)
+  entry = JOURNAL.get(savePath)
+  if entry == None:
+    if os.path.exists(savePath):
+      journalImage(savePath, params, 'done')
+      return True
+    return False
+  if entry[0] == 'failed':
+    return False #try it again
+  return entry[1] == params #made with other settings, redo it
+#END skipImage Function
+
+
+#Records an image result, kept until the worker hands it back
+def journalImage(savePath, params, status, error=None):
+  if JOURNALFILE != None:
+    track = getTrackName(savePath)
+    with JOURNALLOCK:
+      JOURNALOUT.append([savePath, track, status, params, error, time.time()])
+  return True
+#END journalImage Function
+
+
+#Returns (and forgets) the image results recorded by this worker
+def takeJournal():
+  with JOURNALLOCK:
+    entries = JOURNALOUT[:]
+    del JOURNALOUT[:]
+  return entries
+#END takeJournal Function
+
+
+#Writes image results to the journal
+def writeJournal(entries, db=None):
+  if JOURNALFILE == None or not entries:
+    return False
+  mydb = db if db != None else openJournal()
+  with mydb:
+    mydb.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)', entries)
+  if db == None:
+    mydb.close()
+  return True
+#END writeJournal Function
+
+
+#Returns a temp path next to savePath, images are written
+#there then renamed into place (see saveImage)
+def tempPath(savePath):
+  return savePath +'.'+ str(os.getpid()) +'.tmp'
+#END tempPath Function
+
+
+##############
+# LOAD AUDIO #
+##############
+#Loads an audio file using librosa (or the audio cache).
+#Returns [data, sr] or None if it couldn't be loaded.
+def loadAudio(fpath, mono=True, sr=22050):
+  if CACHEDIR != None:
+    audio = cacheLoad(fpath, sr, mono)
+    if audio != None:
+      return audio
+
+  try:
+    data, sr = librosa.load(fpath, sr=sr, mono=mono)
+  except Exception as e:
+    #IOError, or the decoder's errors for broken files
+    print 'Unable to load: ' + fpath + ' '+ repr(e) +'\nSkipping...'
+    return None
+
+  #Was the audio file somehow loaded yet has no data points?
+  if data.size == 0:
+    print 'Unable to load: '+ fpath +'\nFile was opened but there was no data! Corrupted?\nSkipping...'
+    return None
+
+  if CACHEDIR != None:
+    cacheSave(fpath, sr, mono, data)
+  return [data, sr]
+#END loadAudio Function
 
 
 #######################
 # CREATE SPECTROGRAMS #
 #######################
+#Makes a spectrogram from loaded (mono) audio data
+#and saves it to savePath.
+def makeSpect(data, sr, savePath, n_fft=2048, hop_length=512, n_mels=128):
+  #Some calculations on the audio sample points
+  stft = np.abs(librosa.stft(data, n_fft=n_fft, hop_length=hop_length))
+  mel = librosa.feature.melspectrogram(sr=sr, S=stft**2, n_mels=n_mels)
+  log_mel = librosa.logamplitude(mel)
+  return saveSpect(log_mel, sr, savePath)
+#END makeSpect Function
+
+
+########################
+# BATCHED SPECTROGRAMS #
+########################
+MELBASES = {} #Cached [window, mel filterbank] by (sr, n_fft, n_mels)
+
+#Returns the STFT window and mel filterbank for these
+#settings (made once per process, then reused)
+def getMelBasis(sr, n_fft, n_mels):
+  key = (sr, n_fft, n_mels)
+  if not key in MELBASES:
+    window = librosa.filters.get_window('hann', n_fft, fftbins=True)
+    melBasis = librosa.filters.mel(sr, n_fft, n_mels=n_mels)
+    MELBASES[key] = [window.astype(np.float32), melBasis.T.astype(np.float32)]
+  return MELBASES[key]
+#END getMelBasis Function
+
+
+#Computes the log-mel matrix of every clip in a (tracks, samples)
+#array at once: the STFT magnitude, mel projection and dB
+#conversion are each one numpy operation for the whole batch.
+#Gives the same result as makeSpect's librosa calls per clip
+#(to float32 rounding, well under 0.001 dB).
+#Returns a (tracks, n_mels, frames) float32 array.
+def batchLogMel(clips, sr, n_fft=2048, hop_length=512, n_mels=128):
+  window, melBasis = getMelBasis(sr, n_fft, n_mels)
+  clips = np.asarray(clips, dtype=np.float32)
+
+  #Centered frames (like librosa.stft), as a view of the padded clips
+  padded = np.pad(clips, ((0, 0), (n_fft // 2, n_fft // 2)), mode='reflect')
+  frameCount = 1 + (padded.shape[1] - n_fft) // hop_length
+  frames = as_strided(padded, shape=(padded.shape[0], frameCount, n_fft),
+                      strides=(padded.strides[0], padded.strides[1] * hop_length, padded.strides[1]))
+
+  mel = melPower(frames, window, melBasis).transpose(0, 2, 1)
+
+  #Power to dB (librosa.logamplitude, top_db=80 of each clip's peak)
+  logMel = np.maximum(mel, 1e-10)
+  np.log10(logMel, out=logMel)
+  logMel *= 10.0
+  peaks = logMel.reshape(len(logMel), -1).max(axis=1)
+  return np.maximum(logMel, (peaks - 80.0).reshape(-1, 1, 1).astype(np.float32))
+#END batchLogMel Function
+
+
+#The mel power of STFT frames (..., n_fft), returns (..., n_mels)
+#float32. fftpack's real FFT works in float32 (about twice as
+#fast) and packs its output as [r0, r1, i1, r2, i2, ...]
+def melPower(frames, window, melBasis):
+  n_fft = frames.shape[-1]
+  spec = fftpack.rfft(frames * window, axis=-1)
+  np.square(spec, out=spec)
+  power = np.empty(spec.shape[:-1] + (n_fft // 2 + 1,), dtype=np.float32)
+  power[..., 0] = spec[..., 0]
+  if n_fft % 2 == 0:
+    np.add(spec[..., 1:-1:2], spec[..., 2:-1:2], out=power[..., 1:-1])
+    power[..., -1] = spec[..., -1]
+  else:
+    np.add(spec[..., 1::2], spec[..., 2::2], out=power[..., 1:])
+  del spec
+
+  #Mel projection, one (frames, bins) x (bins, n_mels) product
+  mel = np.dot(power.reshape(-1, power.shape[-1]), melBasis)
+  return mel.reshape(power.shape[:-1] + (-1,))
+#END melPower Function
+
+
+#########################
+# STREAMED SPECTROGRAMS #
+#########################
+#Long tracks (fma_full) don't fit in a worker's memory as one
+#buffer: they're decoded STFTBLOCK seconds at a time, mixed to
+#mono and resampled like librosa.load, and each block's frames go
+#through the STFT and mel filterbank, only the mel frames are kept
+#(or their averages, MAXFRAMES). The frames at a block's edges see
+#the same samples as in one buffer, so the log-mel is makeSpect's
+#(to float32 rounding) however the track is cut into blocks. Only
+#rates that don't divide evenly into 22050 (48kHz) differ, by about
+#0.001 dB: resampy adds up its time step over the whole buffer and
+#lands a rounding error off some input samples, a block doesn't.
+
+#Yields a decoded file's mono samples (float32, like librosa.load
+#before resampling) in blocks of about blockSize samples
+def decodeBlocks(audioFile, blockSize):
+  channels = audioFile.channels
+  blocks = []
+  count = 0
+  carry = np.zeros(0, dtype=np.float32) #samples of an unfinished frame
+  with audioFile:
+    for buf in audioFile:
+      samples = np.concatenate([carry, librosa.util.buf_to_float(buf, dtype=np.float32)])
+      whole = len(samples) // channels * channels
+      carry = samples[whole:]
+      blocks.append(samples[:whole])
+      count += whole // channels
+      if count >= blockSize:
+        yield monoBlock(np.concatenate(blocks), channels)
+        blocks = []
+        count = 0
+  if blocks:
+    yield monoBlock(np.concatenate(blocks), channels)
+#END decodeBlocks Function
+
+
+#Interleaved samples to mono, like librosa.load (to_mono)
+def monoBlock(samples, channels):
+  if channels == 1:
+    return samples
+  return librosa.to_mono(samples.reshape((-1, channels)).T)
+#END monoBlock Function
+
+
+#Resamples blocks of samples from srIn to srOut with resampy's
+#kaiser_best filter (librosa.load's), yields the new blocks. Each
+#block is resampled with the filter's reach of the samples before
+#it, starting on a sample where the two rates line up, so every
+#output sample is the one resampling the whole track would give.
+def resampleBlocks(blocks, srIn, srOut):
+  if srIn == srOut:
+    for block in blocks:
+      yield block
+    return
+  ratio = float(srOut) / srIn
+  inStep = srIn // gcd(srIn, srOut) #input samples on the output grid
+  window, precision, rolloff = resampy.filters.get_filter('kaiser_best')
+  reach = len(window) // int(min(1.0, ratio) * precision) + 2 #filter wing (input samples)
+  buf = np.zeros(0, dtype=np.float32)
+  bufStart = 0 #input sample buf[0] is (on the output grid)
+  outNext = 0  #next output sample to yield
+  total = 0
+  for block in blocks:
+    total += len(block)
+    buf = np.concatenate([buf, block])
+    outEnd = int((bufStart + len(buf) - reach) * ratio) #its whole filter is in buf
+    if outEnd <= outNext:
+      continue
+    first = bufStart * srOut // srIn
+    yield resampy.resample(buf, srIn, srOut, filter='kaiser_best')[outNext - first:outEnd - first]
+    outNext = outEnd
+    keep = max(bufStart, (int(outNext / ratio) - reach) // inStep * inStep)
+    buf = buf[keep - bufStart:].copy()
+    bufStart = keep
+
+  #The rest, then librosa's fix_length to ceil(samples * ratio)
+  outEnd = int(total * ratio)
+  if outEnd > outNext:
+    first = bufStart * srOut // srIn
+    yield resampy.resample(buf, srIn, srOut, filter='kaiser_best')[outNext - first:outEnd - first]
+  padding = int(np.ceil(total * ratio)) - max(outEnd, outNext)
+  if padding > 0:
+    yield np.zeros(padding, dtype=np.float32)
+#END resampleBlocks Function
+
+
+#Opens a track for streaming at sr, returns [duration in seconds,
+#generator of mono float32 blocks of about STFTBLOCK seconds] or
+#None if it can't be opened. A cached decode (CACHEDIR) is read
+#from its memory map, anything else is decoded as it goes.
+def openAudioStream(fpath, sr=22050):
+  blockSize = int(max(STFTBLOCK, 1) * sr)
+  if CACHEDIR != None:
+    cached = cacheLoad(fpath, sr, True)
+    if cached != None:
+      data = cached[0]
+      return [len(data) / float(sr), (np.array(data[i:i + blockSize]) for i in range(0, len(data), blockSize))]
+  try:
+    audioFile = audioread.audio_open(os.path.realpath(fpath))
+  except Exception as e:
+    #IOError, or the decoder's errors for broken files
+    print 'Unable to load: ' + fpath + ' '+ repr(e) +'\nSkipping...'
+    return None
+  blocks = decodeBlocks(audioFile, int(max(STFTBLOCK, 1) * audioFile.samplerate))
+  return [audioFile.duration, resampleBlocks(blocks, audioFile.samplerate, sr)]
+#END openAudioStream Function
+
+
+#Starts a streamed spectrogram of config [n_fft, hop_length, n_mels],
+#its frames averaged in groups so there are at most maxFrames of
+#a track this long (0 = every frame). Returns its state (a dict)
+#for feedStft and finishStft.
+def startStft(config, sr, duration=0, maxFrames=0):
+  n_fft, hop_length, n_mels = config
+  window, melBasis = getMelBasis(sr, n_fft, n_mels)
+  group = 1
+  if maxFrames and duration:
+    frames = 1 + int(duration * sr) // hop_length
+    group = max(1, -(-frames // maxFrames))
+  return {'n_fft': n_fft, 'hop': hop_length, 'window': window, 'melBasis': melBasis,
+          'group': group, 'head': [], 'pending': None, 'carry': None, 'mels': []}
+#END startStft Function
+
+
+#Adds a block of samples to a streamed spectrogram: every frame
+#that is all there goes through the STFT and mel filterbank, the
+#samples of the frames still to come are kept (under n_fft).
+def feedStft(state, block, last=False):
+  n_fft, hop = state['n_fft'], state['hop']
+  if state['pending'] is None:
+    #Centered frames (like librosa.stft): the track starts with
+    #its first samples reflected, wait until there are enough
+    state['head'].append(block)
+    if sum(len(b) for b in state['head']) < n_fft and not last:
+      return state
+    samples = np.concatenate(state['head'])
+    if len(samples) < n_fft:
+      raise ValueError('too short: '+ str(len(samples)) +' samples')
+    block = np.concatenate([samples[n_fft // 2:0:-1], samples])
+    state['head'] = None
+    state['pending'] = np.zeros(0, dtype=np.float32)
+
+  samples = np.concatenate([state['pending'], block])
+  if last:
+    samples = np.concatenate([samples, samples[-2:-n_fft // 2 - 2:-1]]) #reflected end
+  frameCount = 1 + (len(samples) - n_fft) // hop if len(samples) >= n_fft else 0
+  if frameCount:
+    frames = as_strided(samples, shape=(frameCount, n_fft),
+                        strides=(samples.strides[0] * hop, samples.strides[0]))
+    addMelFrames(state, melPower(frames, state['window'], state['melBasis']), last)
+  state['pending'] = samples[frameCount * hop:].copy()
+  return state
+#END feedStft Function
+
+
+#Keeps mel frames (frames x n_mels) of a streamed spectrogram,
+#averaged in groups of state['group'] (the last group may be short)
+def addMelFrames(state, mel, last=False):
+  group = state['group']
+  if group > 1:
+    if state['carry'] is not None:
+      mel = np.concatenate([state['carry'], mel])
+    whole = len(mel) // group * group
+    state['carry'] = mel[whole:]
+    if whole:
+      state['mels'].append(mel[:whole].reshape(-1, group, mel.shape[1]).mean(axis=1))
+    if last and len(state['carry']):
+      state['mels'].append(state['carry'].mean(axis=0, keepdims=True))
+  else:
+    state['mels'].append(mel)
+  return state
+#END addMelFrames Function
+
+
+#Finishes a streamed spectrogram, returns its log-mel matrix
+#(n_mels, frames) float32 like batchLogMel's
+def finishStft(state):
+  if state['pending'] is None or len(state['pending']):
+    feedStft(state, np.zeros(0, dtype=np.float32), last=True)
+  mel = np.concatenate(state['mels']).T
+
+  #Power to dB (librosa.logamplitude, top_db=80 of the peak)
+  logMel = np.maximum(mel, 1e-10)
+  np.log10(logMel, out=logMel)
+  logMel *= 10.0
+  return np.maximum(logMel, np.float32(logMel.max() - 80.0))
+#END finishStft Function
+
+
+#Streams a track once for every spectrogram config given
+#([n_fft, hop_length, n_mels]), returns their log-mel matrices
+#or None if it can't be loaded. Memory is a few blocks and the
+#mel frames (MAXFRAMES caps those), not the track.
+def streamLogMels(fpath, configs, sr=22050):
+  stream = openAudioStream(fpath, sr)
+  if stream == None:
+    return None
+  duration, blocks = stream
+  states = [startStft(config, sr, duration, MAXFRAMES) for config in configs]
+  for block in blocks:
+    for state in states:
+      feedStft(state, block)
+  return [finishStft(state) for state in states]
+#END streamLogMels Function
+
+
+#Makes the spectrograms for a batch of tracks (list of
+#[trackPath, genre]). Equal length clips are stacked and
+#done together by batchLogMel. Multiprocessed like doSpect.
+#Returns a list with True/False for each track.
+def doSpectBatch(batch):
+
+  results = [False] * len(batch)
+  clips = {} #clip length -> [[index, data, savePath], ...]
+  ext = '.npy' if RAWNPY or FEATURES else '.png'
+  params = imageParams('spect', [2048, 512, 128])
+  for i, trackL in enumerate(batch):
+    #Do nothing if test complete
+    if testDone():
+      break
+    fpath = str(trackL[0])#File path
+    genre = str(trackL[1])#Track Genre
+    savePath = 'sorted/spect/'+ genre +'/'+ getTrackName(fpath) + ext
+
+    #Is the spectrogram already done? Save time, skip it then
+    if skipImage(savePath, params):
+      if VERBOSE:
+        print savePath +' already done, skipping...'
+      results[i] = True
+      if not TEST:
+        countDone() #Keep counting though!
+      continue
+    if not os.path.isfile(fpath):
+      #Not an image failure (moved by the audio sort?), no journal row
+      print 'File: '+ fpath +' does not exist or is not accessible\n'
+      continue
+    if not claimTest():
+      break #test done
+
+    print 'Attempting to load: '+ fpath
+    audio = loadAudio(fpath, mono=True)
+    if audio == None:
+      journalImage(savePath, params, 'failed', 'audio load failed')
+      continue #Failure
+    data, sr = audio
+    clips.setdefault(len(data), []).append([i, data, savePath])
+
+  #Compute each group of equal length clips together
+  for length, group in clips.items():
+    if length < 2048:
+      #Too short for one frame (empty or broken audio)
+      for i, data, savePath in group:
+        print 'Unable to create: '+ savePath +' (only '+ str(length) +' samples)'
+        journalImage(savePath, params, 'failed', 'too short: '+ str(length) +' samples')
+      continue
+    logMels = batchLogMel([item[1] for item in group], sr)
+    for (i, data, savePath), log_mel in zip(group, logMels):
+      try:
+        made, error = saveSpect(log_mel, sr, savePath), 'not saved'
+      except Exception as e:
+        #Render or write failed (disk full..), record it and go on
+        print 'Unable to create: '+ savePath +' '+ repr(e)
+        made, error = False, repr(e)
+      results[i] = made
+      if made:
+        journalImage(savePath, params, 'done')
+        print 'Finished spectrogram('+ str(countDone()) +'): '+ savePath
+      else:
+        journalImage(savePath, params, 'failed', error)
+  return results
+#END doSpectBatch Function
+
+
 #This function is now multiprocessed
 #There is no longer a loop.
 def doSpect(trackL=None, saveDir=None):
 
-  #Use global S as counter for saved spects
-  global S
-
   #Do nothing if test complete
-  if S >= 5 and TEST:
+  if testDone():
     return False #Do nothing
 
   #Do we have a track path and genre?
@@ -388,64 +1611,67 @@ def doSpect(trackL=None, saveDir=None):
   fileName = str(int(tmp2[0])) # filename (minus leading zeros)
   fileExt = tmp2[1]       # .mp3/.png
 
+  #Setup the save path
+  ext = '.npy' if RAWNPY or FEATURES else '.png'
+  if saveDir == None:
+    savePath = 'sorted/spect/'+ genre +'/'+ fileName + ext
+  else:
+    savePath = saveDir +'/'+ fileName + ext
+  params = imageParams('spect', [2048, 512, 128])
+
   #Verify the file exists and is accessible
   if not os.path.isfile(fpath):
     #File doesn't exist or isn't accessible.
+    #Not an image failure (moved by the audio sort?), no journal row
     print 'File: '+ fullFileName +' does not exist or is not accessible\n'
+    return False
   else:
     #Create Spectrogram (Modified from Joseph Kotva's Code)
-    
-    #Setup the save path
-    if saveDir == None:
-      savePath = 'sorted/spect/'+ genre +'/'+ fileName + '.png'
-    else:
-      savePath = saveDir +'/'+ fileName + '.png'      
 
-    #Does the spectrogram already exist? Save time, skip it then
-    if not os.path.exists(savePath):
+    #Is the spectrogram already done? Save time, skip it then
+    if not skipImage(savePath, params):
+      if not claimTest():
+        return False #test done
+
       #Try to load the audio file using librosa
       print 'Attempting to load: '+ fpath
-      try:
-        data, sr = librosa.load(fpath, mono=True) #mono(1channel)
-      except IOError:
-        print 'Unable to load: ' + fpath + '\nSkipping...'
-        #no s increment here because we didn't make the spectrogram!
-        return False #Failure
-        #continue #restart loop at next index, skip this file
-
-      #Was the audio file somehow loaded yet has no data points?
-      if data.size == 0:
-        print 'Unable to load: '+ fpath +'\nFile was opened but there was no data! Corrupted?\nSkipping...'
-        return False #Failure
-        #continue #restart loop at next index, skip this file
-
-      #Some calculations on the audio sample points
-      stft = np.abs(librosa.stft(data, n_fft=2048, hop_length=512))
-      mel = librosa.feature.melspectrogram(sr=sr, S=stft**2)
-      log_mel = librosa.logamplitude(mel)
-    
+      if STFTBLOCK:
+        audio = None #streamed below, a block at a time
+      else:
+        audio = loadAudio(fpath, mono=True) #mono(1channel)
+        if audio == None:
+          #no s increment here because we didn't make the spectrogram!
+          journalImage(savePath, params, 'failed', 'audio load failed')
+          return False #Failure
+
       #print 'Generating Spectrogram for: '+ fpath
-      #Create the spectrogram image
-      librosa.display.specshow(log_mel, sr=sr, hop_length=512)
-      plt.axis("normal") #axis limits auto scaled to make image sit well in plot box.
-      plt.margins(0,0) #remove margins
-      plt.gca().xaxis.set_major_locator(plt.NullLocator()) #remove x axis locator
-      plt.gca().yaxis.set_major_locator(plt.NullLocator()) #remove y axis locator
-
-      #Save the plotted figure (image) using "SortedVersion" dir structure
-      #the image can/will be copied later into a "DataVersion" dir set.
-      plt.savefig(savePath, dpi=100, frameon='false', bbox_inches="tight", pad_inches=0.0)
-      plt.clf()#Clear the current figure (possibly helps with speed)
+      try:
+        if audio == None:
+          logMels = streamLogMels(fpath, [[2048, 512, 128]])
+          if logMels == None:
+            journalImage(savePath, params, 'failed', 'audio load failed')
+            return False #Failure
+          saveSpect(logMels[0], 22050, savePath)
+        else:
+          data, sr = audio
+          makeSpect(data, sr, savePath)
+      except Exception as e:
+        #Bad audio (empty, too short..), record it and go on
+        print 'Unable to create: '+ savePath +' '+ repr(e)
+        journalImage(savePath, params, 'failed', repr(e))
+        return False
+      journalImage(savePath, params, 'done')
       
-      S += 1 #Increment counter
-      print 'Finished spectrogram('+ str(S) +'): '+ savePath
-      if S == 5 and TEST:
+      done = countDone() #Increment counter
+      print 'Finished spectrogram('+ str(done) +'): '+ savePath
+      if done == 5 and TEST:
         print 'Stopping spectrograms here, spect test done!'
     else:
-      #The spectrogram already exists, skip it
-      print savePath +' already exists, skipping...'
+      #The spectrogram is already done, skip it
+      if VERBOSE or JOURNALFILE == None:
+        print savePath +' already done, skipping...'
       if not TEST:
-        S += 1 #Keep counting though!
+        countDone() #Keep counting though!
   
   return True
 #END doSpect Function
@@ -454,52 +1680,109 @@ def doSpect(trackL=None, saveDir=None):
 ################
 # REMAP VALUES #
 ################
-def remap(x, oMin, oMax, nMin, nMax):
-  #Check range
-  if oMin == oMax:
-    print 'Warning: Zero input range'
-    return x
-  if nMin == nMax:
-    print 'Warning Zero output range'
-    return x
-
-  #Check reversed input range
-  reverseInput = False
-  oldMin = min(oMin, oMax)
-  oldMax = max(oMin, oMax)
-  if not oldMin == oMin:
-    reverseInput = True
-    
-  #Check reversed output range
-  reverseOutput = False
-  newMin = min(nMin, nMax)
-  newMax = max(nMin, nMax)
-  if not newMin == nMin:
-    reverseOutput = True
-
-  portion = (x-oldMin)*(newMax-newMin)/(oldMax-oldMin)
-  if reverseInput:
-    portion = (oldMax-x)*(newMax-newMin)/(oldMax-oldMin)
-  
-  result = portion + newMin
-  if reverseOutput:
-    result = newMax - portion
-
-  return result
+#Number types of remap's fast path (exact types, quicker than isinstance)
+NUMBERS = frozenset([int, long, float] + np.sctypes['int'] + np.sctypes['uint'] + np.sctypes['float'])
+
+#Maps x (a number or an array of any shape) from the range
+#oMin..oMax to nMin..nMax, either range can be reversed
+#(oMin > oMax). One scale and one offset, applied in place in
+#out (or a new array of dtype, a float type, default x's): no
+#temporaries. For a batch of tracks, give ranges that broadcast
+#against x, ex: x (tracks, samples), oMin/oMax (tracks, 1).
+#Zero ranges are warned about and left as they are.
+def remap(x, oMin, oMax, nMin, nMax, out=None, dtype=None):
+  #Numbers: the fast path, no numpy calls
+  if (out is None and type(x) in NUMBERS and type(oMin) in NUMBERS and type(oMax) in NUMBERS
+      and type(nMin) in NUMBERS and type(nMax) in NUMBERS):
+    if oMin == oMax or nMin == nMax:
+      print 'Warning: Zero '+ ('input' if oMin == oMax else 'output') +' range'
+      return x
+    scale = (nMax - nMin) / float(oMax - oMin)
+    return x * scale + (nMin - oMin * scale)
+
+  oRange = np.subtract(oMax, oMin, dtype=np.float64)
+  nRange = np.subtract(nMax, nMin, dtype=np.float64)
+  zero = (oRange == 0) | (nRange == 0)
+  if np.any(zero):
+    print 'Warning: Zero '+ ('input' if np.any(oRange == 0) else 'output') +' range'
+    if np.ndim(zero) == 0:
+      if out is None:
+        return x
+      out[...] = x
+      return out
+  scale = nRange / np.where(zero, 1, oRange)
+  offset = nMin - oMin * scale
+  if np.ndim(zero) > 0:
+    scale = np.where(zero, 1, scale)   #those tracks stay as they are
+    offset = np.where(zero, 0, offset)
+
+  if out is None:
+    out = np.empty(np.shape(x), dtype=dtype or np.result_type(x, 1.0))
+  if np.ndim(scale) > 0:
+    scale = scale.astype(out.dtype) #keep float32 math in float32
+    offset = offset.astype(out.dtype)
+  np.multiply(x, scale, out=out)
+  out += offset
+  return out
 #END remap Function
 
 
 ##################
 # CREATE AUMAGES #
 ##################
-#Works in matplotlib v2.0.2
-def doAudmage(trackL=None, saveDir=None):
+#Builds an audmage from loaded audio data (channels x samples,
+#a mono track is used twice): the values divided by the sampling
+#rate, remapped from their min..max to 0..255, each channel sorted
+#and laid out row by row as the RGB of a near square L x W image
+#(less than a row of zeros at the end). Returns it as RGBA uint8,
+#the pixels plt.imsave made of it (float RGB is clipped to 0..1),
+#or None if the data is all the same. One float32 buffer and the
+#pixels are allocated, every step is done in place in them.
+#Dividing by sr doesn't change a min..max remap, so it's left
+#out, and imsave's 0..1 to 0..255 is part of the one remap.
+def audmagePixels(data, sr):
+  samples = data.shape[-1]
+  rowCount = 2 if data.ndim == 1 else data.shape[0]
+  valueCount = rowCount * samples
+  pixelCount = -(-valueCount // 3)
+  L = max(1, int(pixelCount ** 0.5))
+  W = -(-pixelCount // L)
+
+  values = np.zeros(L * W * 3, dtype=np.float32)
+  rows = values[:valueCount].reshape(rowCount, samples)
+  rows[:] = data #both rows for mono
+  low, high = rows.min(), rows.max()
+  if low == high:
+    return None
+  rows.sort(axis=1)
+  remap(rows, low, high, 0, 255 * 255, out=rows) #0..255, then x 255
+
+  pixels = np.empty((L, W, 4), dtype=np.uint8)
+  pixels[:, :, 3] = 255
+  np.clip(values, 0, 255, out=values)
+  pixels[:, :, :3] = values.reshape(L, W, 3) #truncated like to_rgba
+  return pixels
+#END audmagePixels Function
+
+
+#Makes an audmage from loaded audio data and saves it
+#to savePath. Returns False if the data can't be used.
+def makeAudmage(data, sr, savePath):
+  pixels = audmagePixels(data, sr)
+  if pixels is None:
+    print 'Unable to remap: '+ savePath +'\nFile was opened but the data is all empty or the same! Corrupted?\nSkipping...'
+    return False
 
-  #Use global S as counter for saved audmages
-  global S 
+  writePNG(tempPath(savePath), pixels, PNGLEVEL)
+  os.rename(tempPath(savePath), savePath)
+  return True
+#END makeAudmage Function
+
+
+def doAudmage(trackL=None, saveDir=None):
 
   #Do nothing if test complete
-  if S >= 5 and TEST:
+  if testDone():
     return False #Do nothing
 
   #Do we have a track path and genre?
@@ -521,7 +1804,9 @@ def doAudmage(trackL=None, saveDir=None):
   #Verify the file exists and is accessible
   if not os.path.isfile(fpath):
     #File doesn't exist or isn't accessible.
+    #Not an image failure (moved by the audio sort?), no journal row
     print 'File: '+ fullFileName +' does not exist or is not accessible\n'
+    return False
   else:
     #Create Audmages!
 
@@ -531,83 +1816,789 @@ def doAudmage(trackL=None, saveDir=None):
     else:
       savePath = saveDir +'/'+ fileName + '.png'      
 
-    #Does the audmage already exist? Save time, skip it then
-    if not os.path.exists(savePath):      
+    #Is the audmage already done? Save time, skip it then
+    params = imageParams('audmage')
+    if not skipImage(savePath, params):
+      if not claimTest():
+        return False #test done
+
       #Try to load the audio file using librosa
       if VERBOSE:
         print 'Attempting to load: '+ fpath
-      try:
-        data, sr = librosa.load(fpath, mono=False) #mono(1channel)
-      except IOError:
-        print 'Unable to load: ' + fpath
+      audio = loadAudio(fpath, mono=False) #stereo(2channel)
+      if audio == None:
         #no s increment here because we didn't make the audmage!
+        journalImage(savePath, params, 'failed', 'audio load failed')
         return False #skip this file
 
-      #Was the audio file somehow loaded yet has no data points?
-      if data.size == 0:
-        print 'Unable to load: '+ fpath +'\nFile was opened but there was no data! Corrupted?\nSkipping...'
+      data, sr = audio
+      try:
+        made, error = makeAudmage(data, sr, savePath), 'audio data all the same'
+      except Exception as e:
+        #Bad audio (empty, too short..), record it and go on
+        print 'Unable to create: '+ savePath +' '+ repr(e)
+        made, error = False, repr(e)
+      if not made:
+        journalImage(savePath, params, 'failed', error)
         return False #skip this file
+      journalImage(savePath, params, 'done')
 
-      #print 're-configuring audio data for image...'
-      #Divide each data value by the sampling rate...
-      #We need a way to include the sampling rate and
-      #this way seems most obvious...
-      if sr != 0:
-        data = data/sr #numpy will divide by each value...
-      
-      #Get min and max value in new audio data array
-      audLowValue = np.amin(data) #min value in the audio data
-      audHighValue = np.amax(data)#max value in the audio data
-      #Remap the audio values into pixel values
-      newData = remap(data, audLowValue, audHighValue, 0, 255)
-      if np.array_equal(newData, data):
-        print 'Unable to remap: '+ fpath +'\nFile was opened but the data is all empty or the same! Corrupted?\nSkipping...'
-        return False
-
-      #resize the matrix
-      tmp3 = newData.shape #Read current shape(2,?)
-      #print 'Shape ', tmp3
-      try:
-        valueCount = (tmp3[0]*tmp3[1]) # 2*?
-      except IndexError:
-        valueCount = (tmp3[0] * 2)#Must be mono file(copy same data to 2nd channel)
-        newData = np.vstack((newData,newData))
-        #print 'OldShape: ', str(tmp3), 'NewShape: ', str(newData.shape)
-
-      #split the data up into 3 or 4 image channels (RGB/A)
-      L = W = int((valueCount/3)**0.5) + 2 #adding 2 to square root to ensure all elements fit (ex: 500x500 img~)
-      newData = np.sort(newData, axis=1)  #resort along the 1st axis (try sorting after reshape*)
-      #newData = np.flip(newData, axis=0) #flip high>low values (try after reshape*)
-      newData.resize(L, W, 3) #reshape/size the matrices to an image size 3-4 channels
-
-      #At this point we have averaged all values by the samplng rate
-      #and "remapped" the values to pixel value range and reshaped.
-      #All the values can now be treated as pixel values
-
-      plt.axis('normal')
-      plt.imsave(savePath, newData, cmap='hot', format='png', dpi=100)
-      #Saving as an image lets us store the changes to the numpy matrix
-      #for later use, but this can be done on-the-fly without the image conversion.
-      #by just "normalizing/scaling" the data values with the sampling rate etc...
-      #im.save(newdata, 'sorted/audmages/'+ genre +'/'+ audFileName +'.png')
-      S += 1 #Increment index
+      done = countDone() #Increment index
       if VERBOSE:
-        print 'Finshed audmage('+ str(S) +'): '+ savePath
+        print 'Finshed audmage('+ str(done) +'): '+ savePath
       
       #Stop message if reached 5 images
-      if S == 5 and TEST:
+      if done == 5 and TEST:
         print 'Stopping audmages here, audmage test done!'
 
     else:
-      #The spectrogram already exists, skip it
-      print savePath +' already exists, skipping...'
+      #The audmage is already done, skip it
+      if VERBOSE or JOURNALFILE == None:
+        print savePath +' already done, skipping...'
       if not TEST:
-        S += 1 #Count skips too!
+        countDone() #Count skips too!
 
   return True
 #END doAudmage Function
 
 
+##########################
+# CREATE ALL FROM 1 LOAD #
+##########################
+#Decodes a track once and makes every image asked for
+#from that one buffer: the spectrogram (SPECT), the audmage
+#(AUDMAGE) and each extra spectrogram version (MELCONFIGS).
+#Multiprocessed like doSpect and doAudmage.
+def doTrack(trackL=None):
+
+  #Do nothing if test complete
+  if testDone():
+    return False #Do nothing
+
+  #Do we have a track path and genre?
+  if trackL == None:
+    print 'Missing Track information: [trackPath, genre]'
+    return False
+
+  fpath = str(trackL[0])#File path
+  genre = str(trackL[1])#Track Genre
+
+  #Are any of its images already done? Save time, skip those
+  todo = []
+  for kind, savePath, config in trackImages(fpath, genre):
+    params = imageParams(kind, config)
+    if skipImage(savePath, params):
+      if VERBOSE or JOURNALFILE == None:
+        print savePath +' already done, skipping...'
+    else:
+      todo.append([kind, savePath, config, params])
+  if not todo:
+    return True
+
+  #Verify the file exists and is accessible
+  if not os.path.isfile(fpath):
+    #File doesn't exist or isn't accessible.
+    #Not an image failure (moved by the audio sort?), no journal row
+    print 'File: '+ fpath +' does not exist or is not accessible\n'
+    return False
+  if not claimTest():
+    return False #test done
+  if STFTBLOCK:
+    if not any(image[0] == 'audmage' for image in todo):
+      return streamTrack(fpath, todo)
+    #An audmage sorts all of the track's samples at once
+    print 'Audmages need the whole track, loading (not streaming): '+ fpath
+
+  #Decode once, in stereo only if there's an audmage
+  #to make, every image is made from this buffer.
+  stereo = AUDMAGE and any(image[0] == 'audmage' for image in todo)
+  print 'Attempting to load: '+ fpath
+  audio = loadAudio(fpath, mono=not stereo)
+  if audio == None:
+    for kind, savePath, config, params in todo:
+      journalImage(savePath, params, 'failed', 'audio load failed')
+    return False #Failure
+  data, sr = audio
+
+  success = True
+  mono = None if stereo else data #mono mix, made when the first spectrogram needs it
+  for kind, savePath, config, params in todo:
+    try:
+      if kind == 'audmage':
+        made = makeAudmage(data, sr, savePath)
+        error = 'audio data all the same'
+      else:
+        if mono is None:
+          mono = librosa.to_mono(data)
+        n_fft, hop_length, n_mels = config
+        made = makeSpect(mono, sr, savePath, n_fft, hop_length, n_mels)
+    except Exception as e:
+      #Bad audio (empty, too short..), record it and go on
+      print 'Unable to create: '+ savePath +' '+ repr(e)
+      made, error = False, repr(e)
+    if made:
+      journalImage(savePath, params, 'done')
+      done = countDone() #Increment counter
+      if VERBOSE:
+        print 'Finished image('+ str(done) +'): '+ savePath
+    else:
+      journalImage(savePath, params, 'failed', error)
+    success = made and success
+
+  print 'Finished track: '+ fpath
+  return success
+#END doTrack Function
+
+
+#Makes a track's spectrograms (todo: [kind, savePath, config, params])
+#streamed, one decode feeds them all a block at a time
+def streamTrack(fpath, todo):
+  print 'Attempting to load: '+ fpath
+  try:
+    logMels = streamLogMels(fpath, [image[2] for image in todo])
+  except Exception as e:
+    #Bad audio (empty, too short..), record it and go on
+    print 'Unable to create: '+ todo[0][1] +' '+ repr(e)
+    for kind, savePath, config, params in todo:
+      journalImage(savePath, params, 'failed', repr(e))
+    return False
+  if logMels == None:
+    for kind, savePath, config, params in todo:
+      journalImage(savePath, params, 'failed', 'audio load failed')
+    return False #Failure
+
+  success = True
+  for [kind, savePath, config, params], logMel in zip(todo, logMels):
+    try:
+      made, error = saveSpect(logMel, 22050, savePath), 'not saved'
+    except Exception as e:
+      #Render or write failed (disk full..), record it and go on
+      print 'Unable to create: '+ savePath +' '+ repr(e)
+      made, error = False, repr(e)
+    if made:
+      journalImage(savePath, params, 'done')
+      done = countDone() #Increment counter
+      if VERBOSE:
+        print 'Finished image('+ str(done) +'): '+ savePath
+    else:
+      journalImage(savePath, params, 'failed', error)
+    success = made and success
+
+  print 'Finished track: '+ fpath
+  return success
+#END streamTrack Function
+
+
+#Returns every image wanted for a track [kind, savePath, melConfig]
+def trackImages(fpath, genre):
+  fileName = getTrackName(fpath) # filename (minus leading zeros)
+  ext = '.npy' if RAWNPY or FEATURES else '.png'
+  images = []
+  if SPECT:
+    images.append(['spect', 'sorted/spect/'+ genre +'/'+ fileName + ext, [2048, 512, 128]])
+  for config in MELCONFIGS:
+    images.append(['spect', 'sorted/'+ melDirName(config) +'/'+ genre +'/'+ fileName + ext, config])
+  if AUDMAGE:
+    images.append(['audmage', 'sorted/audmage/'+ genre +'/'+ fileName + '.png', None])
+  return images
+#END trackImages Function
+
+
+###############
+# WORKER POOL #
+###############
+#Makes the worker pool (once) that every creation stage uses,
+#along with the progress counters shared by its workers.
+def startPool(numWorkers):
+  global POOL, DONE, TESTED
+  if POOL == None:
+    DONE = Value('i', 0)
+    TESTED = Value('i', 0)
+    POOL = Pool(processes=numWorkers, initializer=initWorker,
+                initargs=(DONE, TESTED), maxtasksperchild=MAXTASKS)
+  return POOL
+#END startPool Function
+
+
+#Runs in each new worker, hands it the shared counters
+def initWorker(done, tested):
+  global DONE, TESTED, JOURNALLOCK
+  DONE = done
+  TESTED = tested
+  JOURNALLOCK = threading.Lock() #a reader thread may have held it at the fork
+#END initWorker Function
+
+
+#Waits for the workers to finish and closes the pool
+def stopPool():
+  global POOL
+  if POOL != None:
+    POOL.close()
+    POOL.join()
+    POOL = None
+#END stopPool Function
+
+
+#Prints a stage's progress line, count is [tasks, all known]
+#(the ETA is only known once all the tasks are)
+def stageProgress(label, finished, count, images, elapsed):
+  total = str(count[0]) if count[1] else str(count[0]) +'+'
+  eta = '?'
+  if count[1] and finished:
+    eta = formatTime(elapsed / finished * (count[0] - finished))
+  print '[%s] %d/%s done, %d images, %.2f/s, elapsed %s, ETA %s' % (
+    label, finished, total, images, finished / max(elapsed, 1e-9), formatTime(elapsed), eta)
+#END stageProgress Function
+
+
+#Formats seconds as H:MM:SS
+def formatTime(seconds):
+  seconds = int(seconds)
+  return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+#END formatTime Function
+
+
+#Estimated cost of a task, the size in bytes of its audio file(s).
+#Decode and DSP time grow with track length, which the file size
+#follows closely (and it is free to read).
+def taskCost(task):
+  if isinstance(task[0], list):
+    return sum(taskCost(trackL) for trackL in task) #a batch
+  try:
+    return os.path.getsize(task[0])
+  except OSError:
+    return 0
+#END taskCost Function
+
+
+#Runs in a worker, calls func on the task and returns the result
+#and task number along with the worker's pid, the task's
+#start and end times and its image results (for the journal).
+def timedTask(job):
+  func, task, i = job
+  start = time.time()
+  result = func(task)
+  return [result, i, os.getpid(), start, time.time(), takeJournal()]
+#END timedTask Function
+
+
+#Prints how busy each worker was during a stage and the tail gap,
+#the time between the first worker running out of work and the
+#stage finishing (all other workers idle while the last tasks run).
+def scheduleReport(label, timings, start, end):
+  workers = {}
+  for pid, tStart, tEnd in timings:
+    busy, count, last = workers.get(pid, [0.0, 0, start])
+    workers[pid] = [busy + tEnd - tStart, count + 1, max(last, tEnd)]
+  wall = max(end - start, 1e-9)
+  busy = sum(w[0] for w in workers.values())
+  print '[%s] schedule: %d workers, wall %.1fs, %.0f%% busy' % (
+    label, len(workers), wall, 100.0 * busy / (wall * max(len(workers), 1)))
+  for pid in sorted(workers, key=lambda k: -workers[k][0]):
+    wBusy, count, last = workers[pid]
+    print '  worker %d: %d tasks, busy %.1fs (%.0f%%), idle at end %.1fs' % (
+      pid, count, wBusy, 100.0 * wBusy / wall, end - last)
+  if workers:
+    firstIdle = min(w[2] for w in workers.values())
+    print '  tail gap: %.1fs (first worker idle to stage end)' % (end - firstIdle)
+#END scheduleReport Function
+
+
+#Hands out (func, task, task number) jobs from a task iterator
+#that's still being filled (see streamTracks), biggest first
+#within each window of STREAMWINDOW tasks (with ORDER 'size').
+#count is [tasks read so far, True once all are read].
+def streamJobs(func, tasks, count):
+  window = []
+  for task in tasks:
+    window.append((func, task, count[0]))
+    count[0] += 1
+    if len(window) >= STREAMWINDOW:
+      if ORDER == 'size':
+        window.sort(key=lambda job: taskCost(job[1]), reverse=True)
+      for job in window:
+        yield job
+      window = []
+  if ORDER == 'size':
+    window.sort(key=lambda job: taskCost(job[1]), reverse=True)
+  count[1] = True
+  for job in window:
+    yield job
+#END streamJobs Function
+
+
+#Runs func on each task using the worker pool. Tasks are handed
+#out biggest first (see ORDER) and results come back as soon as
+#each task finishes (imap_unordered, CHUNKSIZE tasks per hand-off),
+#so idle workers keep pulling the next task until none are left.
+#tasks can also be an iterator (see streamTracks), then tasks are
+#handed out while it's still being filled.
+#Progress is printed every few seconds.
+#Returns the list of results (in the same order as tasks).
+def runStage(func, tasks, label):
+  if isinstance(tasks, list):
+    order = range(len(tasks))
+    if ORDER == 'size':
+      order.sort(key=lambda i: taskCost(tasks[i]), reverse=True)
+    jobs = [(func, tasks[i], i) for i in order]
+    count = [len(tasks), True]
+  else:
+    count = [0, False]
+    jobs = streamJobs(func, tasks, count)
+  results = {}
+  timings = []
+  finished = 0
+  images = DONE.value #images done before this stage
+  start = lastPrint = time.time()
+  journal = openJournal() if JOURNALFILE != None else None
+  entries = [] #image results not yet written to the journal
+  for result, i, pid, tStart, tEnd, made in POOL.imap_unordered(timedTask, jobs, CHUNKSIZE):
+    results[i] = result
+    finished += 1
+    timings.append((pid, tStart, tEnd))
+    entries += made
+    now = time.time()
+    if now - lastPrint >= 5:
+      writeJournal(entries, journal) #a few seconds of results at a time
+      entries = []
+      lastPrint = now
+      stageProgress(label, finished, count, DONE.value - images, now - start)
+  writeJournal(entries, journal)
+  if journal != None:
+    journal.close()
+  stageProgress(label, finished, count, DONE.value - images, time.time() - start)
+  if REPORT:
+    scheduleReport(label, timings, start, time.time())
+  return [results[i] for i in range(finished)]
+#END runStage Function
+
+
+#################
+# CREATE IMAGES #
+#################
+#Creates the images asked for (SPECT, AUDMAGE, MELCONFIGS)
+#for every track in TRACKLIST using the worker pool.
+#When more than one kind is wanted each track is only
+#decoded once (see doTrack).
+#tracks is TRACKLIST or streamTracks() (creation starts while
+#the search is still going, TRACKLIST is complete after).
+#Returns a dict of trackPath -> True if all its images were made.
+def createImages(numWorkers, tracks=None):
+  loadJournal() #before the workers start, they get a copy
+  startPool(numWorkers)
+  if tracks == None:
+    tracks = TRACKLIST
+  if SHARDCOUNT > 1 and isinstance(tracks, list):
+    writeManifest({}) #every track 'pending' until this shard finishes
+
+  if (SPECT and AUDMAGE) or MELCONFIGS:
+    tresult = runStage(doTrack, tracks, 'tracks')#Run doTrack on each track
+    print "Finished "+ str(sum(map(int, tresult))) + " tracks."
+    status = dict(zip([trackL[0] for trackL in TRACKLIST], tresult))
+  else:
+    status = createEach(tracks)
+
+  if SHARDCOUNT > 1:
+    writeManifest(status)
+
+  #Keep the audio cache under its cap
+  if CACHEDIR != None and CACHESIZE:
+    pruneCache(CACHESIZE)
+  return status
+#END createImages Function
+
+
+#Runs doSpect and/or doAudmage over the tracks (TRACKLIST or
+#streamTracks(), the first stage takes it, later ones TRACKLIST)
+#Returns a dict of trackPath -> True if all its images were made.
+def createEach(tracks):
+  status = {}
+
+  if SPECT and BATCHSIZE > 1 and not STFTBLOCK:
+    #Do Create Spectrograms, a batch of tracks at a time
+    batches = [] #every batch handed out
+    sresult = sum(runStage(doSpectBatch, batchTracks(tracks, batches), 'spect batches'), [])
+    print "Finished "+ str(sum(map(int, sresult))) + " spectrograms."
+    for trackL, made in zip(sum(batches, []), sresult):
+      status[trackL[0]] = made
+    tracks = TRACKLIST
+  elif SPECT:
+    #Do Create Spectrograms
+    sresult = runStage(doSpect, tracks, 'spect')#Run doSpect on each track
+    print "Finished "+ str(sum(map(int, sresult))) + " spectrograms."
+                       #^Calculates number of true function returns
+    for trackL, made in zip(TRACKLIST, sresult):
+      status[trackL[0]] = made
+    tracks = TRACKLIST
+
+  if AUDMAGE:
+    #Do Create Audmages
+    aresult = runStage(doAudmage, tracks, 'audmage')#Run doAudmage on each track
+    print "Finished "+ str(sum(map(int, aresult))) + " audmages."
+    for trackL, made in zip(TRACKLIST, aresult):
+      status[trackL[0]] = status.get(trackL[0], True) and made
+  return status
+#END createEach Function
+
+
+#Yields batches of BATCHSIZE tracks, similar sized files are
+#batched together so most clips in a batch have the same length
+#(all tracks are sorted, or each STREAMWINDOW * BATCHSIZE of a
+#stream). Each batch is also added to batches.
+def batchTracks(tracks, batches):
+  window = max(len(tracks), 1) if isinstance(tracks, list) else STREAMWINDOW * BATCHSIZE
+  group = []
+  for trackL in tracks:
+    group.append(trackL)
+    if len(group) < window:
+      continue
+    group.sort(key=taskCost, reverse=True)
+    for i in range(0, len(group), BATCHSIZE):
+      batches.append(group[i:i + BATCHSIZE])
+      yield batches[-1]
+    group = []
+  group.sort(key=taskCost, reverse=True)
+  for i in range(0, len(group), BATCHSIZE):
+    batches.append(group[i:i + BATCHSIZE])
+    yield batches[-1]
+#END batchTracks Function
+
+
+##############
+# WORK QUEUE #
+##############
+#A SQLite file of tracks to create. Any number of workers, on any
+#host that can reach the file, lease tracks from it biggest first.
+#A worker renews its lease every LEASETIME/3 seconds while it
+#creates the track (hours long tracks take a while), a lease runs
+#out LEASETIME seconds after the last renewal, so the tracks of a
+#crashed worker are handed out again (MAXTRIES times at most,
+#then they are 'failed'). SQLite locking needs a local disk or a
+#shared file system with working locks, not an old NFS mount.
+#Run the workers from the same directory (relative paths).
+
+#Opens the work queue (made if new)
+def openQueue(queuePath):
+  db = sqlite3.connect(queuePath, timeout=60, isolation_level=None)
+  db.execute('''CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE, genre TEXT, cost INTEGER,
+    state TEXT, tries INTEGER, owner TEXT, expires REAL, error TEXT)''')
+  db.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, cost)')
+  return db
+#END openQueue Function
+
+
+#Adds every track in TRACKLIST to the work queue,
+#tracks already in it are left as they are.
+def publishTracks():
+  db = openQueue(QUEUEFILE)
+  before = db.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+  db.execute('BEGIN IMMEDIATE')
+  db.executemany('''INSERT OR IGNORE INTO tasks (path, genre, cost, state, tries)
+    VALUES (?, ?, ?, 'queued', 0)''', [(fpath, genre, taskCost([fpath])) for fpath, genre in TRACKLIST])
+  db.execute('COMMIT')
+  added = db.execute('SELECT COUNT(*) FROM tasks').fetchone()[0] - before
+  db.close()
+  print 'Published '+ str(added) +' tracks to '+ QUEUEFILE +' ('+ str(len(TRACKLIST) - added) +' were already there)'
+  return added
+#END publishTracks Function
+
+
+#Leases the biggest waiting track to owner.
+#Returns [id, path, genre] or None if none are waiting.
+def leaseTask(db, owner):
+  now = time.time()
+  db.execute('BEGIN IMMEDIATE') #one worker leases at a time
+  try:
+    #Run out leases with no tries left have failed
+    db.execute('''UPDATE tasks SET state='failed', error='lease ran out'
+      WHERE state='leased' AND expires<? AND tries>=?''', (now, MAXTRIES))
+    row = db.execute('''SELECT id, path, genre FROM tasks
+      WHERE state='queued' OR (state='leased' AND expires<?)
+      ORDER BY cost DESC LIMIT 1''', (now,)).fetchone()
+    if row != None:
+      db.execute('''UPDATE tasks SET state='leased', tries=tries+1, owner=?, expires=?
+        WHERE id=?''', (owner, now + LEASETIME, row[0]))
+    db.execute('COMMIT')
+  except:
+    db.execute('ROLLBACK')
+    raise
+  return row
+#END leaseTask Function
+
+
+#Marks a leased track done, or queues it again (failed once
+#it has had MAXTRIES tries). Ignored if the lease ran out and
+#the track was handed to another worker.
+def finishTask(db, taskId, owner, success, error=None):
+  if success:
+    db.execute('''UPDATE tasks SET state='done', error=NULL
+      WHERE id=? AND owner=? AND state='leased' ''', (taskId, owner))
+  else:
+    db.execute('''UPDATE tasks SET error=?,
+      state=CASE WHEN tries>=? THEN 'failed' ELSE 'queued' END
+      WHERE id=? AND owner=? AND state='leased' ''', (error, MAXTRIES, taskId, owner))
+  return True
+#END finishTask Function
+
+
+#Runs in a thread while a worker creates a leased track, pushes
+#the lease's expiry forward every LEASETIME/3 seconds until stop
+#is set. Has its own connection (SQLite connections stay in the
+#thread that made them), a renewal that can't get the lock is
+#tried again next time.
+def renewLease(taskId, owner, stop):
+  db = openQueue(QUEUEFILE)
+  while not stop.wait(LEASETIME / 3.0):
+    try:
+      db.execute('''UPDATE tasks SET expires=?
+        WHERE id=? AND owner=? AND state='leased' ''', (time.time() + LEASETIME, taskId, owner))
+    except sqlite3.Error:
+      pass #busy, the lease still has 2/3 of its time
+  db.close()
+#END renewLease Function
+
+
+#Runs in each worker, leases tracks from the queue and creates
+#their images until no tracks are left. While other workers hold
+#leases it waits, their tracks come back if a lease runs out.
+#Returns the number of tracks done by this worker.
+def drainQueue(workerNum):
+  db = openQueue(QUEUEFILE)
+  owner = '%s:%d' % (socket.gethostname(), os.getpid())
+  finished = 0
+  while not testDone():
+    task = leaseTask(db, owner)
+    if task == None:
+      leased = db.execute("SELECT COUNT(*) FROM tasks WHERE state='leased'").fetchone()[0]
+      if not leased:
+        break #queue drained
+      time.sleep(1)
+      continue
+
+    taskId, fpath, genre = task
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=renewLease, args=(taskId, owner, stop))
+    heartbeat.daemon = True
+    heartbeat.start()
+    try:
+      try:
+        doDirs(genre)
+      except OSError:
+        doDirs(genre) #another worker made the dir first
+      success, error = doTrack([fpath, genre]), 'not created'
+    except Exception as e:
+      success, error = False, repr(e)
+    finally:
+      stop.set()
+      heartbeat.join()
+
+    if not success and testDone():
+      #Not a failure, the test images were all made
+      db.execute("UPDATE tasks SET state='queued', tries=tries-1 WHERE id=? AND owner=?", (taskId, owner))
+      break
+    finishTask(db, taskId, owner, success, error)
+    writeJournal(takeJournal()) #no main process here to do it
+    finished += int(success)
+  db.close()
+  return finished
+#END drainQueue Function
+
+
+#Returns the number of tracks in each state {state: count}
+def queueCounts(db):
+  return dict(db.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall())
+#END queueCounts Function
+
+
+#Prints the state of the work queue and the failed tracks
+def queueInfo():
+  db = openQueue(QUEUEFILE)
+  counts = queueCounts(db)
+  print QUEUEFILE +': '+ str(sum(counts.values())) +' tracks'
+  for state in ['queued', 'leased', 'done', 'failed']:
+    print '  '+ state +': '+ str(counts.get(state, 0))
+  for fpath, tries, error in db.execute("SELECT path, tries, error FROM tasks WHERE state='failed'"):
+    print '    '+ fpath +' ('+ str(tries) +' tries): '+ str(error)
+  db.close()
+  return counts
+#END queueInfo Function
+
+
+#Creates images for the tracks in the work queue,
+#numWorkers workers on this host drain it.
+def runQueue(numWorkers):
+  if RETRYFAILED:
+    #The queue hands out every queued track and keeps its own
+    #failed ones (see queueinfo), the journal isn't asked
+    print '--retry-failed is not used with the work queue, the queue\'s failed tracks are in queueinfo'
+    return False
+  loadJournal() #before the workers start, they get a copy
+  startPool(numWorkers)
+  db = openQueue(QUEUEFILE)
+  images = DONE.value
+  start = time.time()
+  result = POOL.map_async(drainQueue, range(numWorkers), 1)
+  while not result.ready():
+    result.wait(5)
+    counts = queueCounts(db)
+    print '[queue] %d images here, %d queued, %d leased, %d done, %d failed, elapsed %s' % (
+      DONE.value - images, counts.get('queued', 0), counts.get('leased', 0),
+      counts.get('done', 0), counts.get('failed', 0), formatTime(time.time() - start))
+  db.close()
+  print "Finished "+ str(sum(result.get())) + " tracks from the queue."
+
+  #Keep the audio cache under its cap
+  if CACHEDIR != None and CACHESIZE:
+    pruneCache(CACHESIZE)
+  return True
+#END runQueue Function
+
+
+##############
+# LINK FILES #
+##############
+#Puts a copy of src at dst, as a link if LINKMODE is set:
+#  hard:    another name for the same file (same file system)
+#  sym:     a relative symbolic link to src
+#  reflink: a copy sharing src's blocks until either is changed
+#           (btrfs, xfs), independent like a copy
+#A link that can't be made (across devices, not supported) is a
+#copy instead, and so are the next files between those devices.
+#An existing dst is replaced.
+def placeFile(src, dst):
+  global LINKCOPIES
+  if os.path.lexists(dst):
+    os.remove(dst)
+  if LINKMODE == None:
+    copyfile(src, dst)
+    return True
+  devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst) or '.').st_dev)
+  if devices in NOLINKS:
+    with FILELOCK:
+      LINKCOPIES += 1
+    copyfile(src, dst)
+    return True
+  try:
+    if LINKMODE == 'hard':
+      os.link(src, dst)
+    elif LINKMODE == 'sym':
+      os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+    else:
+      reflinkFile(src, dst)
+  except OSError as e:
+    if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP,
+                       errno.ENOTTY, errno.EINVAL, errno.ENOSYS]:
+      raise
+    print 'Unable to make a '+ LINKMODE +' link to '+ src +' ('+ os.strerror(e.errno) +'), copying instead'
+    with FILELOCK:
+      if e.errno != errno.EMLINK:
+        NOLINKS.add(devices) #not just this file
+      LINKCOPIES += 1
+    copyfile(src, dst)
+  return True
+#END placeFile Function
+
+
+#Reflinks src to dst (FICLONE), raises OSError if the
+#file system can't (then dst is removed)
+def reflinkFile(src, dst):
+  with open(src, 'rb') as fsrc:
+    with open(dst, 'wb') as fdst:
+      try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+      except IOError as e:
+        error = e
+      else:
+        return True
+  os.remove(dst)
+  raise OSError(error.errno, error.strerror)
+#END reflinkFile Function
+
+
+##############
+# FILE PLANS #
+##############
+#Sorting and datasets first plan every file operation, a list of
+#[op, src, dst]:
+#  'move':   rename src to dst (copied then removed across devices)
+#  'place':  copy or link src to dst (see placeFile)
+#  'remove': remove src
+#then runPlan does them: removes first, every dst dir made once,
+#the moves and copies spread over FILETHREADS threads (on network
+#storage one file at a time leaves the disks idle).
+#With DRYRUN the plan is only printed.
+#Returns the number of operations that failed.
+def runPlan(plan, label):
+  removes = [op for op in plan if op[0] == 'remove']
+  files = [op for op in plan if op[0] != 'remove']
+  dirs = sorted(set(os.path.dirname(op[2]) for op in files))
+  newDirs = [d for d in dirs if d and not os.path.isdir(d)]
+
+  if DRYRUN:
+    for d in newDirs:
+      print 'mkdir '+ d
+    for op, src, dst in plan:
+      print op +' '+ src + ('' if op == 'remove' else ' -> '+ dst)
+    print label +' (dry run): '+ planSummary(plan, newDirs)
+    return 0
+
+  start = time.time()
+  failed = 0
+  for op in removes:
+    if fileOp(op) != None:
+      failed += 1
+  for d in newDirs:
+    if not os.path.isdir(d):
+      os.makedirs(d)
+
+  pool = ThreadPool(max(1, FILETHREADS))
+  try:
+    for error in pool.imap_unordered(fileOp, files, 16):
+      if error != None:
+        failed += 1
+        print error
+  finally:
+    pool.close()
+    pool.join()
+  print label +': '+ planSummary(plan, newDirs) +' in '+ formatTime(time.time() - start) + (', '+ str(failed) +' failed' if failed else '')
+  return failed
+#END runPlan Function
+
+
+#Does one planned operation, returns None or what went wrong
+def fileOp(op):
+  action, src, dst = op
+  try:
+    if action == 'remove':
+      os.remove(src)
+    elif action == 'move':
+      if VERBOSE:
+        print 'Moving '+ src +' to: '+ dst
+      move(src, dst) #a rename on the same file system
+    else:
+      if VERBOSE:
+        print 'Copying '+ src +' to: '+ dst
+      placeFile(src, dst)
+  except (IOError, OSError) as e:
+    if action == 'remove':
+      return 'Unable to remove file: '+ src
+    return 'Unable to '+ ('move' if action == 'move' else 'copy') +' file: '+ src +'\nTo new location: '+ dst +' ('+ str(e) +')\nskipping...'
+  return None
+#END fileOp Function
+
+
+#ex: '120 moves, 3 removes, 8 new dirs'
+def planSummary(plan, newDirs):
+  counts = {}
+  for op in plan:
+    counts[op[0]] = counts.get(op[0], 0) + 1
+  parts = [str(counts[op]) +' '+ (op +'s' if op != 'place' else ('copies' if LINKMODE == None else LINKMODE +' links'))
+           for op in ['move', 'place', 'remove'] if op in counts]
+  return ', '.join(parts + [str(len(newDirs)) +' new dirs'])
+#END planSummary Function
+
+
 ########################
 # Generate the dataset #
 ########################
@@ -617,6 +2608,8 @@ def generateSet(p1,p2,p3):
       #the data split percentages don't equal 100%..
       print "The data split percentages must equal 1"
       sys.exit()
+  total = float(p1+p2+p3)
+  p1, p2, p3 = p1/total, p2/total, p3/total
   
   #which items are we creating a dataset for?
   #not audio files because dataset uses images
@@ -632,152 +2625,216 @@ def generateSet(p1,p2,p3):
   #Try to get a list of genres by reading dir names from a sorted directory
   try:
     genres = os.listdir('sorted/'+ item) #list of genres
-  except IOError:
+  except OSError:
     print 'Unable to get list of genres from: sorted/'+ item
-    #Try opposite item if using and available...
-    if item == 'spect' and AUDMAGE:
-      try:
-        genres = os.listdir('sorted/audmage')
-        item = 'audmage' #change item
-      except IOError:
-        print 'Unable to get list of genres from: sorted/audmage'
-        sys.exit()
-    elif item == 'audmage' and SPECT:
-      try:
-        genres = os.listdir('sorted/spect')
-        item = 'spect'
-      except IOError:
-        print 'Unable to get list of genres from: sorted/audmage'
-        sys.exit()
-  #End exception
+    sys.exit()
 
-  gCount = [] #total images for each genre
-  iTotal = 0 #total number of images among all genres
+  genres.sort() #the label of a genre is its index (like flow_from_directory)
+  kinds = [item] #image kinds in the split, both if both are sorted
+  if item == 'spect' and AUDMAGE and os.path.isdir('sorted/audmage'):
+    kinds.append('audmage')
+  if item == 'audmage' and SPECT and os.path.isdir('sorted/spect'):
+    kinds.append('spect')
+  if SPLITSEED != None:
+    print 'Split seed: '+ str(SPLITSEED)
+
+  #Each track's split comes from its hashed id, not a shuffle,
+  #so a track stays in its split when tracks are added or removed
+  #(and the audmage of a track is in the same split as its spect)
+  wanted = sortedImages(item, genres, p1, p2)
   for genre in genres:
-    try:
-      #count of files listed within genre
-      tmpCount = len(os.listdir('sorted/'+ item +'/'+ genre))
-    except IOError:
-      tmpCount = 0
+    counts = {'train': 0, 'test': 0, 'validate': 0}
+    for imageGenre, label, split in wanted.values():
+      if imageGenre == genre:
+        counts[split] += 1
+    print 'There are '+ str(counts['train']) +' '+ genre +' tracks for train set.'
+    print 'There are '+ str(counts['test']) +' '+ genre +' tracks for test set.'
+    print 'There are '+ str(counts['validate']) +' '+ genre +' tracks for validate set.'
+
+  for kind in kinds:
+    if kind != item:
+      #Its own images (a track may have a spect and no audmage,
+      #and their extensions differ), in the same splits
+      wanted = sortedImages(kind, genres, p1, p2)
+    if SPLITMANIFEST:
+      #Only record the split, nothing is copied
+      current = readSplit(kind)
+    else:
+      current = datasetFiles(kind)
+      print 'Sorting.. please wait..\n'
+    changes = splitChanges(current, wanted)
+    if not SPLITMANIFEST:
+      applyChanges(kind, changes)
+    rows = []
+    for track in sorted(wanted):
+      genre, label, split = wanted[track]
+      rows.append(['../sorted/'+ kind +'/'+ genre +'/'+ track,
+                   getTrackName(track), genre, label, split])
+    if not DRYRUN:
+      writeSplit(kind, rows) #also the record of what's in dataset/
+    reportChanges(kind, changes)
+
+  if LINKCOPIES:
+    print str(LINKCOPIES) +' files were copied, they could not be linked.'
+  if not SPLITMANIFEST and not DRYRUN:
+    print "Dataset generated using split:  %d%%-train | %d%%-test | %d%%-validation." % (round(p1*100), round(p2*100), round(p3*100))
+  return True
+#End generateSet function
 
-    gCount.append(tmpCount) #save count for this genre
-    iTotal += tmpCount #add this genre count to total
-  
-  #At this point "item" value matters.. both or one?
-  i = 0
-  while i < len(genres):
+
+#Images of a kind in sorted/<kind>/<genre>/, returns image name
+#-> [genre, label, split] (label is the genre's index in genres).
+#The split comes from the track id (trackSplit), so each kind has
+#a track's image in the same split.
+def sortedImages(kind, genres, p1, p2):
+  images = {}
+  for label, genre in enumerate(genres):
     try:
-      tracks = os.listdir('sorted/'+ item +'/'+ str(genres[i]))
-    except IOError:
-      print 'Unable to get list of tracks from: sorted/'+ item +'/'+ str(genres[i])
-      i += 1 #Increment to next genre
+      tracks = os.listdir('sorted/'+ kind +'/'+ genre)
+    except OSError:
+      print 'Unable to get list of tracks from: sorted/'+ kind +'/'+ genre
       continue #Skip rest of code, go to next genre
-
-    shuffle(tracks) #mix up the tracks to scramble datasets each time
-    #all of these tracks belong to same genre so it doesn't effect the splits
-    
-    #split up the tracks in this genre for each dataset item (train/test/validate)
-    p1tracks = tracks[:int(gCount[i]*p1)] #only take p1 percent of these tracks
-    p2tracks = tracks[int(gCount[i]*p1):int((gCount[i]*p1)+(gCount[i]*p2))] #take p2 percent of these tracks
-    p3tracks = tracks[int((gCount[i]*p1)+(gCount[i]*p2)):] #all the rest... p3 percent of these tracks..
-
-    print 'There are '+ str(len(p1tracks)) +' '+ genres[i] +' tracks for train set.'
-    print 'There are '+ str(len(p2tracks)) +' '+ genres[i] +' tracks for test set.'
-    print 'There are '+ str(len(p3tracks)) +' '+ genres[i] +' tracks for validate set.'
-    print 'Sorting.. please wait..\n'
-    #copy the p1 files to the dataset test directory
-    for track in p1tracks:
-      doDirs(genres[i])#make sure the dir struct is in place
-      #print 'Test file: ' + track
-      trackPath = 'sorted/'+ item +'/'+ genres[i] +'/'+ track 
-      newPath = 'dataset/'+ item +'/train/'+ genres[i] +'/'+ track
-      try:
-        copyfile(trackPath, newPath)
-      except IOError:
-        print 'Unable to copy file: '+ trackPath
-        print 'To new location: '+ newPath +'\nskipping...'
-      
-      if item == 'spect' and AUDMAGE:
-        trackPath = 'sorted/audmage/'+ genres[i] +'/'+ track
-        newPath = 'dataset/audmage/train/'+ genres[i] +'/'+ track
-        try:
-          copyfile(trackPath, newPath)
-        except IOError:
-          print 'Unable to copy file: '+ trackPath
-          print 'To new location: '+ newPath +'\nskipping...'
-
-      if item == 'audmage' and SPECT:
-        trackPath = 'sorted/spect/'+ genres[i] +'/'+ track 
-        newPath = 'dataset/spect/train/'+genres[i] +'/'+ track
-        try:
-          copyfile(trackPath, newPath)
-        except IOError:
-          print 'Unable to copy file: '+ trackPath
-          print 'To new location: '+ newPath +'\nskipping...'
-    
-    #copy the p2 files to the dataset train directory
-    for track in p2tracks:
-      #print 'Train file: ' + track
-      trackPath = 'sorted/'+ item +'/'+ genres[i] +'/'+ track 
-      newPath = 'dataset/'+ item +'/test/'+ genres[i] +'/'+ track
-      try:
-        copyfile(trackPath, newPath)
-      except IOError:
-        print 'Unable to copy file: '+ trackPath
-        print 'To new location: '+ newPath +'\nskipping...'
-      
-      if item == 'spect' and AUDMAGE:
-        trackPath = 'sorted/audmage/'+ genres[i] +'/'+ track
-        newPath = 'dataset/audmage/test/'+ genres[i] +'/'+ track
-        try:
-          copyfile(trackPath, newPath)
-        except IOError:
-          print 'Unable to copy file: '+ trackPath
-          print 'To new location: '+ newPath +'\nskipping...'
-
-      if item == 'audmage' and SPECT:
-        trackPath = 'sorted/spect/'+ genres[i] +'/'+ track 
-        newPath = 'dataset/spect/test/'+ genres[i] +'/'+ track
-        try:
-          copyfile(trackPath, newPath)
-        except IOError:
-          print 'Unable to copy file: '+ trackPath
-          print 'To new location: '+ newPath +'\nskipping...'
-
-    #copy the p3 files to the dataset validate directory
-    for track in p2tracks:
-      #print 'Validate file: ' + track
-      trackPath = 'sorted/'+ item +'/'+ genres[i] +'/'+ track 
-      newPath = 'dataset/'+ item +'/validate/'+ genres[i] +'/'+ track
+    for track in tracks:
+      images[track] = [genre, label, trackSplit(getTrackName(track), p1, p2)]
+  return images
+#END sortedImages Function
+
+
+#Returns the split ('train', 'test' or 'validate') of a track,
+#its id hashed (md5, with SPLITSEED) to a number in [0, 1) that
+#is below p1 for train, below p1+p2 for test.
+def trackSplit(trackName, p1, p2):
+  key = trackName if SPLITSEED == None else str(SPLITSEED) +':'+ trackName
+  bucket = int(hashlib.md5(key).hexdigest()[:8], 16) / float(16**8)
+  if bucket < p1:
+    return 'train'
+  elif bucket < p1 + p2:
+    return 'test'
+  return 'validate'
+#END trackSplit Function
+
+
+#Images in the dataset dirs of a kind, dataset/<kind>/<split>/<genre>/
+#image name -> list of [genre, split] (more than 1 if left over
+#in other splits)
+def datasetFiles(kind):
+  current = {}
+  for split in ['train', 'test', 'validate']:
+    splitDir = 'dataset/'+ kind +'/'+ split
+    if not os.path.isdir(splitDir):
+      continue
+    for genre in os.listdir(splitDir):
+      if not os.path.isdir(splitDir +'/'+ genre):
+        continue
+      for track in os.listdir(splitDir +'/'+ genre):
+        current.setdefault(track, []).append([genre, split])
+  return current
+#END datasetFiles Function
+
+
+#The split in the last manifest of a kind (dataset/<kind>.csv),
+#image name -> list of [genre, split], like datasetFiles()
+def readSplit(kind):
+  current = {}
+  if not os.path.isfile('dataset/'+ kind +'.csv'):
+    return current
+  with open('dataset/'+ kind +'.csv', 'rb') as mfile:
+    reader = csv.reader(mfile)
+    next(reader) #header
+    for row in reader:
+      current.setdefault(row[0].split('/')[-1], []).append([row[2], row[4]])
+  return current
+#END readSplit Function
+
+
+#Compares what's in the dataset (current) with the split wanted,
+#returns a dictionary of lists of
+#[image, from genre, from split, to genre, to split]:
+#  'added':   not in the dataset yet
+#  'moved':   in another split or genre
+#  'removed': no longer sorted, or left over in another split
+#  'kept':    already in place
+def splitChanges(current, wanted):
+  changes = {'added': [], 'moved': [], 'removed': [], 'kept': []}
+  for track in wanted:
+    genre, label, split = wanted[track]
+    places = current.get(track, [])
+    if [genre, split] in places:
+      changes['kept'].append([track, genre, split, genre, split])
+      stale = [place for place in places if place != [genre, split]]
+    elif places:
+      changes['moved'].append([track, places[0][0], places[0][1], genre, split])
+      stale = places[1:]
+    else:
+      changes['added'].append([track, '', '', genre, split])
+      stale = []
+    for place in stale:
+      changes['removed'].append([track, place[0], place[1], '', ''])
+  for track in current:
+    if track not in wanted:
+      for place in current[track]:
+        changes['removed'].append([track, place[0], place[1], '', ''])
+  return changes
+#END splitChanges Function
+
+
+#Makes the dataset dirs of a kind match the split, only
+#the changed images are touched (and kept ones whose sorted
+#image is newer, it was made again). See runPlan.
+def applyChanges(kind, changes):
+  plan = []
+  for track, genre, split, toGenre, toSplit in changes['removed'] + changes['moved']:
+    plan.append(['remove', 'dataset/'+ kind +'/'+ split +'/'+ genre +'/'+ track, None])
+
+  for track, genre, split, toGenre, toSplit in changes['added'] + changes['moved'] + changes['kept']:
+    trackPath = 'sorted/'+ kind +'/'+ toGenre +'/'+ track
+    newPath = 'dataset/'+ kind +'/'+ toSplit +'/'+ toGenre +'/'+ track
+    if split == toSplit and genre == toGenre:
+      #kept, unless the sorted image is newer
       try:
-        copyfile(trackPath, newPath)
-      except IOError:
-        print 'Unable to copy file: '+ trackPath
-        print 'To new location: '+ newPath +'\nskipping...'
-      
-      if item == 'spect' and AUDMAGE:
-        trackPath = 'sorted/audmage/'+ genres[i] +'/'+ track
-        newPath = 'dataset/audmage/validate/'+ genres[i] +'/'+ track
-        try:
-          copyfile(trackPath, newPath)
-        except IOError:
-          print 'Unable to copy file: '+ trackPath
-          print 'To new location: '+ newPath +'\nskipping...'
-
-      if item == 'audmage' and SPECT:
-        trackPath = 'sorted/spect/'+ genres[i] +'/'+ track 
-        newPath = 'dataset/spect/validate/'+ genres[i] +'/'+ track
-        try:
-          copyfile(trackPath, newPath)
-        except IOError:
-          print 'Unable to copy file: '+ trackPath
-          print 'To new location: '+ newPath +'\nskipping...'
-
-    i += 1 #increment genre index
-  #End While Loop
-  print "Dataset generated using split:  80%-train | 10%-test | 10%-validation."
+        if os.path.getmtime(trackPath) <= os.path.getmtime(newPath):
+          continue
+      except OSError:
+        pass
+    plan.append(['place', trackPath, newPath])
+  return runPlan(plan, kind +' dataset') == 0
+#END applyChanges Function
+
+
+#Prints how the split of a kind changed since the last time and
+#writes the changes to dataset/<kind>-changes.csv
+def reportChanges(kind, changes):
+  print kind +': '+ str(len(changes['added'])) +' added, '+ str(len(changes['moved'])) +' moved, '+ str(len(changes['removed'])) +' removed, '+ str(len(changes['kept'])) +' unchanged'
+  if DRYRUN:
+    return True
+  with open('dataset/'+ kind +'-changes.csv', 'wb') as rfile:
+    writer = csv.writer(rfile)
+    writer.writerow(['image', 'change', 'from_genre', 'from_split', 'to_genre', 'to_split'])
+    for change in ['added', 'moved', 'removed']:
+      for row in sorted(changes[change]):
+        writer.writerow([row[0], change] + row[1:])
+        if VERBOSE:
+          print '  '+ change +' '+ row[0] +': '+ '/'.join(row[1:3]) +' -> '+ '/'.join(row[3:])
   return True
-#End generateSet function
+#END reportChanges Function
+
+
+#Writes a split manifest, dataset/<kind>.csv, with a row per
+#image [path, track, genre, label, split]. Paths are relative to
+#the manifest, label is the index of the genre (sorted names).
+def writeSplit(kind, rows):
+  if not os.path.isdir('dataset'):
+    os.mkdir('dataset')
+  savePath = 'dataset/'+ kind +'.csv'
+  tmpPath = savePath +'.tmp'
+  with open(tmpPath, 'wb') as mfile:
+    writer = csv.writer(mfile)
+    writer.writerow(['path', 'track', 'genre', 'label', 'split'])
+    writer.writerows(rows)
+  os.rename(tmpPath, savePath)
+  print 'Wrote the split of '+ str(len(rows)) +' '+ kind +' images to: '+ savePath
+  return savePath
+#END writeSplit Function
 
 
 #AUDIO SORT
@@ -791,29 +2848,24 @@ def audioSort():
   else:
     #We have track list
     print 'Attempting to sort Audio files...'
+    plan = []
     for fpath, genre in TRACKLIST:
       #Split up the path string and get 
       #the file name and extension
-      tmp = fpath.split('/')
-      tmp2 = str(tmp[-1]).split('.')
-      fullFileName = tmp[-1] # filename.mp3
-      fileName = str(int(tmp2[0])) # filename (minus leading zeros)
-      fileExt = tmp2[1]       # .mp3/.png
+      fullFileName = fpath.split('/')[-1] # filename.mp3
+      newPath = "sorted/audio/"+ genre +"/"+ fullFileName
       
       #Is it already there, (from previous run cut short?)
-      if not os.path.exists("sorted/audio/"+ genre +"/"+ fullFileName):
-        #Move or Copy?
-        if COPY:
-          if VERBOSE:
-            print 'Copying '+ fullFileName +' to: sorted/audio/'+ genre +"/"+ fullFileName
-          copyfile(fpath, "sorted/audio/"+ genre +"/"+ fullFileName)
+      if not os.path.exists(newPath):
+        #Move or Copy (or link)?
+        if COPY or LINKMODE != None:
+          plan.append(['place', fpath, newPath])
         else:
-          if VERBOSE:
-            print 'Moving '+ fullFileName +' to: sorted/audio/'+ genre +"/"+ fullFileName
-          move(fpath, "sorted/audio/"+ genre +"/"+ fullFileName)
+          plan.append(['move', fpath, newPath])
       else:
         print 'Audio file: '+ fullFileName  +' is already there, skipping...'
     #end track loop
+    runPlan(plan, 'Audio sort')
   return True
 #END audioSort Function
 
@@ -828,59 +2880,39 @@ def imageSort():
     print 'Missing track information, you need to first search and match genres.'
     return False
   else:
+    #which kind of images?
+    if SPECT:
+      item = 'spect'
+    else:
+      item = 'audmage'
+
     #We have track list
+    plan = []
     for fpath, genre in TRACKLIST:
       #Split up the path string and get 
       #the file name and extension
-      tmp = fpath.split('/')
-      tmp2 = str(tmp[-1]).split('.')
-      fullFileName = tmp[-1] # filename.mp3
-      fileName = str(int(tmp2[0])) # filename (minus leading zeros)
-      fileExt = tmp2[1]       # .mp3/.png
-      
-      #which kind of images?
-      if SPECT:
-        item = 'spect'
-      else:
-        item = 'audmage'
+      fullFileName = fpath.split('/')[-1] # filename.png
+      newPath = "sorted/"+ item +"/"+ genre +"/"+ fullFileName
  
       #Is it already there, (from previous run cut short?)
-      if not os.path.exists("sorted/"+ item +"/"+ genre +"/"+ fullFileName):
-        #Move or Copy?
-        if COPY:
-          copyfile(fpath, "sorted/"+ item +"/"+ genre +"/"+ fullFileName)
+      if not os.path.exists(newPath):
+        #Move or Copy (or link)?
+        if COPY or LINKMODE != None:
+          plan.append(['place', fpath, newPath])
         else:
-          move(fpath, "sorted/"+ item +"/"+ genre +"/"+ fullFileName)
+          plan.append(['move', fpath, newPath])
     #end track loop
+    runPlan(plan, 'Image sort')
   return True
 #END imageSort Function
 
 
 #OK All functions are ready, lets begin.
 if __name__ == '__main__':
-  #First try and read the tracks.txt file.
-  #This file greatly speeds everything up.
-  #It's used to build a dictionary lookup
-  #for genre using trackname as a key
-  try:
-    with open('tracks.txt', 'r') as f:
-      tmp = list(f.read().splitlines())
-    for row in tmp:
-      tmp2 = row.split(' ')
-      META_T[tmp2[0]] = tmp2[1]
-  except IOError:
-    print 'Could not find tracks.txt'
-    #Try to open and read the tracks.csv file
-    #This file is slower do to extra looping.
-    try:
-      iFile = open("fma_metadata/tracks.csv", "rb")
-      META = csv.reader(iFile)
-    except IOError:
-      try:
-        iFile = open("tracks.csv", "rb")
-        META = csv.reader(iFile)
-      except IOError:
-        print 'Unable to open: fma_metadata/tracks.csv'
+  #First load the genre index (tracks.csv).
+  #It's used to look up the genre of
+  #each track by its track name.
+  loadGenreIndex()
 
 
   #Begin setting up options and inputs #
@@ -897,6 +2929,9 @@ if __name__ == '__main__':
       #split up command arguments taking all arguments after arg 1
       #and loop through each option to check which it is.
       for option in sys.argv[2:]:
+        #Options with values are given as --name=value
+        optName, optValue = (option.lower().split('=', 1) + [''])[:2]
+        rawValue = (option.split('=', 1) + [''])[1] #paths keep their case
         if option.lower() == 'audio' or option.lower() == '-a':
           #User wants to work with audio files
           AUDIO = True
@@ -924,9 +2959,109 @@ if __name__ == '__main__':
         elif option.lower() == 'copy' or option.lower() == '-p':
           #User wishes to copy when sorting
           COPY = True
-        elif option.lower() == 'test' or option.lower('-t'):
-          #User wishes to copy when sorting
+        elif option.lower() == 'test' or option.lower() == '-t':
+          #User wishes to only make a few images
           TEST = True
+        elif optName == '--render':
+          #User wants to choose the spectrogram renderer (mpl/lut)
+          RENDER = optValue
+        elif optName == '--size':
+          #Size of 'lut' spectrograms, ex: --size=503x376
+          IMGSIZE = tuple(int(v) for v in optValue.split('x'))
+        elif optName == '--png-level':
+          #PNG compression level of 'lut' spectrograms (0-9)
+          PNGLEVEL = int(optValue)
+        elif optName == '--mel':
+          #Extra spectrogram version, ex: --mel=1024:256:96
+          #(n_fft:hop_length:n_mels), can be given more than once
+          MELCONFIGS.append([int(v) for v in optValue.split(':')])
+        elif optName == '--batch':
+          #Spectrograms with the float32 FFT, ex: --batch=2
+          BATCHSIZE = int(optValue)
+        elif optName == '--stft-block':
+          #Streamed spectrograms, blocks of N seconds, ex: --stft-block=30
+          STFTBLOCK = float(optValue)
+        elif optName == '--max-frames':
+          #Spectrograms at most N frames wide, ex: --max-frames=4096
+          MAXFRAMES = int(optValue)
+        elif optName == '--chunksize':
+          #Tasks handed to a worker at a time, ex: --chunksize=4
+          CHUNKSIZE = int(optValue)
+        elif optName == '--max-tasks':
+          #Replace each worker after this many tasks, ex: --max-tasks=200
+          MAXTASKS = int(optValue)
+        elif optName == '--order' and optValue in ['size', 'list']:
+          #Task order, ex: --order=list
+          ORDER = optValue
+        elif option.lower() == 'report':
+          #Print a scheduling report after each stage
+          REPORT = True
+        elif optName == '--shard-index':
+          #This node's shard, ex: --shard-index=3
+          SHARDINDEX = int(optValue)
+        elif optName == '--shard-count':
+          #Number of shards, ex: --shard-count=16
+          SHARDCOUNT = int(optValue)
+        elif option.lower() == 'merge':
+          #Merge the shard manifests
+          MERGE = True
+        elif optName == '--queue':
+          #Use this work queue, ex: --queue=jobs.db
+          QUEUEFILE = rawValue
+        elif option.lower() == 'publish':
+          #Add the matched tracks to the work queue
+          QUEUECMD = 'publish'
+        elif option.lower() == 'queueinfo':
+          #Show the work queue
+          QUEUECMD = 'info'
+        elif optName == '--lease':
+          #Lease timeout in seconds, ex: --lease=1800
+          LEASETIME = float(optValue)
+        elif optName == '--tries':
+          #Times a track is tried, ex: --tries=5
+          MAXTRIES = int(optValue)
+        elif optName == '--journal':
+          #Job journal file, ex: --journal=run2.db or --journal=none
+          JOURNALFILE = None if optValue == 'none' else rawValue
+        elif optName == '--retry-failed':
+          #Only redo the failed images
+          RETRYFAILED = True
+        elif option.lower() == 'nostream':
+          #Search and match everything before creating
+          STREAM = False
+        elif optName == '--link' and optValue in ['', 'hard', 'sym', 'reflink']:
+          #Link files instead of copying, ex: --link=sym
+          LINKMODE = optValue or 'hard'
+        elif optName == '--cache':
+          #Cache decoded audio in this dir, ex: --cache=audiocache
+          CACHEDIR = rawValue if rawValue else 'audiocache'
+        elif optName == '--cache-size':
+          #Size cap of the audio cache, ex: --cache-size=20G
+          CACHESIZE = parseSize(optValue)
+        elif option.lower() == 'cacheinfo':
+          #User wants to see what's in the audio cache
+          CACHECMD = 'info'
+        elif option.lower() == 'cacheprune':
+          #User wants to prune the audio cache to --cache-size
+          CACHECMD = 'prune'
+        elif option.lower() == 'dryrun':
+          #Only print the sorting/dataset file operations
+          DRYRUN = True
+        elif optName == '--file-threads':
+          #Threads moving/copying files, ex: --file-threads=32
+          FILETHREADS = int(optValue)
+        elif option.lower() == 'manifest':
+          #Only write the dataset split (dataset/<item>.csv)
+          SPLITMANIFEST = True
+        elif optName == '--seed':
+          #Seed of the dataset split, ex: --seed=42
+          SPLITSEED = int(optValue)
+        elif option.lower() == 'npy':
+          #User wants raw uint8 .npy spectrograms instead of .png
+          RAWNPY = True
+        elif option.lower() == 'features':
+          #User wants float16 log-mel .npy features, no images
+          FEATURES = True
         else:
           print 'Unknown option: '+ option +', skipping it...'
       #end option loop
@@ -940,6 +3075,48 @@ if __name__ == '__main__':
     ################
     # SCRIPT BEGIN #
     ################
+    #Only looking after the audio cache?
+    if CACHECMD != None:
+      if CACHEDIR == None:
+        CACHEDIR = sys.argv[1] #ex: python audmage.py audiocache cacheinfo
+      cacheCommand(CACHECMD)
+      sys.exit()
+
+    if not 0 <= SHARDINDEX < SHARDCOUNT:
+      print 'Error, --shard-index must be from 0 to --shard-count - 1'
+      sys.exit()
+
+    if DRYRUN and CREATE:
+      print 'Error, dryrun only plans sorting and datasets, leave out create'
+      sys.exit()
+
+    #Only merging the shard manifests?
+    if MERGE:
+      CREATE = True #search the audio collection
+      doSearch(sys.argv[1])
+      matchTracks() #every track, to find the missing ones
+      mergeManifests()
+      sys.exit()
+
+    #Only filling or looking at the work queue?
+    if QUEUECMD != None:
+      if QUEUEFILE == None:
+        print 'Error, give the work queue with --queue=<file.db>'
+        sys.exit()
+      if QUEUECMD == 'publish':
+        CREATE = True #search the audio collection
+        doSearch(sys.argv[1])
+        if not PATHLIST:
+          print 'Unable to locate audio files in specified directory: '+ sys.argv[1]
+          sys.exit()
+        matchTracks()
+        if SHARDCOUNT > 1:
+          shardTracks() #Only this shard's tracks
+        publishTracks()
+      else:
+        queueInfo()
+      sys.exit()
+
     #Are we working with audio files?
     if AUDIO:
       #Do sort audio
@@ -951,32 +3128,40 @@ if __name__ == '__main__':
       print 'Found '+ str(len(PATHLIST)) +' Files'
 
       matchTracks() #Match tracks with genres
+      if SHARDCOUNT > 1:
+        shardTracks() #Only this node's tracks
       audioSort()   #Sort the audio tracks in genres
       print 'Finished sorting audio files.'
       
       #Are we going to create image files?
       if CREATE:
         #Figure out how many worker processes to spawn
-        numWorkers = NUMNODES * NUMCORES
-        if SPECT:
-          #Do Create Spectrograms
-          p = Pool(processes=numWorkers) #set number of worker processes
-          sresult = p.map(doSpect, TRACKLIST)#Run doSpect on each element of TRACKLIST
-          #ie: Split TRACKLIST between NumWorkers and run doSpect on each element
-          print "Finished "+ str(sum(map(int, sresult))) + " spectrograms."
-                             #^Calculates number of true function returns
-
-        if AUDMAGE:
-          #Do Create Audmages
-          p = Pool(processes=numWorkers) #set number of worker processes
-          aresult = p.map(doAudmage, TRACKLIST)#Run doAudmage on each element of TRACKLIST
-          #ie: Split TRACKLIST between NumWorkers and run doAudmage on each element
-          print "Finished "+ str(sum(map(int, aresult))) + " audmages."
+        #(a shard runs on one node)
+        numWorkers = NUMCORES if SHARDCOUNT > 1 else NUMNODES * NUMCORES
+        createImages(numWorkers)
 
       if GDATA:
         #Do generate dataset
         generateSet(.8, .1, .1)
 
+    elif CREATE and QUEUEFILE != None:
+      #Creating images from the work queue, the tracks
+      #were matched and published there (see publish)
+      runQueue(NUMCORES) #workers on this host
+
+    elif CREATE and STREAM:
+      #Still working with audio files!
+      #Creating images (auto sorted) while searching,
+      #the workers start on the first tracks found
+      if GINDEX == None:
+        #No track would match, don't start the workers
+        print 'No genre data, skipping...'
+        sys.exit()
+      NumWorkers = NUMCORES if SHARDCOUNT > 1 else NUMNODES * NUMCORES
+      createImages(NumWorkers, streamTracks(sys.argv[1]))
+      if not PATHLIST:
+        print 'Unable to locate audio files in specified directory: '+ sys.argv[1]
+
     elif CREATE:
       #Still working with audio files!
       #Creating images (auto sorted)
@@ -987,25 +3172,15 @@ if __name__ == '__main__':
       #How many were found?
       print 'Found '+ str(len(PATHLIST)) +' Files'
 
-      #Figure out how many worker processes to spawn
-      NumWorkers = NUMNODES * NUMCORES
-
       #match up audio files with genres
       matchTracks() 
-      
-      if SPECT:
-        #Do Create Spectrograms
-        p = Pool(processes=NumWorkers) #set number of worker processes
-        sresult = p.map(doSpect, TRACKLIST)#Run doSpect on each element of TRACKLIST
-        #ie: Split TRACKLIST between NumWorkers and run doSpect on each element
-        print "Finished "+ str(sum(map(int, sresult))) + " spectrograms."
-
-      if AUDMAGE:
-        #Do Create Audmages
-        p = Pool(processes=NumWorkers) #set number of worker processes
-        aresult = p.map(doAudmage, TRACKLIST)#Run doAudmage on each element of TRACKLIST
-        #ie: Split TRACKLIST between NumWorkers and run doAudmage on each element
-        print "Finished "+ str(sum(map(int, aresult))) + " audmages."
+      if SHARDCOUNT > 1:
+        shardTracks() #Only this node's tracks
+
+      #Figure out how many worker processes to spawn
+      #(a shard runs on one node)
+      NumWorkers = NUMCORES if SHARDCOUNT > 1 else NUMNODES * NUMCORES
+      createImages(NumWorkers)
 
     elif GDATA:
       #We are Not working with audio files!
@@ -1022,12 +3197,13 @@ if __name__ == '__main__':
         print 'Unable to locate image files in specified directory: '+ sys.argv[1]
         sys.exit()
 
-      matchTracks()#match track names with genres from tracks.txt
+      matchTracks()#match track names with genres from the genre index
 
       if SPECT and AUDMAGE:
         print 'Can only sort one directory at a time.\nplease choose spects or audmages, not both.'
       else:
         imageSort() #Sort images, function will decide which based on commands given
+    stopPool() #Let the workers finish up
   else:
     #No arguments given, need path data!
     print 'You must provide a directory path, exiting...'
@@ -0,0 +1,1165 @@
+############################################################
+# Bench - Timing scripts for the slow parts of audmage.py
+#
+# Each benchmark builds its own synthetic data inside a
+# temporary directory, so it can be run from anywhere
+# without the FMA sets being downloaded.
+#
+# Author: github/npocodes and C490 Deep Learning Group
+#
+# Command inputs:
+#   1+- benchmarks to run {match, render, fanout, batch, search, dataset,
+#       sort, pack, loader, cache, augment,
+#       audmage, remap, stream, queue, rerun}
+#       (no options runs all benchmarks)
+#
+# [Usage Examples]
+# ex: ~$ python bench.py match
+# times the genre index against a 100k row tracks.csv
+#
+# ex2: ~$ python bench.py render
+# times the matplotlib and lookup table spectrogram renderers
+#
+# ex3: ~$ python bench.py fanout
+# times making spectrograms+audmages with one decode per track
+#
+# ex4: ~$ python bench.py batch
+# times batched log-mel computation against one track at a time
+#
+# ex5: ~$ python bench.py search
+# times the file search against the old recursive listdir search
+#
+# ex6: ~$ python bench.py dataset
+# times generating a dataset split with copies and with links
+#
+# ex7: ~$ python bench.py sort
+# times sorting images one move at a time against the file plan
+#
+# ex8: ~$ python bench.py pack
+# times a training epoch's input from PNGs and from packed shards
+#
+# ex9: ~$ python bench.py loader
+# measures input stall per training step, 1 loader vs worker processes
+#
+# ex10: ~$ python bench.py cache
+# times 3 epochs of input with and without the decoded image cache
+#
+# ex11: ~$ python bench.py augment
+# times augmenting a batch image by image against the batch augmenter
+#
+# ex12: ~$ python bench.py audmage
+# peak memory and time per track of the old audmage code and the new one
+#
+# ex13: ~$ python bench.py remap
+# times the old remap against the fused one, on a track, a batch and numbers
+#
+# ex14: ~$ python bench.py stream
+# peak memory and time per track loading whole tracks against streaming them
+#
+# ex15: ~$ python bench.py queue
+# drains a work queue with several worker processes, one of them killed,
+# checks every track is done exactly once
+#
+# ex16: ~$ python bench.py rerun
+# runs the default sort and create flow, then reruns, checks the journal
+#
+#############################################################
+
+#Import required libs
+import os    #for file system tools
+import sys   #to read command-line arguments
+import time  #for the timers
+import csv
+import shutil
+import subprocess
+from multiprocessing import Pool, Process, cpu_count
+from functools import partial
+import tempfile
+import wave
+import signal
+import sqlite3
+from collections import Counter
+from random import Random
+
+import numpy as np
+import audmage
+
+GENRES = ['Electronic', 'Experimental', 'Folk', 'Hip-Hop',
+          'Instrumental', 'International', 'Pop', 'Rock']
+CLIP = None #[data, sr] of benchAudmage, forked into its workers (not pickled)
+
+
+###########
+# HELPERS #
+###########
+#Runs func(*args) with stdout silenced (audmage talks a lot)
+#and returns how many seconds it took.
+def timeQuiet(func, *args):
+  devnull = open(os.devnull, 'w')
+  stdout = sys.stdout
+  sys.stdout = devnull
+  try:
+    start = time.time()
+    func(*args)
+    return time.time() - start
+  finally:
+    sys.stdout = stdout
+    devnull.close()
+#END timeQuiet Function
+
+
+#Makes a stereo test clip (two tones and some noise)
+def makeClip(seconds=30, sr=22050, seed=490):
+  rand = np.random.RandomState(seed)
+  t = np.arange(int(seconds * sr)) / float(sr)
+  left = 0.3 * np.sin(2 * np.pi * 220 * t) * np.sin(2 * np.pi * 0.5 * t)
+  right = 0.3 * np.sin(2 * np.pi * 330 * t)
+  clip = np.vstack((left, right)) + 0.05 * rand.randn(2, len(t))
+  return clip.astype(np.float32), sr
+#END makeClip Function
+
+
+#Writes stereo 16 bit .wav files named like FMA tracks
+#(000002.mp3 ...) that librosa can load like the real thing.
+#Returns the list of [path, genre] for TRACKLIST.
+def makeAudioFiles(audioDir, count, seconds=30, sr=44100):
+  if not os.path.isdir(audioDir):
+    os.makedirs(audioDir)
+  tracks = []
+  for i in range(count):
+    clip, sr = makeClip(seconds, sr, seed=i)
+    fpath = audioDir +'/%06d.mp3' % (i + 2)
+    w = wave.open(fpath, 'wb')
+    w.setnchannels(2)
+    w.setsampwidth(2)
+    w.setframerate(sr)
+    w.writeframes((np.clip(clip.T, -1, 1) * 32767).astype('<i2').tostring())
+    w.close()
+    tracks.append([fpath, GENRES[i % len(GENRES)]])
+  return tracks
+#END makeAudioFiles Function
+
+
+#The log-mel matrix doSpect draws for a mono clip
+def makeLogMel(data, sr):
+  stft = np.abs(audmage.librosa.stft(data, n_fft=2048, hop_length=512))
+  mel = audmage.librosa.feature.melspectrogram(sr=sr, S=stft**2)
+  return audmage.librosa.logamplitude(mel)
+#END makeLogMel Function
+
+
+#Reads a PNG back as (height, width, 3) uint8
+def readRGB(imgPath):
+  pixels = audmage.plt.imread(imgPath)
+  return (pixels[:, :, :3] * 255 + 0.5).astype(np.uint8)
+#END readRGB Function
+
+
+#Averages (height, width, 3) pixels over k x k blocks
+def blockMean(pixels, k=8):
+  h = pixels.shape[0] // k * k
+  w = pixels.shape[1] // k * k
+  return pixels[:h, :w].reshape(h // k, k, w // k, k, 3).mean(axis=3).mean(axis=1)
+#END blockMean Function
+
+
+#Writes lut spectrograms of synthetic tracks to sorted/spect/<genre>/
+#and their split manifest dataset/spect.csv (all train)
+def makeSpectSet(images):
+  os.makedirs('dataset')
+  rand = np.random.RandomState(490)
+  rows = []
+  width, height = audmage.IMGSIZE
+  data, sr = makeClip(seconds=30)
+  base = makeLogMel(np.mean(data, axis=0), sr)
+  for i in range(images):
+    genre = GENRES[i % len(GENRES)]
+    logMel = base + 3 * rand.randn(*base.shape) #every image different
+    pixels = audmage.specToPixels(logMel, width, height)
+    if not os.path.isdir('sorted/spect/'+ genre):
+      os.makedirs('sorted/spect/'+ genre)
+    audmage.writePNG('sorted/spect/%s/%06d.png' % (genre, i + 2), pixels)
+    rows.append(['../sorted/spect/%s/%06d.png' % (genre, i + 2), str(i + 2), genre,
+                 sorted(GENRES).index(genre), 'train'])
+  with open('dataset/spect.csv', 'wb') as mfile:
+    writer = csv.writer(mfile)
+    writer.writerow(['path', 'track', 'genre', 'label', 'split'])
+    writer.writerows(rows)
+  return rows
+#END makeSpectSet Function
+
+
+#Clears the audmage globals used by the matching step
+def resetMatch():
+  del audmage.PATHLIST[:]
+  del audmage.TRACKLIST[:]
+  audmage.GINDEX = None
+#END resetMatch Function
+
+
+#Writes a fake tracks.csv with the same layout as the FMA one
+#(3 header rows, track id in col 0, subset in col 32 and
+#genre in col 40) and returns the list of track ids written.
+def makeTracksCsv(csvPath, rows, rand):
+  trackIds = rand.sample(xrange(1, rows * 2), rows)
+  trackIds.sort()
+  cols = 53
+  with open(csvPath, 'wb') as f:
+    writer = csv.writer(f)
+    for h in range(3):
+      writer.writerow(['header'+ str(h)] * cols)
+    for trackId in trackIds:
+      row = ['x'] * cols
+      row[0] = str(trackId)
+      row[32] = rand.choice(['small', 'medium', 'medium', 'large'])
+      row[40] = rand.choice(GENRES)
+      writer.writerow(row)
+  return trackIds
+#END makeTracksCsv Function
+
+
+#The old nested csv-row x path loop, kept here only
+#to show how long matching used to take.
+def legacyMatch(meta, pathList):
+  pathList = list(pathList)
+  for row in meta:
+    for fpath in pathList:
+      fileName = audmage.getTrackName(fpath)
+      if fileName == row[0]:
+        if row[32] == 'small' or row[32] == 'medium':
+          pathList.remove(fpath)
+          break
+    if len(pathList) == 0:
+      break
+#END legacyMatch Function
+
+
+#The old tracks.txt dictionary lookup, kept here only
+#to compare the genre index against.
+def legacyTxtMatch(pathList):
+  genreDict = {}
+  with open('tracks.txt', 'r') as f:
+    for row in f.read().splitlines():
+      tmp2 = row.split(' ')
+      genreDict[tmp2[0]] = tmp2[1]
+  return [genreDict.get(audmage.getTrackName(fpath)) for fpath in pathList]
+#END legacyTxtMatch Function
+
+
+#The old recursive doSearch (os.listdir plus os.path.isdir per entry)
+def legacySearch(dirPath, pathList):
+  if os.path.isdir(dirPath):
+    for item in os.listdir(dirPath):
+      legacySearch(dirPath +'/'+ item, pathList)
+  elif dirPath[-4:] == '.mp3':
+    pathList.append(dirPath)
+  return pathList
+#END legacySearch Function
+
+
+#The old imageSort (doDirs and one move per track)
+def legacySort():
+  for fpath, genre in audmage.TRACKLIST:
+    audmage.DIRSMADE.clear() #doDirs did all its checks every time
+    audmage.doDirs(genre)
+    newPath = 'sorted/spect/'+ genre +'/'+ fpath.split('/')[-1]
+    if not os.path.exists(newPath):
+      shutil.move(fpath, newPath)
+  return True
+#END legacySort Function
+
+
+#The old remap (a temporary array for every step)
+def legacyRemap(x, oMin, oMax, nMin, nMax):
+  oldMin, oldMax = min(oMin, oMax), max(oMin, oMax)
+  newMin, newMax = min(nMin, nMax), max(nMin, nMax)
+  portion = (x-oldMin)*(newMax-newMin)/(oldMax-oldMin)
+  if oldMin != oMin:
+    portion = (oldMax-x)*(newMax-newMin)/(oldMax-oldMin)
+  result = portion + newMin
+  if newMin != nMin:
+    result = newMax - portion
+  return result
+#END legacyRemap Function
+
+
+#The old makeAudmage (float copies at every step, saved by imsave)
+def legacyAudmage(data, sr, savePath):
+  data = data / sr
+  newData = legacyRemap(data, np.amin(data), np.amax(data), 0, 255)
+  if newData.ndim == 1:
+    newData = np.vstack((newData, newData))
+  L = W = int((newData.size / 3) ** 0.5) + 2
+  newData = np.sort(newData, axis=1)
+  newData.resize(L, W, 3)
+  audmage.plt.imsave(savePath, newData, cmap='hot', format='png', dpi=100)
+  return True
+#END legacyAudmage Function
+
+
+#Runs func(*args) in this (forked) process and returns
+#[seconds, peak memory it added in MB] (Linux: the peak
+#is reset through /proc/self/clear_refs first)
+def peakMemory(func, *args):
+  with open('/proc/self/clear_refs', 'w') as f:
+    f.write('5')
+  status = lambda key: [int(line.split()[1]) for line in open('/proc/self/status') if line.startswith(key)][0]
+  base = status('VmRSS:')
+  start = time.time()
+  func(*args)
+  return [time.time() - start, (status('VmHWM:') - base) / 1024.0]
+#END peakMemory Function
+
+
+#Makes an audmage of CLIP with func (makeAudmage or legacyAudmage)
+def clipAudmage(func, savePath):
+  return func(CLIP[0], CLIP[1], savePath)
+#END clipAudmage Function
+
+
+#Makes a track's spectrogram the way doSpect does, the whole
+#track loaded (loadAudio) or streamed (STFTBLOCK)
+def trackSpect(fpath, savePath):
+  if audmage.STFTBLOCK:
+    return audmage.saveSpect(audmage.streamLogMels(fpath, [[2048, 512, 128]])[0], 22050, savePath)
+  data, sr = audmage.loadAudio(fpath)
+  return audmage.makeSpect(data, sr, savePath)
+#END trackSpect Function
+
+
+###################
+# MATCH BENCHMARK #
+###################
+#Times genre matching with the genre index (cold build from
+#tracks.csv, then warm start) against the old tracks.txt
+#lookup, on a synthetic 100k row csv and 25k audio paths.
+def benchMatch(rows=100000, files=25000, legacyFiles=250, lookups=100000):
+  rand = Random(490)
+  workDir = tempfile.mkdtemp(prefix='bench-match-')
+  cwd = os.getcwd()
+  os.chdir(workDir)
+  try:
+    trackIds = makeTracksCsv('tracks.csv', rows, rand)
+    pathList = ['fma/%03d/%06d.mp3' % (t // 1000, t) for t in rand.sample(trackIds, files)]
+
+    def indexMatch():
+      audmage.loadGenreIndex()
+      audmage.matchTracks()
+
+    #Cold start, the index is built from tracks.csv
+    resetMatch()
+    audmage.PATHLIST.extend(pathList)
+    coldTime = timeQuiet(indexMatch)
+    matched = list(audmage.TRACKLIST)
+
+    #Warm start, the index is memory-mapped from disk
+    resetMatch()
+    audmage.PATHLIST.extend(pathList)
+    warmTime = timeQuiet(indexMatch)
+    if not audmage.TRACKLIST == matched:
+      print 'Warning: warm and cold genre matches differ!'
+
+    #Startup (loading the index) alone
+    loadTime = timeQuiet(audmage.loadGenreIndex)
+
+    #Lookup rate of the index alone
+    names = [str(rand.choice(trackIds)) for i in xrange(lookups)]
+    lookupTime = timeQuiet(audmage.lookupGenres, names)
+
+    #Old tracks.txt dictionary, only matched tracks are listed in it
+    with open('tracks.txt', 'w') as f:
+      for fpath, genre in matched:
+        print >> f, audmage.getTrackName(fpath), genre
+    txtTime = timeQuiet(legacyTxtMatch, [t[0] for t in matched])
+
+    #Old nested loop on a small sample, scaled up to the full path count
+    iFile = open('tracks.csv', 'rb')
+    legacyTime = timeQuiet(legacyMatch, csv.reader(iFile), pathList[:legacyFiles])
+    iFile.close()
+    legacyTime = legacyTime * files / float(legacyFiles)
+  finally:
+    resetMatch()
+    os.chdir(cwd)
+    shutil.rmtree(workDir)
+
+  print 'Genre matching: '+ str(rows) +' csv rows, '+ str(files) +' files ('+ str(len(matched)) +' matched)'
+  print '  genre index (build):   %8.3f s' % coldTime
+  print '  genre index (warm):    %8.3f s (load + matchTracks)' % warmTime
+  print '  genre index (load):    %8.3f s' % loadTime
+  print '  genre index lookups:   %8.0f /s' % (lookups / max(lookupTime, 1e-9))
+  print '  tracks.txt (old):      %8.3f s' % txtTime
+  print '  tracks.csv (old loop): %8.3f s (estimated from %d files)' % (legacyTime, legacyFiles)
+  return True
+#END benchMatch Function
+
+
+####################
+# RENDER BENCHMARK #
+####################
+#Times saveSpect() with the matplotlib renderer against the
+#lookup table renderer (PNG at two compression levels and
+#raw .npy), then checks how close the pixels are.
+def benchRender(images=20):
+  clip, sr = makeClip()
+  logMel = makeLogMel(audmage.librosa.to_mono(clip), sr)
+  workDir = tempfile.mkdtemp(prefix='bench-render-')
+  old = (audmage.RENDER, audmage.PNGLEVEL, audmage.RAWNPY, audmage.IMGSIZE)
+  try:
+    def render(mode, level, raw):
+      audmage.RENDER, audmage.PNGLEVEL, audmage.RAWNPY = mode, level, raw
+      ext = '.npy' if raw else '.png'
+      paths = [workDir +'/'+ mode + str(level) +'-'+ str(i) + ext for i in range(images)]
+      start = time.time()
+      for imgPath in paths:
+        audmage.saveSpect(logMel, sr, imgPath)
+      return images / (time.time() - start), paths[0]
+
+    print 'Spectrogram rendering: '+ str(images) +' images of '+ str(logMel.shape)
+    mplRate, mplPath = render('mpl', 6, False)
+    print '  mpl (specshow):   %7.1f images/s' % mplRate
+    for mode, level, raw in [('lut', 6, False), ('lut', 1, False), ('lut', 6, True)]:
+      rate, lutPath = render(mode, level, raw)
+      label = 'lut (.npy)' if raw else 'lut (png '+ str(level) +')'
+      print '  %-16s  %7.1f images/s (%.1fx)' % (label +':', rate, rate / mplRate)
+
+    #Pixel agreement with the matplotlib output. The mpl image has
+    #a white margin and black axes frame around the plot, so compare
+    #only the inside of the frame against a lut image of that size.
+    mplPixels = readRGB(mplPath).astype(np.int16)
+    dark = mplPixels.sum(axis=2) < 60
+    frameRows = np.where(dark.mean(axis=1) > 0.9)[0]
+    frameCols = np.where(dark.mean(axis=0) > 0.9)[0]
+    inner = mplPixels[frameRows[0] + 1:frameRows[-1], frameCols[0] + 1:frameCols[-1]]
+    audmage.RENDER, audmage.RAWNPY = 'lut', False
+    audmage.IMGSIZE = (inner.shape[1], inner.shape[0])
+    audmage.saveSpect(logMel, sr, workDir +'/inner.png')
+    lutPixels = readRGB(workDir +'/inner.png').astype(np.int16)
+    diff = np.abs(inner - lutPixels).max(axis=2)
+    print '  pixel agreement:  %dx%d plot area, mean abs diff %.2f, %.1f%% within 8 levels' % (
+      inner.shape[1], inner.shape[0], diff.mean(), 100.0 * np.mean(diff <= 8))
+    #Noise in the spectrogram lands on slightly different pixels,
+    #so also compare 8x8 pixel block averages.
+    diff = np.abs(blockMean(inner) - blockMean(lutPixels)).max(axis=2)
+    print '  block agreement:  8x8 blocks, mean abs diff %.2f, %.1f%% within 8 levels' % (
+      diff.mean(), 100.0 * np.mean(diff <= 8))
+  finally:
+    audmage.RENDER, audmage.PNGLEVEL, audmage.RAWNPY, audmage.IMGSIZE = old
+    shutil.rmtree(workDir)
+  return True
+#END benchRender Function
+
+
+####################
+# FANOUT BENCHMARK #
+####################
+#Times making spectrograms and audmages the old way (doSpect
+#then doAudmage, two decodes per track) against doTrack
+#(one decode per track), on one process.
+def benchFanout(tracks=3):
+  workDir = tempfile.mkdtemp(prefix='bench-fanout-')
+  cwd = os.getcwd()
+  os.chdir(workDir)
+  old = (audmage.SPECT, audmage.AUDMAGE, audmage.VERBOSE)
+  try:
+    trackList = makeAudioFiles('fma/000', tracks)
+    audmage.SPECT = audmage.AUDMAGE = True
+    audmage.VERBOSE = False
+    for fpath, genre in trackList:
+      audmage.doDirs(genre)
+
+    def separate():
+      for track in trackList:
+        audmage.doSpect(track)
+      for track in trackList:
+        audmage.doAudmage(track)
+    def fanout():
+      for track in trackList:
+        audmage.doTrack(track)
+
+    sepTime = timeQuiet(separate)
+    shutil.rmtree('sorted')
+    for fpath, genre in trackList:
+      audmage.doDirs(genre)
+    fanTime = timeQuiet(fanout)
+  finally:
+    audmage.SPECT, audmage.AUDMAGE, audmage.VERBOSE = old
+    os.chdir(cwd)
+    shutil.rmtree(workDir)
+
+  print 'Spectrogram + audmage creation: '+ str(tracks) +' tracks (30s, 44.1kHz stereo)'
+  print '  doSpect + doAudmage: %7.2f s/track' % (sepTime / tracks)
+  print '  doTrack (1 decode):  %7.2f s/track (%.0f%% less time)' % (
+    fanTime / tracks, 100.0 * (1 - fanTime / sepTime))
+  return True
+#END benchFanout Function
+
+
+###################
+# BATCH BENCHMARK #
+###################
+#Times log-mel computation one track at a time (the librosa
+#calls in makeSpect) against batchLogMel at a few batch sizes,
+#and checks the results match.
+def benchBatch(tracks=16, batchSizes=[1, 4, 8, 16]):
+  clips = []
+  for i in range(tracks):
+    clip, sr = makeClip(seed=i)
+    clips.append(audmage.librosa.to_mono(clip))
+
+  start = time.time()
+  expected = [makeLogMel(clip, sr) for clip in clips]
+  baseRate = tracks / (time.time() - start)
+  print 'Log-mel computation: '+ str(tracks) +' tracks (30s, 22.05kHz)'
+  print '  per track (librosa):  %6.1f tracks/s' % baseRate
+
+  for size in batchSizes:
+    start = time.time()
+    results = []
+    for i in range(0, tracks, size):
+      results.extend(audmage.batchLogMel(np.vstack(clips[i:i + size]), sr))
+    rate = tracks / (time.time() - start)
+    worst = max(np.abs(a - b).max() for a, b in zip(expected, results))
+    print '  batch of %-2d:           %6.1f tracks/s (%.1fx), max diff %.2g dB' % (
+      size, rate, rate / baseRate, worst)
+  return True
+#END benchBatch Function
+
+
+####################
+# SEARCH BENCHMARK #
+####################
+#Times the search of an fma-like tree (dirs 000-155 of empty
+#.mp3 files) with the old recursive search and the walker, and
+#how long until the first file is found (streamed creation).
+#The tree is in the page cache, a cold network file system
+#gains more from the saved stat calls.
+def benchSearch(dirs=156, files=160):
+  workDir = tempfile.mkdtemp(prefix='bench-search-')
+  old = audmage.CREATE
+  try:
+    for d in range(dirs):
+      os.mkdir(workDir +'/%03d' % d)
+      for f in range(files):
+        open(workDir +'/%03d/%06d.mp3' % (d, d * 1000 + f), 'w').close()
+    audmage.CREATE = True
+
+    start = time.time()
+    expected = legacySearch(workDir, [])
+    legacyTime = time.time() - start
+
+    start = time.time()
+    del audmage.PATHLIST[:]
+    audmage.doSearch(workDir)
+    walkTime = time.time() - start
+    found = sorted(audmage.PATHLIST) == sorted(expected)
+    del audmage.PATHLIST[:]
+
+    start = time.time()
+    next(audmage.searchFiles(workDir))
+    firstTime = time.time() - start
+  finally:
+    audmage.CREATE = old
+    shutil.rmtree(workDir)
+
+  print 'File search: '+ str(dirs * files) +' files in '+ str(dirs) +' dirs (warm cache)'
+  print '  old recursive listdir: %6.3f s' % legacyTime
+  print '  walker:                %6.3f s (%.1fx, %s), same files: %s' % (
+    walkTime, legacyTime / walkTime, 'scandir' if audmage.scandir != None else 'listdir', found)
+  print '  first file found:      %6.3f s' % firstTime
+  return True
+#END benchSearch Function
+
+
+#####################
+# DATASET BENCHMARK #
+#####################
+#Times generateSet on a sorted set of images (random bytes, about
+#the size of lut spectrograms) copying them and with each --link
+#mode, and the disk space the dataset takes on top of sorted/.
+def benchDataset(images=23000, size=16384):
+  workDir = tempfile.mkdtemp(prefix='bench-dataset-')
+  cwd = os.getcwd()
+  os.chdir(workDir)
+  old = (audmage.SPECT, audmage.AUDMAGE, audmage.GDATA, audmage.LINKMODE)
+  results = []
+  try:
+    rand = Random(490)
+    for i in range(images):
+      genre = GENRES[i % len(GENRES)]
+      if not os.path.isdir('sorted/spect/'+ genre):
+        os.makedirs('sorted/spect/'+ genre)
+      with open('sorted/spect/%s/%d.png' % (genre, i + 2), 'wb') as f:
+        f.write(os.urandom(size))
+    audmage.SPECT = audmage.GDATA = True
+    audmage.AUDMAGE = False
+
+    for mode in [None, 'hard', 'sym', 'reflink']:
+      shutil.rmtree('dataset', True)
+      os.mkdir('dataset')
+      audmage.LINKMODE = mode
+      audmage.LINKCOPIES = 0
+      seconds = timeQuiet(audmage.generateSet, .8, .1, .1)
+      extra = 0 #bytes not shared with sorted/
+      for path, dirs, files in os.walk('dataset/spect'):
+        for name in files:
+          info = os.lstat(path +'/'+ name)
+          if info.st_nlink == 1:
+            extra += info.st_blocks * 512
+      results.append([mode or 'copy', seconds, extra, audmage.LINKCOPIES])
+  finally:
+    audmage.SPECT, audmage.AUDMAGE, audmage.GDATA, audmage.LINKMODE = old
+    os.chdir(cwd)
+    shutil.rmtree(workDir)
+
+  print 'Dataset generation: '+ str(images) +' images of '+ str(size // 1024) +'KB'
+  for mode, seconds, extra, copies in results:
+    note = ' ('+ str(copies) +' copied, could not link)' if copies else ''
+    print '  %-8s %6.2f s, %7.1f MB extra disk%s' % (mode +':', seconds, extra / 1e6, note)
+  return True
+#END benchDataset Function
+
+
+##################
+# SORT BENCHMARK #
+##################
+#Sorts unsorted images (moves) one at a time like the old
+#imageSort and with the planned file operations on 1 and
+#FILETHREADS threads. Local disk in the page cache, on network
+#storage the threads overlap the round trips.
+def benchSort(images=25000):
+  workDir = tempfile.mkdtemp(prefix='bench-sort-')
+  cwd = os.getcwd()
+  os.chdir(workDir)
+  old = (audmage.SPECT, audmage.GDATA, audmage.FILETHREADS)
+  results = []
+  try:
+    audmage.SPECT = True
+    audmage.GDATA = False
+    tracks = [['images/%06d.png' % (i + 2), GENRES[i % len(GENRES)]] for i in range(images)]
+    for threads, func in [[0, legacySort], [1, audmage.imageSort],
+                          [audmage.FILETHREADS, audmage.imageSort]]:
+      shutil.rmtree('sorted', True)
+      os.mkdir('images')
+      for fpath, genre in tracks:
+        open(fpath, 'w').close()
+      audmage.TRACKLIST[:] = tracks
+      audmage.DIRSMADE.clear()
+      audmage.FILETHREADS = threads
+      results.append([threads, timeQuiet(func)])
+      moved = sum(len(files) for path, dirs, files in os.walk('sorted'))
+      if moved != images:
+        print 'Sort benchmark: only '+ str(moved) +' of '+ str(images) +' images were sorted'
+      shutil.rmtree('images')
+  finally:
+    audmage.SPECT, audmage.GDATA, audmage.FILETHREADS = old
+    del audmage.TRACKLIST[:]
+    os.chdir(cwd)
+    shutil.rmtree(workDir)
+
+  print 'Image sort: '+ str(images) +' moves'
+  for threads, seconds in results:
+    name = 'one at a time:' if threads == 0 else 'plan, '+ str(threads) +' thread'+ ('s:' if threads > 1 else ':')
+    print '  %-16s %6.2f s (%.0f files/s)' % (name, seconds, images / seconds)
+  return True
+#END benchSort Function
+
+
+##################
+# PACK BENCHMARK #
+##################
+#Times one epoch of dlag-p.py's input (no model): the PNGs
+#decoded and resized by the manifest iterator against the packed
+#uint8 shards, rescale only (validation) and with dlag-p's
+#augmentation (training). Lut spectrograms of synthetic tracks.
+def benchPack(images=240, batch=16):
+  import dlagdata #keras, only for this benchmark
+  from keras.preprocessing.image import ImageDataGenerator
+  workDir = tempfile.mkdtemp(prefix='bench-pack-')
+  cwd = os.getcwd()
+  os.chdir(workDir)
+  results = []
+  try:
+    makeSpectSet(images)
+    width, height = audmage.IMGSIZE
+    size = (width, height) #dlag-p's target_size
+    split = dlagdata.readManifest('dataset/spect.csv')
+    packTime = timeQuiet(dlagdata.packManifest, 'dataset/spect.csv', 'packed', size)
+    pack = dlagdata.readPack('packed')
+    plain = ImageDataGenerator(rescale=1. / 255)
+    augment = ImageDataGenerator(rescale=1. / 255, shear_range=0.2,
+                                 zoom_range=0.2, horizontal_flip=True)
+    for label, gen in [['rescale', plain], ['augmented', augment]]:
+      sources = [['png', dlagdata.flowFromManifest(gen, split, 'train', target_size=size, batch_size=batch)],
+                 ['packed', dlagdata.flowFromPack(gen, pack, 'train', batch_size=batch)]]
+      for name, source in sources:
+        start = time.time()
+        for i in range(len(source)):
+          source[i]
+        results.append([label, name, time.time() - start])
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(workDir)
+
+  print 'Training input: '+ str(images) +' spectrograms '+ str(width) +'x'+ str(height) +', one epoch, batches of '+ str(batch)
+  print '  packing (once): %6.2f s' % packTime
+  for label, name, seconds in results:
+    print '  %-9s %-7s %6.2f s (%.0f images/s)' % (label, name +':', seconds, images / seconds)
+  return True
+#END benchPack Function
+
+
+####################
+# LOADER BENCHMARK #
+####################
+#Trains a small model (cheap steps, so the input shows) for one
+#epoch on PNG spectrograms with dlag-p's augmentation, loading
+#with 1 worker thread (the old workers=1) and with worker
+#processes, and reports the input stall per step (StallTimer).
+def benchLoader(images=160, batch=16, workers=max(2, cpu_count())):
+  import dlagdata #keras, only for this benchmark
+  from keras.preprocessing.image import ImageDataGenerator
+  from keras.models import Sequential
+  from keras.layers import Conv2D, GlobalAveragePooling2D, Dense
+  workDir = tempfile.mkdtemp(prefix='bench-loader-')
+  cwd = os.getcwd()
+  os.chdir(workDir)
+  results = []
+  try:
+    makeSpectSet(images)
+    size = audmage.IMGSIZE #dlag-p's target_size
+    split = dlagdata.readManifest('dataset/spect.csv')
+    augment = ImageDataGenerator(rescale=1. / 255, shear_range=0.2,
+                                 zoom_range=0.2, horizontal_flip=True)
+    for count, multi in [[1, False], [workers, True]]:
+      model = Sequential()
+      model.add(Conv2D(8, (3, 3), strides=(4, 4), activation='relu', input_shape=size + (3,)))
+      model.add(GlobalAveragePooling2D())
+      model.add(Dense(len(GENRES), activation='softmax'))
+      model.compile(loss='categorical_crossentropy', optimizer='sgd')
+      source = dlagdata.flowFromManifest(augment, split, 'train', target_size=size, batch_size=batch)
+      timer = dlagdata.StallTimer()
+      start = time.time()
+      timeQuiet(partial(model.fit_generator, source, steps_per_epoch=len(source), epochs=1,
+                        verbose=0, callbacks=[timer], max_queue_size=10,
+                        workers=count, use_multiprocessing=multi))
+      results.append([count, multi, timer.history[-1][1], timer.history[-1][2], time.time() - start])
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(workDir)
+
+  print 'Training input: '+ str(images) +' PNG spectrograms, augmented, batches of '+ str(batch) +', '+ str(cpu_count()) +' cores'
+  for count, multi, stall, step, seconds in results:
+    name = str(count) +(' processes:' if multi else ' thread:')
+    print '  %-12s stall %6.1f ms/step, compute %6.1f ms/step, epoch %5.2f s' % (name, stall * 1000, step * 1000, seconds)
+  return True
+#END benchLoader Function
+
+
+###################
+# CACHE BENCHMARK #
+###################
+#Reads 3 epochs of PNG spectrograms (rescale only, the decoding
+#shows) without a cache, with a cache big enough for all of them
+#and with one for half, checks the cached batches are the same.
+def benchCache(images=160, batch=16, epochs=3):
+  import dlagdata #keras, only for this benchmark
+  from keras.preprocessing.image import ImageDataGenerator
+  workDir = tempfile.mkdtemp(prefix='bench-cache-')
+  cwd = os.getcwd()
+  os.chdir(workDir)
+  results = []
+  try:
+    makeSpectSet(images)
+    size = audmage.IMGSIZE #dlag-p's target_size
+    split = dlagdata.readManifest('dataset/spect.csv')
+    plain = ImageDataGenerator(rescale=1. / 255)
+    imageBytes = size[0] * size[1] * 3
+    first = None
+    for name, budget in [['no cache', 0], ['cache, all', images * imageBytes],
+                         ['cache, half', images * imageBytes // 2]]:
+      cache = dlagdata.ImageCache(budget) if budget else None
+      source = dlagdata.flowFromManifest(plain, split, 'train', target_size=size,
+                                         batch_size=batch, seed=1, cache=cache)
+      times = []
+      same = True
+      for epoch in range(epochs):
+        start = time.time()
+        for i in range(len(source)):
+          x, y = source[i]
+          if epoch == 0 and i == 0:
+            same = first is None or np.array_equal(x, first)
+            first = x if first is None else first
+        times.append(time.time() - start)
+        source.on_epoch_end()
+      results.append([name, times, str(cache) if cache else '', same])
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(workDir)
+
+  print 'Image cache: '+ str(images) +' PNG spectrograms, '+ str(epochs) +' epochs'
+  for name, times, stats, same in results:
+    print '  %-12s %s s/epoch%s' % (name +':', ', '.join('%.2f' % t for t in times), '' if same else ' (batches differ!)')
+    if stats:
+      print '               '+ stats
+  return True
+#END benchCache Function
+
+
+#####################
+# AUGMENT BENCHMARK #
+#####################
+#Times dlag-p's training augmentation (rescale, shear, zoom and
+#flip) on a batch of spectrogram sized images: ImageDataGenerator
+#image by image against BatchAugmenter on the whole batch, and
+#the time/frequency masks alone. Checks the batch transform gives
+#keras' apply_transform images for the same parameters.
+def benchAugment(batch=16, rounds=5):
+  import dlagdata #keras, only for this benchmark
+  from keras.preprocessing.image import ImageDataGenerator
+  width, height = audmage.IMGSIZE
+  rand = np.random.RandomState(490)
+  x = (rand.rand(batch, height, width, 3) * 255).astype(np.float32)
+  perImage = ImageDataGenerator(rescale=1. / 255, shear_range=0.2,
+                                zoom_range=0.2, horizontal_flip=True)
+  batched = dlagdata.BatchAugmenter(rescale=1. / 255, shear_range=0.2,
+                                    zoom_range=0.2, horizontal_flip=True)
+  masks = dlagdata.BatchAugmenter(rescale=1. / 255, time_mask=0.1,
+                                  freq_mask=0.1, mask_count=2)
+
+  def runPerImage(seed):
+    np.random.seed(seed)
+    for i in range(batch):
+      perImage.standardize(perImage.random_transform(x[i]))
+
+  results = []
+  for name, func in [['per image', runPerImage],
+                     ['batch', lambda seed: batched.augmentBatch(x.copy(), np.random.RandomState(seed))],
+                     ['masks', lambda seed: masks.augmentBatch(x.copy(), np.random.RandomState(seed))]]:
+    start = time.time()
+    for seed in range(rounds):
+      func(seed)
+    results.append([name, (time.time() - start) / rounds])
+
+  #Same parameters through keras, one image at a time
+  shears = rand.uniform(-0.2, 0.2, batch)
+  zooms = rand.uniform(0.8, 1.2, (batch, 2))
+  flips = rand.rand(batch) < 0.5
+  out = dlagdata.affineBatch(x.copy(), shears, zooms, flips)
+  worst = 0
+  for i in range(batch):
+    params = {'shear': shears[i], 'zx': zooms[i, 0], 'zy': zooms[i, 1], 'flip_horizontal': flips[i]}
+    worst = max(worst, np.abs(perImage.apply_transform(x[i], params) - out[i]).max())
+  same = np.array_equal(batched.augmentBatch(x.copy(), np.random.RandomState(1)),
+                        batched.augmentBatch(x.copy(), np.random.RandomState(1)))
+
+  print 'Augmentation: batches of '+ str(batch) +' images '+ str(width) +'x'+ str(height) +', '+ str(rounds) +' rounds'
+  for name, seconds in results:
+    print '  %-10s %7.1f ms/batch (%.0f images/s)' % (name +':', seconds * 1000, batch / seconds)
+  print '  largest difference from keras (0-255): %.4f, same seed same batch: %s' % (worst, same)
+  return True
+#END benchAugment Function
+
+
+#####################
+# AUDMAGE BENCHMARK #
+#####################
+#Peak memory (added to the decoded audio) and time per track of
+#the old audmage code against makeAudmage, on stereo 22.05kHz
+#clips of a normal (30s) and a long (10 min, fma_full) track.
+#Each run is in a new process, the peaks don't mix, and checks
+#the pixels are the same (old PNG read back, less the padding).
+def benchAudmage(lengths=[30, 600], runs=3):
+  workDir = tempfile.mkdtemp(prefix='bench-audmage-')
+  results = []
+  try:
+    for seconds in lengths:
+      global CLIP
+      CLIP = makeClip(seconds, 22050)
+      data = CLIP[0]
+      for name, func in [['old', legacyAudmage], ['new', audmage.makeAudmage]]:
+        savePath = workDir +'/'+ name +'.png'
+        times, peaks = [], []
+        for run in range(runs):
+          pool = Pool(1)
+          took, peak = pool.apply(peakMemory, (clipAudmage, func, savePath))
+          pool.close()
+          pool.join()
+          times.append(took)
+          peaks.append(peak)
+        results.append([seconds, name, min(times), max(peaks)])
+      old = audmage.plt.imread(workDir +'/old.png')[:, :, :3].ravel()[:data.size]
+      new = audmage.plt.imread(workDir +'/new.png')[:, :, :3].ravel()[:data.size]
+      results[-1].append(np.array_equal(old, new))
+  finally:
+    shutil.rmtree(workDir)
+
+  print 'Audmages: stereo clips at 22.05kHz, '+ str(runs) +' runs each (best time, highest peak)'
+  audioMB = lambda seconds: seconds * 22050 * 2 * 4 / 1e6
+  for row in results:
+    same = '' if len(row) < 5 else ('  (same pixels)' if row[4] else '  (pixels differ!)')
+    print '  %4ds (%5.1f MB audio) %s: %6.2f s/track, peak +%6.1f MB%s' % (row[0], audioMB(row[0]), row[1], row[2], row[3], same)
+  return True
+#END benchAudmage Function
+
+
+###################
+# REMAP BENCHMARK #
+###################
+#Times remap the old way (legacyRemap) against the fused one,
+#with a new array and in place (out=): a 30s stereo track
+#(float32), a batch of tracks each remapped from its own range
+#(one call, against a call per track) and 100k single numbers.
+def benchRemap(tracks=16, rounds=10, numbers=100000):
+  data = makeClip(30, 22050)[0]
+  batch = np.vstack([makeClip(30, 22050, seed=i)[0][0] for i in range(tracks)])
+  lows = batch.min(axis=1)[:, np.newaxis]
+  highs = batch.max(axis=1)[:, np.newaxis]
+  low, high = data.min(), data.max()
+  track = np.empty_like(data)
+  out = np.empty_like(batch)
+
+  def oldBatch():
+    for i in range(tracks):
+      legacyRemap(batch[i], lows[i, 0], highs[i, 0], 0, 255)
+  def oldNumbers():
+    for i in range(numbers):
+      legacyRemap(0.25, -1.0, 1.0, 0, 255)
+  def newNumbers():
+    for i in range(numbers):
+      audmage.remap(0.25, -1.0, 1.0, 0, 255)
+
+  cases = [['track', 'old', lambda: legacyRemap(data, low, high, 0, 255), rounds],
+           ['track', 'new', lambda: audmage.remap(data, low, high, 0, 255), rounds],
+           ['track', 'new, out=', lambda: audmage.remap(data, low, high, 0, 255, out=track), rounds],
+           ['track', 'reversed, out=', lambda: audmage.remap(data, high, low, 255, 0, out=track), rounds],
+           ['batch', 'old, per track', oldBatch, rounds],
+           ['batch', 'new, one call', lambda: audmage.remap(batch, lows, highs, 0, 255, out=out), rounds],
+           ['numbers', 'old', oldNumbers, 1],
+           ['numbers', 'new', newNumbers, 1]]
+  results = []
+  for case, name, func, count in cases:
+    start = time.time()
+    for i in range(count):
+      func()
+    results.append([case, name, (time.time() - start) / count])
+  worst = np.abs(audmage.remap(data, low, high, 0, 255) - legacyRemap(data, low, high, 0, 255)).max()
+
+  print 'Remap: 30s stereo track ('+ str(data.size) +' float32), batch of '+ str(tracks) +' mono tracks, '+ str(numbers) +' numbers'
+  for case, name, seconds in results:
+    print '  %-8s %-16s %8.2f ms' % (case +':', name +':', seconds * 1000)
+  print '  largest difference from the old remap (0-255): %.6f' % worst
+  return True
+#END benchRemap Function
+
+
+####################
+# STREAM BENCHMARK #
+####################
+#Checks streamed log-mels against doSpect's (makeLogMel) on 30s
+#44.1kHz stereo files cut into blocks of a few sizes, then the
+#peak memory (over the interpreter) and time per track loading
+#whole tracks against streaming them, on long 22.05kHz tracks.
+#Spectrograms are saved as features so the renderer doesn't
+#weigh in. Each run is in a new process, the peaks don't mix.
+def benchStream(tracks=3, blocks=[1, 5, 30], lengths=[60, 600], block=30, maxFrames=4096):
+  workDir = tempfile.mkdtemp(prefix='bench-stream-')
+  stftBlock, maxFrames0, features = audmage.STFTBLOCK, audmage.MAXFRAMES, audmage.FEATURES
+  matches = []
+  results = []
+  try:
+    audmage.FEATURES = True
+    clips = makeAudioFiles(workDir +'/clips', tracks, 30, 44100)
+    for seconds in blocks:
+      audmage.STFTBLOCK = seconds
+      worst = 0.0
+      for fpath, genre in clips:
+        data, sr = audmage.librosa.load(fpath, sr=22050)
+        logMel = audmage.streamLogMels(fpath, [[2048, 512, 128]])[0]
+        worst = max(worst, np.abs(logMel - makeLogMel(data, sr)).max())
+      matches.append([seconds, worst])
+
+    for seconds in lengths:
+      fpath = makeAudioFiles(workDir +'/long%d' % seconds, 1, seconds, 22050)[0][0]
+      for name, stft, frames in [['loaded', 0, 0], ['streamed', block, 0], ['streamed, max frames', block, maxFrames]]:
+        audmage.STFTBLOCK, audmage.MAXFRAMES = stft, frames
+        pool = Pool(1)
+        took, peak = pool.apply(peakMemory, (trackSpect, fpath, workDir +'/spect.npy'))
+        pool.close()
+        pool.join()
+        shape = np.load(workDir +'/spect.npy').shape
+        results.append([seconds, name, took, peak, shape])
+  finally:
+    audmage.STFTBLOCK, audmage.MAXFRAMES, audmage.FEATURES = stftBlock, maxFrames0, features
+    shutil.rmtree(workDir)
+
+  print 'Streamed log-mels against doSpect\'s, '+ str(tracks) +' 30s stereo 44.1kHz tracks'
+  for seconds, worst in matches:
+    print '  %2ds blocks: largest difference %.6f dB' % (seconds, worst)
+  print 'Spectrograms of stereo 22.05kHz tracks, '+ str(block) +'s blocks (peak memory over the interpreter)'
+  for seconds, name, took, peak, shape in results:
+    print '  %4ds %-22s %6.2f s/track, peak +%6.1f MB, %s' % (seconds, name +':', took, peak, 'x'.join(map(str, shape)))
+  return True
+#END benchStream Function
+
+
+###################
+# QUEUE BENCHMARK #
+###################
+#Runs in a worker process: drains the work queue (drainQueue)
+#with every track taking at least hold seconds, and appends
+#the path of each track it makes to logPath.
+def queueWorker(hold, logPath):
+  makeTrack = audmage.doTrack
+  def slowTrack(trackL):
+    time.sleep(hold)
+    made = makeTrack(trackL)
+    if made:
+      with open(logPath, 'a') as f:
+        f.write(trackL[0] +'\n')
+    return made
+  audmage.doTrack = slowTrack #drainQueue calls it by name
+  sys.stdout = open(os.devnull, 'w')
+  audmage.drainQueue(0)
+#END queueWorker Function
+
+
+#Tests the work queue on this host against a temporary SQLite
+#queue of synthetic tracks: a worker leases a track and is
+#killed, then several worker processes drain the queue, each
+#track taking longer than a lease (so the leases must be renewed).
+#Checks every track ends 'done', made exactly once, and the
+#killed worker's track was handed out again.
+def benchQueue(tracks=12, workers=3, lease=2, hold=3):
+  workDir = tempfile.mkdtemp(prefix='bench-queue-')
+  cwd = os.getcwd()
+  saved = [audmage.QUEUEFILE, audmage.LEASETIME, audmage.SPECT, audmage.FEATURES,
+           audmage.JOURNALFILE, audmage.TRACKLIST]
+  try:
+    os.chdir(workDir) #the workers make sorted/ here
+    audmage.TRACKLIST = makeAudioFiles(workDir +'/fma/000', tracks, 5, 22050)
+    audmage.QUEUEFILE = workDir +'/jobs.db'
+    audmage.LEASETIME = lease
+    audmage.SPECT, audmage.FEATURES, audmage.JOURNALFILE = True, True, None
+    timeQuiet(audmage.publishTracks)
+    db = audmage.openQueue(audmage.QUEUEFILE)
+    logPath = workDir +'/made.txt'
+
+    #A worker that dies holding a lease
+    victim = Process(target=queueWorker, args=(3600, logPath))
+    victim.start()
+    while db.execute("SELECT COUNT(*) FROM tasks WHERE state='leased'").fetchone()[0] == 0:
+      time.sleep(0.05)
+    lost = db.execute("SELECT path FROM tasks WHERE state='leased'").fetchone()[0]
+    os.kill(victim.pid, signal.SIGKILL)
+    victim.join()
+
+    start = time.time()
+    procs = [Process(target=queueWorker, args=(hold, logPath)) for i in range(workers)]
+    for proc in procs:
+      proc.start()
+    for proc in procs:
+      proc.join()
+    seconds = time.time() - start
+
+    counts = audmage.queueCounts(db)
+    tries = dict(db.execute('SELECT path, tries FROM tasks').fetchall())
+    db.close()
+    made = Counter(open(logPath).read().split())
+    images = sum(len(files) for path, dirs, files in os.walk(workDir +'/sorted/spect'))
+  finally:
+    os.chdir(cwd)
+    [audmage.QUEUEFILE, audmage.LEASETIME, audmage.SPECT, audmage.FEATURES,
+     audmage.JOURNALFILE, audmage.TRACKLIST] = saved
+    shutil.rmtree(workDir)
+
+  once = sorted(made.values()) == [1] * tracks
+  again = tries[lost] == 2 and made[lost] == 1
+  renewed = all(count == 1 for fpath, count in tries.items() if fpath != lost)
+  print 'Work queue: '+ str(tracks) +' tracks, '+ str(workers) +' workers + 1 killed, '+ str(lease) +'s leases, '+ str(hold) +'s per track'
+  print '  drained in %.1f s, %d images, states: %s' % (seconds, images, counts)
+  print '  every track done exactly once:        '+ ('yes' if once and counts == {'done': tracks} else 'NO')
+  print '  killed worker\'s track handed out again: '+ ('yes' if again else 'NO')
+  print '  leases renewed (no track leased twice): '+ ('yes' if renewed else 'NO')
+  return once and again and renewed
+#END benchQueue Function
+
+
+###################
+# RERUN BENCHMARK #
+###################
+#Returns the journal's {status: images} of a work dir
+def journalCounts(workDir):
+  if not os.path.isfile(workDir +'/journal.db'):
+    return {}
+  db = sqlite3.connect(workDir +'/journal.db')
+  counts = dict(db.execute('SELECT status, COUNT(*) FROM images GROUP BY status').fetchall())
+  db.close()
+  return counts
+#END journalCounts Function
+
+
+#Runs audmage.py the default way on synthetic tracks, one of them
+#a broken file: 'audio create spect' sorts the audio (moves it)
+#then creates from the old paths, then 'sorted/audio create spect'
+#makes the images, then the broken track is fixed and the same
+#command is run again. Checks the moved audio isn't journaled as
+#failed, the failed image is retried without --retry-failed and
+#the images already done are skipped.
+def benchRerun(tracks=8):
+  workDir = tempfile.mkdtemp(prefix='bench-rerun-')
+  script = os.path.abspath(audmage.__file__).replace('.pyc', '.py')
+  runs = [['fma audio create spect', ['fma', 'audio']],
+          ['sorted/audio create spect', ['sorted/audio']],
+          ['(broken track fixed) again', ['sorted/audio']],
+          ['again', ['sorted/audio']]]
+  results = []
+  try:
+    trackList = makeAudioFiles(workDir +'/fma/000', tracks, 5)
+    with open(workDir +'/tracks.txt', 'w') as f:
+      for fpath, genre in trackList:
+        f.write(audmage.getTrackName(fpath) +' '+ genre +'\n')
+    broken, genre = trackList[0]
+    with open(broken, 'wb') as f:
+      f.write('not audio' * 100)
+
+    for name, args in runs:
+      if name.startswith('(broken'):
+        fixed = makeAudioFiles(workDir +'/fixed', 1, 5)[0][0]
+        shutil.move(fixed, workDir +'/sorted/audio/'+ genre +'/'+ os.path.basename(broken))
+      devnull = open(os.devnull, 'w')
+      start = time.time()
+      subprocess.call([sys.executable, '-W', 'ignore', script] + args + ['create', 'spect', '--render=lut'],
+                      cwd=workDir, stdout=devnull, stderr=devnull)
+      seconds = time.time() - start
+      devnull.close()
+      made = sum(len(files) for path, dirs, files in os.walk(workDir +'/sorted/spect'))
+      results.append([name, seconds, made, journalCounts(workDir)])
+  finally:
+    shutil.rmtree(workDir)
+
+  print 'Reruns: '+ str(tracks) +' tracks (1 broken, fixed before the 3rd run), create spect --render=lut'
+  for name, seconds, made, counts in results:
+    print '  %-28s %5.1f s, %2d images, journal %d done %d failed' % (name +':', seconds, made, counts.get('done', 0), counts.get('failed', 0))
+  ok = (results[0][3] == {} and results[1][2] == tracks - 1 and results[1][3].get('failed') == 1
+        and results[2][2] == tracks and results[2][3] == {'done': tracks} and results[3][3] == {'done': tracks})
+  print '  moved audio not failed, failed image retried, done images kept: '+ ('yes' if ok else 'NO')
+  return ok
+#END benchRerun Function
+
+
+#Ok, all benchmarks ready.
+if __name__ == '__main__':
+  BENCHES = [('match', benchMatch), ('render', benchRender),
+             ('fanout', benchFanout), ('batch', benchBatch),
+             ('search', benchSearch),
+             ('dataset', benchDataset), ('sort', benchSort),
+             ('pack', benchPack), ('loader', benchLoader),
+             ('cache', benchCache), ('augment', benchAugment),
+             ('audmage', benchAudmage), ('remap', benchRemap),
+             ('stream', benchStream), ('queue', benchQueue),
+             ('rerun', benchRerun)]
+
+  chosen = [opt.lower() for opt in sys.argv[1:]]
+  for name, func in BENCHES:
+    if not chosen or name in chosen:
+      func()
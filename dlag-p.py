@@ -9,11 +9,19 @@
 # Directory Structure: 
 #     dataset/spect/{train, validate, test}/<genre>/<image.png>
 #        .../audmage/...
+#     or a split manifest: dataset/spect.csv (see dlagdata.py)
+#     or a packed split: dataset/spect-packed/pack.json (+ shards)
+#     images or log-mel features: <track>.npy (audmage.py features),
+#     features train on 1 channel n_mels x frames inputs
 #
 # Command Options:
 #     #1 - directory path to dataset ex: ('dataset/spectrograms')
 #          the program will look here for train and validate dirs
 #          and count files and classes automatically
+#          or a split manifest ex: ('dataset/spect.csv')
+#          written by "audmage.py sorted dataset spect manifest"
+#          or a packed split ex: ('dataset/spect-packed')
+#          written by "dlagdata.py pack dataset/spect.csv"
 #          
 #     #2 - filename and path to save results file
 #          ex: ('myresults/dlag.h5')
@@ -41,12 +49,16 @@ from keras.optimizers import SGD
 import numpy as np
 import sys
 import os
+from multiprocessing import cpu_count
+import dlagdata #split manifests, packs and batch loaders
 #Model Saving Bug Fix
 #from keras.backend import manual_variable_initialization 
 
 
 #Default Command argument variable
 dataPath = 'dataset/spect-med' #Directory containing (train and validate directories)
+manifest = None #Split manifest (.csv), used instead of the directories
+pack = None     #Packed split (dir with pack.json), images decoded once
 saveName = 'dlag-test2-med' #Name to use when saving model/results.
 
 #Set Name
@@ -55,11 +67,26 @@ setName = 'Spectrogram Medium Set'
 # The dimensions to which all images found will be resized.
 #img_width, img_height = 252, 188 #Half size original
 img_width, img_height = 503, 376 #Original size
+img_channels = 3 #1 for log-mel features (found from the data)
 
 #Epoch and batch variables
 epochs = 50
 batch_size = 16
 #(Reduce batch size if OOM error)
+feature_batch_size = 32 #batch size with log-mel features, 1 channel
+                        #128x1292 inputs are ~1/3 of a 503x376x3 image
+
+#Data loading variables (see dlagdata.py)
+workers = cpu_count() #Processes loading batches while the model trains
+max_queue_size = 10   #Batches loaded ahead of the model
+use_multiprocessing = workers > 1 #(batches are seeded, safe in processes)
+cache_mb = 0 #Decoded image cache in MB (0 = off), ex: 8000 spectrograms
+             #at 503x376 are ~4600 MB, loaded from disk only once.
+             #Loads with threads (the cache is in this process).
+
+#Augmentation variables (see dlagdata.BatchAugmenter, whole batches)
+time_mask = 0. #Widest time band masked, fraction of the width (0 = off)
+freq_mask = 0. #Widest frequency band masked, fraction of the height
 
 #The rest of these are found or assumed
 dataPathT = dataPath +"/train"    #Default training data path
@@ -83,7 +110,27 @@ print "\n"
 if len(sys.argv) > 1:
 
   #1 - path to dataset (assuming it contains min: train, validate)
-  if not os.path.isdir(sys.argv[1]) == True:
+  #or to a split manifest or packed split
+  if os.path.isfile(sys.argv[1] +'/pack.json') or (os.path.isfile(sys.argv[1]) and sys.argv[1].lower().endswith('.csv')):
+    dataPath = str(sys.argv[1])
+    if os.path.isdir(dataPath):
+      pack = dlagdata.readPack(dataPath)
+      #a split with the counts and genres of the pack
+      manifest = dict((split, [pack['splits'][split]['paths'], pack['splits'][split]['classes']])
+                      for split in dlagdata.SPLITS)
+      manifest['genres'] = pack['genres']
+      #The images were resized when packed
+      img_width, img_height = pack['size']
+      img_channels = pack['channels']
+    else:
+      manifest = dlagdata.readManifest(dataPath)
+
+    if len(sys.argv) > 2:
+      saveName = str(sys.argv[2])
+
+    if len(sys.argv) > 3:
+      setName = str(sys.argv[3])
+  elif not os.path.isdir(sys.argv[1]) == True:
     print "Error, " + str(sys.argv[1]) +" is not a directory or doesn't exist\n"
     sys.exit()
   else:
@@ -107,7 +154,8 @@ print 'Results will be saved to: '+ saveName
 print 'Running: '+ setName
 
 #Verify that the directory given has {train, test, validate} dirs
-subList = os.listdir(dataPath)
+#(or that the manifest has train and validate images)
+subList = [] if manifest else os.listdir(dataPath)
 c = 0 #count of sub-dirs
 cCountT = 0 #count of train classes
 cCountV = 0 #count of validate classes
@@ -148,18 +196,45 @@ for subDir in subList:
     if c >= 3:
       break #We found them, stop looking.
 #END subDir loop
+if manifest:
+  for split in dlagdata.SPLITS:
+    if len(manifest[split][0]) > 0:
+      print 'Found '+ str(len(manifest[split][0])) +' '+ split +' images.'
+      c += 1
+  print 'Found '+ str(len(manifest['genres'])) +' classes.\n'
+  cCountT = cCountV = classCount = len(manifest['genres'])
+  trainCount = len(manifest['train'][0])
+  validCount = len(manifest['validate'][0])
+  if len(manifest['test'][0]) < 1:
+    dataPathP = None #No test images, skip predictions
 if not c >= 2:
   print 'Unable to locate both train and validation directories.'
   sys.exit()
 if not cCountV == cCountT:
   print 'Train and Validation have different number of classes.'
   sys.exit()
+if not manifest:
+  #The directories as lists, loaded like a manifest
+  manifest = dlagdata.readDirectories({'train': dataPathT, 'validate': dataPathV, 'test': dataPathP})
+  classCount = len(manifest['genres'])
+  trainCount = len(manifest['train'][0])
+  validCount = len(manifest['validate'][0])
+  if len(manifest['test'][0]) < 1:
+    dataPathP = None #No test images, skip predictions
+
+#Log-mel features? They're used at their own size (n_mels, frames)
+if not pack and dlagdata.featureShape(manifest):
+  img_width, img_height = dlagdata.featureShape(manifest)
+  img_channels = 1
+if img_channels == 1:
+  batch_size = feature_batch_size
+  print 'Training on '+ str(img_width) +'x'+ str(img_height) +' log-mel features, batches of '+ str(batch_size)
 
 #Verify input_shape format
 if K.image_data_format() == 'channels_first':
-    input_shape = (3, img_width, img_height)
+    input_shape = (img_channels, img_width, img_height)
 else:
-    input_shape = (img_width, img_height, 3)
+    input_shape = (img_width, img_height, img_channels)
 
 #Begin our model
 model = Sequential()
@@ -220,32 +295,66 @@ model.compile(loss='categorical_crossentropy', #Loss function
               optimizer=SGD(lr=1e-2, momentum=0.9), #Optimizer function
               metrics=['accuracy']) #measurements evaluated by the model
 
+#Images are rescaled to 0-1, features are read scaled
+rescale = 1. / 255 if img_channels == 3 else None
+
 # this is the augmentation configuration we will use for training
-train_datagen = ImageDataGenerator(
-    rescale=1. / 255,
+# (augmented a batch at a time, one seed per batch)
+train_datagen = dlagdata.BatchAugmenter(
+    rescale=rescale,
     shear_range=0.2,
     zoom_range=0.2,
-    horizontal_flip=True)
+    horizontal_flip=True,
+    time_mask=time_mask,
+    freq_mask=freq_mask)
 
 # this is the augmentation configuration we will use for testing:
 # only rescaling
-validate_datagen = ImageDataGenerator(rescale=1. / 255)
+validate_datagen = ImageDataGenerator(rescale=rescale)
+
+#Keep the decoded images between epochs? (not for packs,
+#they're memory-mapped and cached by the OS already)
+cache = None
+callbacks = []
+if cache_mb > 0 and not pack:
+  cache = dlagdata.ImageCache(cache_mb * 1024 * 1024)
+  callbacks.append(dlagdata.CacheReport(cache))
+  use_multiprocessing = False #worker threads share the cache
 
 #Create a training generator that will load our image files
 #and create augmented versions of them to train on.
-train_generator = train_datagen.flow_from_directory(
-    dataPathT,
-    target_size=(img_width, img_height),
-    batch_size=batch_size,
-    class_mode='categorical')
-
 #Create a validation generator that will do the same but
 #for validation segment of the script
-validation_generator = validate_datagen.flow_from_directory(
-    dataPathV,
-    target_size=(img_width, img_height),
-    batch_size=batch_size,
-    class_mode='categorical')
+if pack:
+  #Straight from the memory-mapped shards, no decoding
+  train_generator = dlagdata.flowFromPack(
+      train_datagen, pack, 'train',
+      batch_size=batch_size,
+      class_mode='categorical')
+
+  validation_generator = dlagdata.flowFromPack(
+      validate_datagen, pack, 'validate',
+      batch_size=batch_size,
+      class_mode='categorical')
+else:
+  #Straight from the manifest's (or directories') lists
+  train_generator = dlagdata.flowFromManifest(
+      train_datagen, manifest, 'train',
+      target_size=(img_width, img_height),
+      batch_size=batch_size,
+      class_mode='categorical',
+      cache=cache)
+
+  validation_generator = dlagdata.flowFromManifest(
+      validate_datagen, manifest, 'validate',
+      target_size=(img_width, img_height),
+      batch_size=batch_size,
+      class_mode='categorical',
+      cache=cache)
+
+#Times how long each step waits for its batch
+stallTimer = dlagdata.StallTimer()
+callbacks.append(stallTimer)
 
 ##################################################
 ## BEGIN ACTUAL TRAINING and VALIDATION PROCESS ##
@@ -257,7 +366,9 @@ history = model.fit_generator(
     epochs=epochs,
     validation_data=validation_generator,
     validation_steps=validCount // batch_size,
-    use_multiprocessing=False, workers=1)
+    callbacks=callbacks,
+    max_queue_size=max_queue_size,
+    use_multiprocessing=use_multiprocessing, workers=workers)
 
 ## BEGIN TROUBLE ZONE ##
 
@@ -294,19 +405,30 @@ if not dataPathP == None:
   prediction_datagen = ImageDataGenerator()
 
   #Load the ImageDataGenerator with images from our test directory
-  prediction_generator = prediction_datagen.flow_from_directory(
-    dataPathP, #Path to the test directory
-    target_size=(img_width, img_height), #resized dimensions of our images
-    batch_size=batch_size, #Provide the batch size to use
-    classes=['Electronic', 'Experimental', 'Folk', 'Hip-Hop', 'Instrumental', 'International', 'Pop', 'Rock'],
-    class_mode='categorical')#Pass the labels into the generator, and switch mode to categorical
+  if pack:
+    #or the pack's test images (in order, for the filenames)
+    prediction_generator = dlagdata.flowFromPack(
+      prediction_datagen, pack, 'test',
+      batch_size=batch_size, #Provide the batch size to use
+      class_mode='categorical',
+      shuffle=False)
+  else:
+    #or the test images of the manifest (or test directory)
+    #in order, so the predictions match the filenames
+    prediction_generator = dlagdata.flowFromManifest(
+      prediction_datagen, manifest, 'test',
+      target_size=(img_width, img_height), #resized dimensions of our images
+      batch_size=batch_size, #Provide the batch size to use
+      class_mode='categorical',
+      shuffle=False)
 
   #Let's make our predictions!!
   final_predictions = model.predict_generator(
     prediction_generator, #pass in our ImageDataGenerator Results
     verbose=True, #Show us that your doing something.
-    use_multiprocessing=False, #Use built in multi-processing.
-    workers=1)  #Set how many sub-processes you want.
+    max_queue_size=max_queue_size, #Batches loaded ahead
+    use_multiprocessing=use_multiprocessing, #Use built in multi-processing.
+    workers=workers)  #Set how many sub-processes you want.
 
   #Get the class index dictionary and filenames
   classIndexDict = prediction_generator.class_indices #Dictionary of Class -> Index
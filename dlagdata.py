@@ -0,0 +1,715 @@
+# DLAG Data Sources
+#
+# Author: C-490 Deep Learning Group
+#
+# Brief: Feeds the images of a dataset split to dlag-p.py
+#        from a split manifest written by audmage.py
+#        (python audmage.py sorted dataset spect manifest),
+#        no dataset/<type>/<split>/<genre> tree needed.
+#        Or packs the split once into uint8 shards (decoded and
+#        resized) that training memory-maps, no PNG decoding
+#        on every epoch.
+#        The batch loaders are keras Sequences, any batch can be
+#        made by any worker process (fit_generator's workers and
+#        use_multiprocessing), StallTimer shows if they keep up.
+#        BatchAugmenter augments a whole batch at once (shear,
+#        zoom, flip and/or time/frequency masks), seeded per batch.
+#        Log-mel features (audmage.py's features option, float16
+#        .npy) are read as 1 channel inputs instead of images.
+#
+# Manifest: dataset/<spect|audmage>.csv, one row per image
+#     path,track,genre,label,split
+#     ../sorted/spect/Rock/000002.png,2,Rock,7,train
+#     (paths are relative to the manifest)
+#
+# Features: <track>.npy, float16 (n_mels, frames) log-mel in dB,
+#     read scaled to 0-1 (peak - 80 dB to the peak, like the
+#     spectrograms' colours) and cut or padded to target_size
+#     (n_mels, frames), N x n_mels x frames x 1
+#
+# Pack: <dir>/pack.json, <split>-000.npy ... (uint8 images,
+#     N x H x W x 3, H x W is dlag-p's target_size, or float16
+#     features N x n_mels x frames x 1) and <split>-labels.npy (int32)
+#
+# Command inputs (packing):
+#   1-  pack
+#   2-  <manifest.csv> : split manifest to pack
+#   3-  <dir>          : where the pack goes (default dataset/spect-packed
+#                        for dataset/spect.csv)
+#   --size=<H>x<W>     : target_size (default 503x376, like dlag-p.py,
+#                        features default to their shape, featureShape)
+#   --shard-mb=<N>     : shard size in MB (default 512)
+#   --workers=<N>      : processes decoding images (default all cores)
+#
+# Usage:
+#     import dlagdata
+#     split = dlagdata.readManifest('dataset/spect.csv')
+#     gen = dlagdata.flowFromManifest(datagen, split, 'train',
+#              target_size=(503, 376), batch_size=16)
+#
+# ex: ~$ python dlagdata.py pack dataset/spect.csv
+# decodes the split once to dataset/spect-packed, then:
+#     ~$ python dlag-p.py dataset/spect-packed
+##############################################################
+
+#Imports
+import csv
+import os
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+import numpy as np
+from keras.preprocessing.image import Iterator, load_img
+from keras.callbacks import Callback
+from keras import backend as K
+
+SPLITS = ['train', 'test', 'validate'] #Split names in a manifest
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+FEATURE_EXT = '.npy' #Log-mel features (audmage.py features)
+TOP_DB = 80.0 #dB range of the log-mel features (batchLogMel's floor)
+
+
+#True if a manifest path is a log-mel feature file, not an image
+def isFeatures(path):
+  return path.lower().endswith(FEATURE_EXT)
+#END isFeatures Function
+
+
+#Returns the (n_mels, frames) of a split's (readManifest result)
+#features, the most frames of its first 100 files (clips vary a
+#little), None if it has images
+def featureShape(split, sample=100):
+  paths = [path for name in SPLITS for path in split[name][0]][:sample]
+  if not paths or not isFeatures(paths[0]):
+    return None
+  shapes = [np.load(path, mmap_mode='r').shape for path in paths]
+  return (shapes[0][0], max(shape[1] for shape in shapes))
+#END featureShape Function
+
+
+#Reads a split manifest, returns a dictionary:
+#  'genres': genre names (index = label)
+#  '<split>': [paths, labels] for each split (paths joined
+#             to the manifest's directory, labels int32)
+def readManifest(manifestPath):
+  root = os.path.dirname(manifestPath)
+  split = dict((name, [[], []]) for name in SPLITS)
+  genres = {} #label -> genre
+  with open(manifestPath, 'rb') as mfile:
+    reader = csv.reader(mfile)
+    header = next(reader)
+    col = dict((name, header.index(name)) for name in ['path', 'genre', 'label', 'split'])
+    for row in reader:
+      label = int(row[col['label']])
+      genres[label] = row[col['genre']]
+      paths, labels = split.setdefault(row[col['split']], [[], []])
+      paths.append(os.path.join(root, row[col['path']]))
+      labels.append(label)
+
+  for name in split:
+    split[name][1] = np.array(split[name][1], dtype=np.int32)
+  split['genres'] = [genres.get(label, str(label)) for label in range(max(genres) + 1 if genres else 0)]
+  return split
+#END readManifest Function
+
+
+#Reads a dataset/<type>/{train, test, validate}/<genre>/ tree like
+#readManifest reads a manifest, dirs: split name -> its directory
+#(a missing one is an empty split). The genres (labels) are the
+#sorted sub-directories of train, like flow_from_directory.
+def readDirectories(dirs):
+  split = dict((name, [[], []]) for name in SPLITS)
+  genres = []
+  if os.path.isdir(dirs.get('train') or ''):
+    genres = sorted(d for d in os.listdir(dirs['train']) if os.path.isdir(os.path.join(dirs['train'], d)))
+  for name in SPLITS:
+    if not os.path.isdir(dirs.get(name) or ''):
+      continue
+    paths, labels = split[name]
+    for label, genre in enumerate(genres):
+      genreDir = os.path.join(dirs[name], genre)
+      if not os.path.isdir(genreDir):
+        continue
+      for fname in sorted(os.listdir(genreDir)):
+        if fname.lower().endswith(IMAGE_EXTS + (FEATURE_EXT,)):
+          paths.append(os.path.join(genreDir, fname))
+          labels.append(label)
+  for name in SPLITS:
+    split[name][1] = np.array(split[name][1], dtype=np.int32)
+  split['genres'] = genres
+  return split
+#END readDirectories Function
+
+
+###############
+# IMAGE CACHE #
+###############
+#Decoded, resized images (uint8) kept in memory between epochs,
+#up to maxBytes, least recently used ones are dropped first.
+#Images that don't fit are decoded from disk again when needed.
+#Shared by the threads of one process (not across processes,
+#keras makes new worker processes every epoch).
+class ImageCache(object):
+
+  def __init__(self, maxBytes):
+    self.maxBytes = maxBytes
+    self.images = OrderedDict() #key -> uint8 array, oldest first
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.lock = threading.Lock()
+
+  #Returns the cached image (read-only) or None
+  def get(self, key):
+    with self.lock:
+      pixels = self.images.pop(key, None)
+      if pixels is None:
+        self.misses += 1
+        return None
+      self.images[key] = pixels #most recently used
+      self.hits += 1
+      return pixels
+
+  def put(self, key, pixels):
+    if pixels.nbytes > self.maxBytes:
+      return False
+    pixels.flags.writeable = False #augmentation works on copies
+    with self.lock:
+      if key in self.images:
+        self.nbytes -= self.images.pop(key).nbytes
+      while self.nbytes + pixels.nbytes > self.maxBytes:
+        self.nbytes -= self.images.popitem(last=False)[1].nbytes
+        self.evictions += 1
+      self.images[key] = pixels
+      self.nbytes += pixels.nbytes
+    return True
+
+  #Returns the counters: hits, misses, hit_rate, images, bytes,
+  #max_bytes and evictions
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {'hits': self.hits, 'misses': self.misses,
+              'hit_rate': self.hits / float(lookups) if lookups else 0.0,
+              'images': len(self.images), 'bytes': self.nbytes,
+              'max_bytes': self.maxBytes, 'evictions': self.evictions}
+
+  def __str__(self):
+    st = self.stats()
+    return 'Image cache: %.1f%% hits (%d of %d), %d images, %.1f of %.1f MB, %d evicted' % (
+      100 * st['hit_rate'], st['hits'], st['hits'] + st['misses'], st['images'],
+      st['bytes'] / 1e6, st['max_bytes'] / 1e6, st['evictions'])
+#END ImageCache Class
+
+
+#Keras callback printing an ImageCache's statistics after each epoch
+class CacheReport(Callback):
+
+  def __init__(self, cache):
+    super(CacheReport, self).__init__()
+    self.cache = cache
+
+  def on_epoch_end(self, epoch, logs=None):
+    print str(self.cache)
+#END CacheReport Class
+
+
+#Decodes and resizes one image like flow_from_directory does
+#(load_img, nearest), returns it as uint8 H x W x channels
+def decodePixels(path, target_size, color_mode='rgb'):
+  pixels = np.asarray(load_img(path, color_mode=color_mode, target_size=target_size), dtype=np.uint8)
+  if pixels.ndim == 2:
+    pixels = pixels[:, :, np.newaxis] #grayscale
+  return pixels
+#END decodePixels Function
+
+
+#Reads a track's log-mel features (float16 dB), scaled to 0-1 from
+#TOP_DB under its peak, frames cut or padded (with 0, the floor)
+#to target_size, returns them as float16 n_mels x frames x 1
+def decodeFeatures(path, target_size):
+  logMel = np.load(path)
+  rows, cols = target_size
+  if logMel.shape[0] != rows:
+    raise ValueError(path +' has '+ str(logMel.shape[0]) +' mel bands, not '+ str(rows))
+  features = np.zeros((rows, cols, 1), dtype=np.float16)
+  frames = min(cols, logMel.shape[1])
+  scaled = logMel[:, :frames].astype(np.float32)
+  scaled -= scaled.max() - TOP_DB
+  scaled *= 1 / TOP_DB
+  np.clip(scaled, 0, 1, out=scaled)
+  features[:, :frames, 0] = scaled
+  return features
+#END decodeFeatures Function
+
+
+######################
+# BATCH AUGMENTATION #
+######################
+#Augments whole batches (N x H x W x C floats) at once in place
+#of ImageDataGenerator's per image scipy transforms, same options
+#and same transforms (keras' shear in degrees, zoom zx/zy, flip):
+#one coordinate map for the batch and a vectorized bilinear
+#lookup (fill_mode 'nearest'). Or/and spectrogram masks: up to
+#mask_count bands of up to time_mask (a fraction of the width,
+#time) and freq_mask (of the height) are set to mask_value
+#(None = the image's mean colour), much cheaper than the affine.
+#Every random draw comes from the rng given, one seed = one batch.
+#Used as the image_data_generator of the split iterators.
+class BatchAugmenter(object):
+
+  def __init__(self, rescale=None, shear_range=0., zoom_range=0.,
+               horizontal_flip=False, time_mask=0., freq_mask=0.,
+               mask_count=1, mask_value=None):
+    self.rescale = rescale
+    self.shear_range = shear_range
+    if np.isscalar(zoom_range):
+      zoom_range = [1 - zoom_range, 1 + zoom_range]
+    self.zoom_range = list(zoom_range)
+    self.horizontal_flip = horizontal_flip
+    self.time_mask = time_mask
+    self.freq_mask = freq_mask
+    self.mask_count = mask_count
+    self.mask_value = mask_value
+
+  #Returns the augmented batch (x itself when only rescaled or masked)
+  def augmentBatch(self, x, rng):
+    channelsFirst = K.image_data_format() == 'channels_first'
+    if channelsFirst:
+      x = x.transpose(0, 2, 3, 1) #a view, N x H x W x C
+    if self.rescale:
+      x *= self.rescale
+    n = len(x)
+    flips = (rng.random_sample(n) < 0.5) & bool(self.horizontal_flip)
+    shears = rng.uniform(-self.shear_range, self.shear_range, n) if self.shear_range else np.zeros(n)
+    if self.zoom_range != [1, 1]:
+      zooms = rng.uniform(self.zoom_range[0], self.zoom_range[1], (n, 2))
+    else:
+      zooms = np.ones((n, 2))
+    if self.shear_range or self.zoom_range != [1, 1]:
+      x = affineBatch(x, shears, zooms, flips)
+    elif flips.any():
+      x[flips] = x[flips, :, ::-1]
+    if self.time_mask or self.freq_mask:
+      maskBatch(x, rng, self.time_mask, self.freq_mask, self.mask_count, self.mask_value)
+    if channelsFirst:
+      x = np.ascontiguousarray(x.transpose(0, 3, 1, 2))
+    return x
+#END BatchAugmenter Class
+
+
+#Shears, zooms and flips (after) every image of x (N x H x W x C)
+#like keras' apply_affine_transform + flip_axis: the matrix
+#[[zx, -sin(shear) zy], [0, cos(shear) zy]] about the image centre
+#maps each output pixel to the input, read with bilinear
+#interpolation, coordinates past the edges clamped ('nearest').
+#The input column only depends on the output column, so columns
+#are interpolated first (whole columns, per image) then rows
+#(one lookup for the batch), 2 gathers instead of 4.
+def affineBatch(x, shears, zooms, flips):
+  n, h, w, c = x.shape
+  shears = np.deg2rad(shears)
+  a00 = zooms[:, 0].astype(np.float32)[:, np.newaxis, np.newaxis]
+  a01 = -np.sin(shears) * zooms[:, 1]
+  a11 = np.cos(shears) * zooms[:, 1]
+  oRow = h / 2. + 0.5 #keras' transform_matrix_offset_center
+  oCol = w / 2. + 0.5
+  b0 = oRow - zooms[:, 0] * oRow - a01 * oCol
+  b1 = oCol - a11 * oCol
+
+  #Pixel i's neighbours are i and i + 1, so the last pixel is
+  #read as 0% of the one before it and 100% of itself
+  col = np.arange(w)[np.newaxis, :]
+  col = np.where(flips[:, np.newaxis], w - 1 - col, col) #n x w, flipped output
+  inCol = np.clip(a11[:, np.newaxis] * col + b1[:, np.newaxis], 0, w - 1)
+  c0 = np.minimum(inCol.astype(np.intp), w - 2) #floor, they're >= 0
+  fc = (inCol - c0).astype(x.dtype)[:, :, np.newaxis]
+  cols = np.empty_like(x)
+  for i in range(n):
+    left = np.take(x[i], c0[i], axis=1)
+    right = np.take(x[i], c0[i] + 1, axis=1)
+    right -= left
+    right *= fc[i]
+    np.add(left, right, out=cols[i])
+
+  shift = (a01[:, np.newaxis] * col + b0[:, np.newaxis]).astype(np.float32)
+  inRow = a00 * np.arange(h, dtype=np.float32)[np.newaxis, :, np.newaxis] + shift[:, np.newaxis, :]
+  np.clip(inRow, 0, h - 1, out=inRow)
+  r0 = np.minimum(inRow.astype(np.intp), h - 2)
+  inRow -= r0
+  top = r0
+  top += (np.arange(n) * h)[:, np.newaxis, np.newaxis]
+  top *= w
+  top += np.arange(w)
+  flat = cols.reshape(n * h * w, c)
+  out = np.take(flat, top, axis=0)
+  top += w
+  lower = np.take(flat, top, axis=0)
+  lower -= out
+  lower *= inRow[..., np.newaxis]
+  out += lower
+  return out
+#END affineBatch Function
+
+
+#Masks time (column) and frequency (row) bands of every image of
+#x (N x H x W x C) in place, see BatchAugmenter
+def maskBatch(x, rng, timeMask, freqMask, count, value=None):
+  n, h, w, c = x.shape
+  if value is None:
+    fill = x.reshape(n, h * w, c).mean(axis=1) #each image's mean colour
+  else:
+    fill = np.full((n, c), value, dtype=x.dtype)
+  bands = []
+  for size, length in [[timeMask, w], [freqMask, h]]:
+    widths = rng.randint(0, int(size * length) + 1, (n, count))
+    starts = (rng.random_sample((n, count)) * (length - widths + 1)).astype(int)
+    bands.append([starts, starts + widths] if size else None)
+  for i in range(n):
+    for k in range(count):
+      if bands[0]:
+        x[i, :, bands[0][0][i, k]:bands[0][1][i, k]] = fill[i]
+      if bands[1]:
+        x[i, bands[1][0][i, k]:bands[1][1][i, k]] = fill[i]
+  return x
+#END maskBatch Function
+
+
+#Base of the split iterators, a keras Sequence whose batches only
+#depend on (epoch, batch index), not on which process or thread
+#makes them or in what order: the shuffle of an epoch and the
+#augmentation of a batch are seeded from those. So keras can hand
+#the batches to worker processes (use_multiprocessing=True) and
+#no two workers repeat the same random transforms (forked workers
+#all start with the same numpy random state).
+class SplitSequence(Iterator):
+
+  def __init__(self, n, batch_size, shuffle, seed):
+    self.epoch = 0
+    self.baseSeed = seed if seed is not None else np.random.randint(0, 2**31 - 1)
+    super(SplitSequence, self).__init__(n, batch_size, shuffle, seed)
+
+  def _set_index_array(self):
+    if self.shuffle:
+      self.index_array = np.random.RandomState((self.baseSeed + self.epoch) % 2**32).permutation(self.n)
+    else:
+      self.index_array = np.arange(self.n)
+
+  def __getitem__(self, idx):
+    if idx >= len(self):
+      raise ValueError('Asked to retrieve element '+ str(idx) +', but the Sequence has length '+ str(len(self)))
+    if self.index_array is None:
+      self._set_index_array()
+    #random_transform uses numpy's global random state (this process's)
+    seed = (self.baseSeed + self.epoch * len(self) + idx + 1) % 2**32
+    np.random.seed(seed)
+    index_array = self.index_array[self.batch_size * idx:self.batch_size * (idx + 1)]
+    return self._get_batches_of_transformed_samples(index_array, seed)
+
+  def on_epoch_end(self):
+    self.epoch += 1
+    self._set_index_array()
+
+  def next(self):
+    with self.lock:
+      index_array = next(self.index_generator)
+    return self._get_batches_of_transformed_samples(index_array)
+
+  #Runs a BatchAugmenter over the batch (seeded), returns it
+  def augmentBatch(self, batch_x, seed):
+    return self.image_data_generator.augmentBatch(batch_x, np.random.RandomState(seed))
+
+  #Returns the batch with its labels (per class_mode)
+  def labelBatch(self, index_array, batch_x):
+    if self.class_mode == 'categorical':
+      batch_y = np.zeros((len(batch_x), self.num_classes), dtype=K.floatx())
+      batch_y[np.arange(len(batch_x)), self.classes[index_array]] = 1.
+    elif self.class_mode == 'sparse':
+      batch_y = self.classes[index_array]
+    else:
+      return batch_x
+    return batch_x, batch_y
+#END SplitSequence Class
+
+
+#Iterator over the images of one split, like the one
+#flow_from_directory returns (same batches, augmentation,
+#filenames, classes and class_indices) but from a list.
+#With an ImageCache the decoded images are kept between epochs
+#(augmentation still runs every epoch, on copies).
+class ManifestIterator(SplitSequence):
+
+  def __init__(self, paths, labels, genres, image_data_generator,
+               target_size=(256, 256), color_mode='rgb',
+               class_mode='categorical', batch_size=32,
+               shuffle=True, seed=None, cache=None):
+    self.cache = cache
+    self.filenames = list(paths)
+    self.classes = np.asarray(labels, dtype=np.int32)
+    self.class_indices = dict((genre, i) for i, genre in enumerate(genres))
+    self.num_classes = len(genres)
+    self.samples = len(self.filenames)
+    self.image_data_generator = image_data_generator
+    self.target_size = tuple(target_size)
+    self.color_mode = color_mode
+    self.class_mode = class_mode
+    self.features = bool(self.filenames) and isFeatures(self.filenames[0])
+    channels = 1 if color_mode == 'grayscale' or self.features else 3
+    if K.image_data_format() == 'channels_first':
+      self.image_shape = (channels,) + self.target_size
+    else:
+      self.image_shape = self.target_size + (channels,)
+    super(ManifestIterator, self).__init__(self.samples, batch_size, shuffle, seed)
+
+  def _get_batches_of_transformed_samples(self, index_array, seed=None):
+    batch_x = np.zeros((len(index_array),) + self.image_shape, dtype=K.floatx())
+    augmenter = isinstance(self.image_data_generator, BatchAugmenter)
+    for i, j in enumerate(index_array):
+      pixels = None
+      if self.cache is not None:
+        key = (self.filenames[j], self.target_size, self.color_mode)
+        pixels = self.cache.get(key)
+      if pixels is None:
+        if self.features:
+          pixels = decodeFeatures(self.filenames[j], self.target_size)
+        else:
+          pixels = decodePixels(self.filenames[j], self.target_size, self.color_mode)
+        if self.cache is not None:
+          self.cache.put(key, pixels)
+      if K.image_data_format() == 'channels_first':
+        pixels = pixels.transpose(2, 0, 1)
+      if augmenter:
+        batch_x[i] = pixels #augmented as a batch below
+        continue
+      x = pixels.astype(K.floatx())
+      x = self.image_data_generator.random_transform(x)
+      x = self.image_data_generator.standardize(x)
+      batch_x[i] = x
+    if augmenter:
+      batch_x = self.augmentBatch(batch_x, seed)
+    return self.labelBatch(index_array, batch_x)
+#END ManifestIterator Class
+
+
+#Returns a ManifestIterator over one split ('train', 'test'
+#or 'validate') of a readManifest() result, options are
+#the ones of flow_from_directory.
+def flowFromManifest(image_data_generator, split, name, **options):
+  paths, labels = split[name]
+  return ManifestIterator(paths, labels, split['genres'], image_data_generator, **options)
+#END flowFromManifest Function
+
+
+###############
+# STALL TIMER #
+###############
+#Keras callback timing the input pipeline: per training step
+#the time spent waiting for the batch (stall) and the time in
+#the model (compute), printed after each epoch and kept in
+#history as [epoch, stall seconds/step, compute seconds/step].
+class StallTimer(Callback):
+
+  def __init__(self):
+    super(StallTimer, self).__init__()
+    self.history = []
+
+  def on_epoch_begin(self, epoch, logs=None):
+    self.stalls = []
+    self.steps = []
+    self.last = time.time()
+
+  def on_batch_begin(self, batch, logs=None):
+    #fit_generator calls this once the batch is there
+    self.begin = time.time()
+    self.stalls.append(self.begin - self.last)
+
+  def on_batch_end(self, batch, logs=None):
+    self.last = time.time()
+    self.steps.append(self.last - self.begin)
+
+  def on_epoch_end(self, epoch, logs=None):
+    if not self.steps:
+      return
+    stall = sum(self.stalls) / len(self.stalls)
+    step = sum(self.steps) / len(self.steps)
+    self.history.append([epoch, stall, step])
+    print 'Input stall: %.1f ms/step, compute: %.1f ms/step (%.1f%% waiting for data)' % (
+      stall * 1000, step * 1000, 100 * stall / (stall + step))
+#END StallTimer Class
+
+
+###########
+# PACKING #
+###########
+#decodePixels (or decodeFeatures) for the packing pool,
+#job is (path, size)
+def decodeImage(job):
+  if isFeatures(job[0]):
+    return decodeFeatures(job[0], job[1])
+  return decodePixels(job[0], job[1])
+#END decodeImage Function
+
+
+#Packs every split of a manifest into outDir, each image decoded
+#and resized once, written straight into memory-mapped .npy shards
+#of about shardMB MB. pack.json is written last (a pack without
+#it is unfinished). Features are packed as float16. size None is
+#503x376 for images, featureShape() for features.
+#Returns the path of pack.json.
+def packManifest(manifestPath, outDir, size=None, shardMB=512, workers=None):
+  split = readManifest(manifestPath)
+  if not os.path.isdir(outDir):
+    os.makedirs(outDir)
+  features = featureShape(split)
+  size = tuple(size or features or (503, 376))
+  shape = size + (1 if features else 3,)
+  dtype = np.dtype(np.float16 if features else np.uint8)
+  perShard = max(1, int(shardMB * 1024 * 1024 // (shape[0] * shape[1] * shape[2] * dtype.itemsize)))
+  info = {'size': list(size), 'channels': shape[2], 'dtype': dtype.name, 'genres': split['genres'],
+          'manifest': os.path.abspath(manifestPath), 'splits': {}}
+
+  pool = Pool(workers or cpu_count())
+  try:
+    for name in SPLITS:
+      paths, labels = split[name]
+      if len(paths) < 1:
+        continue
+      start = time.time()
+      shards = []
+      for first in range(0, len(paths), perShard):
+        shardPaths = paths[first:first + perShard]
+        shardName = '%s-%03d.npy' % (name, len(shards))
+        images = np.lib.format.open_memmap(os.path.join(outDir, shardName + '.tmp'), mode='w+',
+                                           dtype=dtype, shape=(len(shardPaths),) + shape)
+        jobs = [(path, size) for path in shardPaths]
+        for i, pixels in enumerate(pool.imap(decodeImage, jobs, 8)):
+          images[i] = pixels
+        images.flush()
+        del images
+        os.rename(os.path.join(outDir, shardName + '.tmp'), os.path.join(outDir, shardName))
+        shards.append(shardName)
+      np.save(os.path.join(outDir, name +'-labels.npy'), labels)
+      info['splits'][name] = {'count': len(paths), 'shards': shards,
+                              'labels': name +'-labels.npy', 'paths': paths}
+      print 'Packed '+ str(len(paths)) +' '+ name +' images in '+ str(len(shards)) +' shards ('+ str(round(time.time() - start, 1)) +' s)'
+  finally:
+    pool.close()
+    pool.join()
+
+  infoPath = os.path.join(outDir, 'pack.json')
+  with open(infoPath +'.tmp', 'w') as jfile:
+    json.dump(info, jfile)
+  os.rename(infoPath +'.tmp', infoPath)
+  return infoPath
+#END packManifest Function
+
+
+#Opens a pack (memory-mapped, nothing is read yet), returns
+#pack.json's dictionary with, for each split, 'images' (list of
+#uint8/float16 shard memmaps) and 'classes' (int32 labels) added
+def readPack(packDir):
+  with open(os.path.join(packDir, 'pack.json')) as jfile:
+    pack = json.load(jfile)
+  for name in pack['splits']:
+    info = pack['splits'][name]
+    info['images'] = [np.load(os.path.join(packDir, shard), mmap_mode='r') for shard in info['shards']]
+    info['classes'] = np.load(os.path.join(packDir, info['labels']))
+  for name in SPLITS:
+    pack['splits'].setdefault(name, {'count': 0, 'shards': [], 'paths': [], 'images': [],
+                                     'classes': np.zeros(0, dtype=np.int32)})
+  return pack
+#END readPack Function
+
+
+#Iterator over the images of one split of a pack, same batches
+#as ManifestIterator but read from the memory-mapped shards,
+#no decoding or resizing. A rescale only generator is one
+#multiply, a BatchAugmenter augments the batch at once.
+class PackedIterator(SplitSequence):
+
+  def __init__(self, pack, name, image_data_generator,
+               class_mode='categorical', batch_size=32,
+               shuffle=True, seed=None):
+    info = pack['splits'][name]
+    self.shards = info['images']
+    self.perShard = len(self.shards[0]) if self.shards else 1
+    self.filenames = info['paths']
+    self.classes = info['classes']
+    self.class_indices = dict((genre, i) for i, genre in enumerate(pack['genres']))
+    self.num_classes = len(pack['genres'])
+    self.samples = info['count']
+    self.image_data_generator = image_data_generator
+    self.class_mode = class_mode
+    self.image_shape = tuple(pack['size']) + (pack['channels'],)
+    self.dtype = np.dtype(pack.get('dtype', 'uint8'))
+    self.channels_first = K.image_data_format() == 'channels_first'
+    gen = image_data_generator
+    self.augmenter = isinstance(gen, BatchAugmenter)
+    self.rescale_only = not self.augmenter and not (gen.featurewise_center or gen.samplewise_center or
+                             gen.featurewise_std_normalization or gen.samplewise_std_normalization or
+                             gen.zca_whitening or gen.preprocessing_function or
+                             gen.rotation_range or gen.width_shift_range or gen.height_shift_range or
+                             gen.shear_range or gen.zoom_range != [1, 1] or gen.channel_shift_range or
+                             gen.horizontal_flip or gen.vertical_flip or
+                             getattr(gen, 'brightness_range', None))
+    super(PackedIterator, self).__init__(self.samples, batch_size, shuffle, seed)
+
+  def _get_batches_of_transformed_samples(self, index_array, seed=None):
+    index_array = np.sort(index_array) #each shard's rows together
+    raw = np.empty((len(index_array),) + self.image_shape, dtype=self.dtype)
+    shardNums = index_array // self.perShard
+    for shardNum in np.unique(shardNums):
+      lo, hi = np.searchsorted(shardNums, [shardNum, shardNum + 1])
+      raw[lo:hi] = self.shards[shardNum][index_array[lo:hi] - shardNum * self.perShard]
+    if self.channels_first:
+      raw = raw.transpose(0, 3, 1, 2)
+    if self.rescale_only:
+      #convert and scale in one pass
+      batch_x = np.multiply(raw, self.image_data_generator.rescale or 1, dtype=K.floatx())
+    elif self.augmenter:
+      batch_x = self.augmentBatch(raw.astype(K.floatx()), seed)
+    else:
+      batch_x = raw.astype(K.floatx())
+      for i in range(len(batch_x)):
+        x = self.image_data_generator.random_transform(batch_x[i])
+        batch_x[i] = self.image_data_generator.standardize(x)
+    return self.labelBatch(index_array, batch_x)
+#END PackedIterator Class
+
+
+#Returns a PackedIterator over one split of a readPack() result
+def flowFromPack(image_data_generator, pack, name, **options):
+  return PackedIterator(pack, name, image_data_generator, **options)
+#END flowFromPack Function
+
+
+#Packing command, see the top of the file
+if __name__ == '__main__':
+  if len(sys.argv) < 3 or sys.argv[1].lower() != 'pack' or not os.path.isfile(sys.argv[2]):
+    print 'Usage: python dlagdata.py pack <manifest.csv> [<dir>] [--size=503x376] [--shard-mb=512] [--workers=N]'
+    sys.exit()
+
+  manifestPath = sys.argv[2]
+  outDir = os.path.splitext(manifestPath)[0] +'-packed'
+  size = None #see packManifest
+  shardMB = 512
+  workers = None
+  for option in sys.argv[3:]:
+    optName, optValue = (option.lower().split('=', 1) + [''])[:2]
+    if optName == '--size':
+      size = tuple(int(v) for v in optValue.split('x'))
+    elif optName == '--shard-mb':
+      shardMB = float(optValue)
+    elif optName == '--workers':
+      workers = int(optValue)
+    elif not option.startswith('--'):
+      outDir = option
+    else:
+      print 'Unknown option: '+ option +', skipping it...'
+
+  print 'Packing '+ manifestPath +' to '+ outDir
+  packManifest(manifestPath, outDir, size, shardMB, workers)